@@ -0,0 +1,69 @@
+"""
+Compare per-frame CPU time of decoding websocket frames, between the old path, building a marshmallow schema for every
+summary and serializing every frame for a debug log, and the current path through tempest_decoding.
+
+Run with: python -m benchmarks.bench_decoding [devices] [seconds]
+"""
+import json
+import logging
+import sys
+import time
+from typing import Any, Callable, List
+
+from benchmarks.frames import websocket_frames
+from tempest_extractor.config import TempestConfig, TempestDeviceConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_dataclasses import TempestObservation, TempestObsSummary
+from tempest_extractor.tempest_decoding import loads, orjson
+
+_logger = logging.getLogger(__name__)
+
+
+def old_decode(collector: TempestCollector, frame: str) -> Any:
+    obs = json.loads(frame)
+    _logger.debug("Websocket message:" + json.dumps(obs, indent=2))
+    summary = None
+    if "summary" in obs:
+        summary = TempestObsSummary.schema().load(obs["summary"])
+        summary.epoch = obs["obs"][0][0]
+    return collector._observations_from_response(obs), summary
+
+
+def new_decode(collector: TempestCollector, frame: str) -> Any:
+    obs = loads(frame)
+    _logger.debug("Websocket message: %s", frame)
+    summary = collector._summary_from_response(obs) if "summary" in obs else None
+    return collector._observations_from_response(obs), summary
+
+
+def cpu_per_frame(frames: List[str], function: Callable[[str], Any]) -> float:
+    start = time.process_time()
+    for frame in frames:
+        function(frame)
+    return (time.process_time() - start) / len(frames)
+
+
+def main() -> None:
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 3600
+    frames = [frame for _, frame in websocket_frames(devices, seconds)]
+    collector = TempestCollector(
+        TempestConfig(
+            token="",
+            elements=TempestObservation.get_elements(),
+            summaries=TempestObsSummary.get_elements(),
+            devices=[TempestDeviceConfig(str(d + 1), "") for d in range(devices)],
+        )
+    )
+
+    old = cpu_per_frame(frames, lambda frame: old_decode(collector, frame))
+    new = cpu_per_frame(frames, lambda frame: new_decode(collector, frame))
+    summaries = sum(1 for frame in frames if '"summary"' in frame)
+    print(f"{len(frames)} frames, {summaries} with summaries, orjson {'installed' if orjson else 'not installed'}")
+    print(f"before: {old * 1e6:.1f} us per frame")
+    print(f"after:  {new * 1e6:.1f} us per frame")
+    print(f"speedup: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
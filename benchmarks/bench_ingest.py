@@ -0,0 +1,182 @@
+"""
+Throughput and latency of the live ingest path, from a raw websocket frame through TempestCollector._on_message and
+Streamer._extract to a stub upload queue, and of parsing and converting a large REST historical response. Results
+are written as JSON, so runs can be compared over time.
+
+Run with: python -m benchmarks.bench_ingest --devices 100 --seconds 3600 [--rate 0] [--days 7] [--output run.json]
+
+With --replay, frames recorded by the extractor are used instead of synthetic traffic, for all devices seen in them.
+"""
+import argparse
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from threading import Event
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from benchmarks.frames import historical_response, websocket_frames
+from tempest_extractor.config import ExtractorConfig, TempestConfig, TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_dataclasses import TempestObservation, TempestObsSummary
+from tempest_extractor.tempest_replay import read_frames
+from tempest_extractor.tempest_streamer import Streamer
+
+
+class StubUploadQueue:
+    """
+    Counts what would have been uploaded to CDF.
+    """
+
+    def __init__(self):
+        self.datapoints = 0
+        self.calls = 0
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        self.calls += 1
+        self.datapoints += len(datapoints)
+
+    def upload(self) -> None:
+        pass
+
+
+def percentile(timings: List[float], fraction: float) -> float:
+    if len(timings) < 2:
+        return timings[0] if timings else 0.0
+    return statistics.quantiles(timings, n=100, method="inclusive")[int(fraction * 100) - 1]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def make_config(device_ids: List[str], flush_size: int) -> YamlConfig:
+    tempest = TempestConfig(
+        token="",
+        elements=TempestObservation.get_elements(),
+        summaries=TempestObsSummary.get_elements(),
+        devices=[TempestDeviceConfig(device_id, f"Device {device_id}") for device_id in device_ids],
+    )
+    return YamlConfig(
+        version=None,
+        type=None,
+        # Only the external ID prefix is used on the ingest path
+        cognite=SimpleNamespace(external_id_prefix="tempest:"),
+        logger=None,
+        tempest=tempest,
+        extractor=ExtractorConfig(flush_size=flush_size),
+    )
+
+
+def bench_live(config: YamlConfig, frames: List[Any], rate: float) -> Dict[str, Any]:
+    collector = TempestCollector(config.tempest)
+    queue = StubUploadQueue()
+    streamer = Streamer(queue, Event(), collector, config)
+    flush_size = config.extractor.flush_size
+
+    latencies = []
+    flushes = []
+    start = time.perf_counter()
+    for i, (_, frame) in enumerate(frames):
+        if rate > 0:
+            # Throttle to the given rate, as frames arrive from the network
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        received = time.perf_counter()
+        collector._on_message(None, frame)
+        latencies.append(time.perf_counter() - received)
+        if collector.buffer.depth >= flush_size:
+            flush_start = time.perf_counter()
+            streamer._extract()
+            flushes.append(time.perf_counter() - flush_start)
+    flush_start = time.perf_counter()
+    streamer._extract()
+    flushes.append(time.perf_counter() - flush_start)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "frames": len(frames),
+        "datapoints": queue.datapoints,
+        "seconds": round(elapsed, 4),
+        "frames_per_second": round(len(frames) / elapsed, 1),
+        "datapoints_per_second": round(queue.datapoints / elapsed, 1),
+        "frame_latency_p50_us": round(percentile(latencies, 0.5) * 1e6, 1),
+        "frame_latency_p99_us": round(percentile(latencies, 0.99) * 1e6, 1),
+        "flushes": len(flushes),
+        "flush_latency_p50_ms": round(percentile(flushes, 0.5) * 1e3, 3),
+        "flush_latency_p99_ms": round(percentile(flushes, 0.99) * 1e3, 3),
+    }
+
+
+def bench_historical(config: YamlConfig, days: int) -> Dict[str, Any]:
+    collector = TempestCollector(config.tempest)
+    response = json.dumps(historical_response(device_id=1, days=days))
+    start = time.perf_counter()
+    batch = collector._observations_from_response(json.loads(response))
+    data = collector.datapoints_per_element(config.tempest.elements, batch)
+    elapsed = time.perf_counter() - start
+    datapoints = sum(len(points) for points in data.values())
+    return {
+        "days": days,
+        "rows": len(batch),
+        "payload_bytes": len(response),
+        "datapoints": datapoints,
+        "seconds": round(elapsed, 4),
+        "datapoints_per_second": round(datapoints / elapsed, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=100, help="Number of devices in the fleet")
+    parser.add_argument("--seconds", type=int, default=3600, help="Seconds of websocket traffic to generate")
+    parser.add_argument("--rate", type=float, default=0, help="Frames per second to feed, 0 for as fast as possible")
+    parser.add_argument("--flush-size", type=int, default=1000, help="Buffer depth that triggers a streamer flush")
+    parser.add_argument("--days", type=int, default=7, help="Days in the REST historical response, 0 to skip")
+    parser.add_argument("--replay", help="Recording file or directory to use instead of synthetic traffic")
+    parser.add_argument("--output", help="File to write the results to, instead of stdout")
+    args = parser.parse_args()
+
+    if args.replay:
+        frames = list(read_frames(args.replay))
+        device_ids = sorted({str(json.loads(frame).get("device_id")) for _, frame in frames})
+    else:
+        frames = websocket_frames(args.devices, args.seconds)
+        device_ids = [str(d + 1) for d in range(args.devices)]
+    config = make_config(device_ids, args.flush_size)
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "live": bench_live(config, frames, args.rate),
+    }
+    del frames
+    if args.days > 0:
+        results["historical"] = bench_historical(config, args.days)
+    results["peak_rss_mb"] = round(peak_rss_mb(), 1)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Compare parsing and per-element conversion of a large historical response, between the row based
+TempestObservation path and the columnar TempestObservationBatch path.
+
+Run with: python -m benchmarks.bench_observations [days]
+"""
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from benchmarks.frames import historical_response
+from tempest_extractor.config import TempestConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_dataclasses import TempestObservation
+
+
+def row_based(response: Dict[str, Any], elements: List[str]) -> Dict[str, List[Any]]:
+    # One dataclass per row, then one getattr scan per element, as done before the columnar batches
+    observations = [TempestObservation(a[0], "obs_st", *a[1:22]) for a in response["obs"]]
+    data = {}
+    for element in elements:
+        data[element] = []
+        for obs in observations:
+            if getattr(obs, element) != None:
+                data[element].append((obs.epoch * 1000, getattr(obs, element)))
+    return data
+
+
+def columnar(collector: TempestCollector, response: Dict[str, Any], elements: List[str]) -> Dict[str, List[Any]]:
+    return collector.datapoints_per_element(elements, collector._observations_from_response(response))
+
+
+def allocated(function: Callable[[], Any]) -> int:
+    # Size of what the function returns, as kept alive in the collector between parsing and conversion
+    tracemalloc.start()
+    result = function()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def best_of(repeats: int, function: Callable[[], Any]) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> None:
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    response = historical_response(device_id=1, days=days)
+    elements = TempestObservation.get_elements()
+    collector = TempestCollector(TempestConfig(token="", elements=elements, summaries=[], device_id="1"))
+
+    assert sum(len(v) for v in row_based(response, elements).values()) == sum(
+        len(v) for v in columnar(collector, response, elements).values()
+    )
+
+    row_time = best_of(5, lambda: row_based(response, elements))
+    columnar_time = best_of(5, lambda: columnar(collector, response, elements))
+    print(f"{len(response['obs'])} rows, {len(elements)} elements")
+    print(f"row based: {row_time * 1000:.1f} ms")
+    print(f"columnar:  {columnar_time * 1000:.1f} ms")
+    print(f"speedup:   {row_time / columnar_time:.1f}x")
+
+    row_memory = allocated(lambda: [TempestObservation(a[0], "obs_st", *a[1:22]) for a in response["obs"]])
+    columnar_memory = allocated(lambda: collector._observations_from_response(response))
+    print(f"parsed size, row based: {row_memory / 1024:.0f} KiB")
+    print(f"parsed size, columnar:  {columnar_memory / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
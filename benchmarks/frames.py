@@ -0,0 +1,154 @@
+import json
+import random
+from typing import Any, Dict, List, Tuple
+
+# Seconds between rows in REST historical responses at full resolution
+HISTORICAL_INTERVAL = 60
+# Seconds between rapid_wind messages on the websocket
+RAPID_WIND_INTERVAL = 3
+
+
+def obs_st_row(epoch: int, rng: random.Random) -> List[Any]:
+    """
+    A synthetic obs_st row, laid out as documented in tempest_dataclasses.py.
+    """
+    wind = rng.uniform(0, 12)
+    return [
+        epoch,
+        round(wind * 0.7, 2),
+        round(wind, 2),
+        round(wind * 1.4, 2),
+        rng.randint(0, 359),
+        3,
+        round(rng.uniform(980, 1040), 1),
+        round(rng.uniform(-20, 35), 1),
+        rng.randint(20, 100),
+        rng.randint(0, 100000),
+        round(rng.uniform(0, 11), 2),
+        rng.randint(0, 1000),
+        round(rng.uniform(0, 2), 2),
+        rng.randint(0, 3),
+        0,
+        0,
+        round(rng.uniform(2.3, 2.8), 2),
+        1,
+        round(rng.uniform(0, 30), 2),
+        None,
+        None,
+        0,
+    ]
+
+
+def historical_response(device_id: int, days: int, end: int = 1661673288, seed: int = 0) -> Dict[str, Any]:
+    """
+    A REST historical observations response for a Tempest device with one obs_st row per minute.
+    """
+    rng = random.Random(seed)
+    rows = days * 24 * 60 * 60 // HISTORICAL_INTERVAL
+    start = end - rows * HISTORICAL_INTERVAL
+    return {
+        "status": {"status_code": 0, "status_message": "SUCCESS"},
+        "device_id": device_id,
+        "type": "obs_st",
+        "source": "db",
+        "obs": [obs_st_row(start + i * HISTORICAL_INTERVAL, rng) for i in range(rows)],
+    }
+
+
+def obs_sky_row(epoch: int, rng: random.Random) -> List[Any]:
+    """
+    A synthetic obs_sky row, laid out as documented in tempest_dataclasses.py.
+    """
+    wind = rng.uniform(0, 12)
+    return [
+        epoch,
+        rng.randint(0, 100000),
+        round(rng.uniform(0, 11), 2),
+        round(rng.uniform(0, 2), 2),
+        round(wind * 0.7, 2),
+        round(wind, 2),
+        round(wind * 1.4, 2),
+        rng.randint(0, 359),
+        round(rng.uniform(3.0, 3.6), 2),
+        1,
+        rng.randint(0, 1000),
+        round(rng.uniform(0, 30), 2),
+        rng.randint(0, 3),
+        3,
+        None,
+        None,
+        0,
+    ]
+
+
+def obs_air_row(epoch: int, rng: random.Random) -> List[Any]:
+    """
+    A synthetic obs_air row, laid out as documented in tempest_dataclasses.py.
+    """
+    return [
+        epoch,
+        round(rng.uniform(980, 1040), 1),
+        round(rng.uniform(-20, 35), 1),
+        rng.randint(20, 100),
+        0,
+        0,
+        round(rng.uniform(3.0, 3.6), 2),
+        1,
+    ]
+
+
+ROWS = {"obs_st": obs_st_row, "obs_sky": obs_sky_row, "obs_air": obs_air_row}
+
+
+def summary(rng: random.Random) -> Dict[str, Any]:
+    """
+    A synthetic summary, as sent with observations on the websocket.
+    """
+    temperature = rng.uniform(-20, 35)
+    return {
+        "pressure_trend": rng.choice(["falling", "steady", "rising"]),
+        "strike_count_1h": 0,
+        "strike_count_3h": 0,
+        "precip_total_1h": round(rng.uniform(0, 5), 2),
+        "strike_last_dist": rng.randint(1, 40),
+        "strike_last_epoch": 1661600000,
+        "precip_accum_local_yesterday": 0,
+        "precip_analysis_type_yesterday": 0,
+        "feels_like": round(temperature - 1, 1),
+        "heat_index": round(temperature, 1),
+        "wind_chill": round(temperature - 2, 1),
+        "dew_point": round(temperature - 5, 1),
+        "wet_bulb_temperature": round(temperature - 3, 1),
+        "wet_bulb_globe_temperature": round(temperature - 1, 1),
+        "air_density": round(rng.uniform(1.1, 1.3), 5),
+        "delta_t": round(rng.uniform(0, 10), 1),
+        "raining_minutes": [0] * 12,
+        "pulse_adj_ob_time": 1661673240,
+        "pulse_adj_ob_wind_avg": round(rng.uniform(0, 12), 1),
+        "pulse_adj_ob_temp": round(temperature, 1),
+    }
+
+
+def websocket_frames(devices: int, seconds: int, start: int = 1661673288, seed: int = 0) -> List[Tuple[int, str]]:
+    """
+    Websocket traffic for a fleet, as (epoch, frame) pairs in time order. Devices cycle through Tempest, Sky and Air.
+    Each sends an observation with a summary every minute, Tempest and Sky devices also rapid_wind every 3 seconds.
+    """
+    rng = random.Random(seed)
+    kinds = list(ROWS)
+    frames = []
+    for device in range(devices):
+        device_id = device + 1
+        kind = kinds[device % len(kinds)]
+        # Spread devices over the minute, as real devices are not in sync
+        offset = rng.randint(0, HISTORICAL_INTERVAL - 1)
+        for epoch in range(start + offset, start + seconds, HISTORICAL_INTERVAL):
+            frame = {"type": kind, "device_id": device_id, "obs": [ROWS[kind](epoch, rng)], "summary": summary(rng)}
+            frames.append((epoch, json.dumps(frame)))
+        if kind == "obs_air":
+            continue
+        for epoch in range(start + offset % RAPID_WIND_INTERVAL, start + seconds, RAPID_WIND_INTERVAL):
+            wind = [epoch, round(rng.uniform(0, 12), 2), rng.randint(0, 359)]
+            frames.append((epoch, json.dumps({"type": "rapid_wind", "device_id": device_id, "ob": wind})))
+    frames.sort(key=lambda frame: frame[0])
+    return frames
@@ -1,32 +1,52 @@
 import logging
 import os
+import signal
 from threading import Event, Thread
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 from cognite.client import CogniteClient
 from cognite.client.data_classes import Asset, TimeSeries
 from cognite.extractorutils import Extractor
+from cognite.extractorutils.base import ReloadConfigAction
 from cognite.extractorutils.statestore import AbstractStateStore
 from cognite.extractorutils.uploader import TimeSeriesUploadQueue
-from cognite.extractorutils.util import ensure_time_series
+from cognite.extractorutils.util import ensure_time_series, set_event_on_interrupt
 from tempest_backfiller import Backfiller
 from tempest_client import TempestCollector
 from tempest_frontfiller import Frontfiller
 
 from tempest_extractor import __version__
-from tempest_extractor.config import YamlConfig
-from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.config import TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_aggregation import AggregationStage
+from tempest_extractor.tempest_async import AsyncRuntime
+from tempest_extractor.tempest_buffer import RingBuffer
+from tempest_extractor.tempest_cache import HistoricalCache
+from tempest_extractor.tempest_client import CollectedFrame, TempestCollector
+from tempest_extractor.tempest_compression import CompressionStage
+from tempest_extractor.tempest_coverage import CoverageIndex, coverage_elements
 from tempest_extractor.tempest_dataclasses import TempestObservation, TempestObsSummary, TempestStation
+from tempest_extractor.tempest_gapfiller import GapFiller
+from tempest_extractor.tempest_healer import GapHealer
+from tempest_extractor.tempest_metrics import BUFFER_DEPTH, BUFFER_DROPPED, BUFFER_SPILLED
+from tempest_extractor.tempest_metrics import post_upload_handler as metrics_post_upload_handler
+from tempest_extractor.tempest_pipeline import DedupFilter, SourceCounter
+from tempest_extractor.tempest_registry import ProvisioningRegistry, fingerprint
+from tempest_extractor.tempest_replay import FrameRecorder, FrameReplayer
+from tempest_extractor.tempest_rolling import STATISTICS, RollingFeed, RollingStatistics
+from tempest_extractor.tempest_spill import SpillStage
+from tempest_extractor.tempest_statestore import LogStateStore, state_log_store
 from tempest_extractor.tempest_streamer import Streamer
+from tempest_extractor.tempest_supervisor import Supervisor, partition_state_store, rebalance_states
+from tempest_extractor.tempest_udp import UdpListener
 
 
-def list_time_series(config: YamlConfig, asset_id: Optional[str]) -> List[TimeSeries]:
+def list_time_series(config: YamlConfig, asset_ids: Optional[Dict[str, int]]) -> List[TimeSeries]:
     """
     Create TimeSeries Objects (without creating them in CDF) for all the sensors at all the weather stations configured.
     Args:
         config: Configuration parameters, among other containing the list of elements to track
-        asset_id: (Optional) Dictionary asset ID. If configured to create assets, the
-                time series will be associated with an asset ID.
+        asset_ids: (Optional) Dictionary of asset IDs per device ID. If configured to create assets, the
+                time series will be associated with the asset of its device.
     Returns:
         List of TimeSeries objects
     """
@@ -34,30 +54,41 @@ def list_time_series(config: YamlConfig, asset_id: Optional[str]) -> List[TimeSe
 
     elements = config.tempest.elements + config.tempest.summaries
 
-    for element in elements:
-        if TempestObservation.is_string(element) is None and TempestObsSummary.is_string(element) is None:
-            continue
-        is_str = TempestObservation.is_string(element) or TempestObsSummary.is_string(element)
-        external_id = f"{config.cognite.external_id_prefix}{config.tempest.device_id}:{element}"
+    for device in config.tempest.get_devices():
+        for element in elements:
+            if TempestObservation.is_string(element) is None and TempestObsSummary.is_string(element) is None:
+                continue
+            time_series.append(create_time_series_object(config, device, element, asset_ids))
+        if config.rolling:
+            # Rolling statistics computed in the extractor
+            for statistic in config.rolling.statistics:
+                time_series.append(create_time_series_object(config, device, statistic, asset_ids))
 
-        args = {
-            "external_id": external_id,
-            "legacy_name": external_id,
-            "name": f"{config.tempest.device_name}: {element.replace('_', ' ')}",
-        }
+    return time_series
 
-        if config.extractor.create_assets:
-            args["asset_id"] = asset_id
 
-        if config.cognite.data_set_id:
-            args["data_set_id"] = config.cognite.data_set_id
+def create_time_series_object(
+    config: YamlConfig, device: TempestDeviceConfig, element: str, asset_ids: Optional[Dict[str, int]]
+) -> TimeSeries:
+    is_str = TempestObservation.is_string(element) or TempestObsSummary.is_string(element)
+    external_id = config.external_id(device.device_id, element)
 
-        if is_str:
-            args["is_string"] = True
+    args = {
+        "external_id": external_id,
+        "legacy_name": external_id,
+        "name": f"{device.device_name}: {element.replace('_', ' ')}",
+    }
 
-        time_series.append(TimeSeries(**args))
+    if config.extractor.create_assets and asset_ids:
+        args["asset_id"] = asset_ids.get(device.device_id)
 
-    return time_series
+    if config.cognite.data_set_id:
+        args["data_set_id"] = config.cognite.data_set_id
+
+    if is_str:
+        args["is_string"] = True
+
+    return TimeSeries(**args)
 
 
 def delete_time_series(cdf: CogniteClient, timeseries: List[TimeSeries]):
@@ -67,28 +98,26 @@ def delete_time_series(cdf: CogniteClient, timeseries: List[TimeSeries]):
     cdf.time_series.delete(external_id=to_delete, ignore_unknown_ids=True)
 
 
-def create_asset(config: YamlConfig, cdf: CogniteClient, station: TempestStation) -> str:
+def create_asset_object(config: YamlConfig, device: TempestDeviceConfig, station: TempestStation) -> Asset:
     """
-    Create asset in CDF for the Tempest device. We simplify and support only one device in
-    a station, so we create only one asset.
+    Create Asset object (without creating it in CDF) for a Tempest device. We simplify and create one asset per device,
+    with the metadata of the station it belongs to.
     Args:
         config: Config parameters
-        cdf: Cognite client
+        device: Device to create the asset for
+        station: Station the device belongs to
     Returns:
-        asset_id of asset
+        Asset object
     """
-    asset = cdf.assets.retrieve(external_id=f"{config.cognite.external_id_prefix}{config.tempest.device_id}")
-    if asset:
-        return asset.id
     asset = Asset(
-        external_id=f"{config.cognite.external_id_prefix}{config.tempest.device_id}",
+        external_id=f"{config.cognite.external_id_prefix}{device.device_id}",
         name=station.name,
         source="Tempest",
         metadata={
             "longitude": str(station.longitude),
             "latitude": str(station.latitude),
             "station_id": station.station_id,
-            "device_id": config.tempest.device_id,
+            "device_id": device.device_id,
             "timezone": station.timezone,
             "location_id": station.location_id,
             "public_name": station.public_name,
@@ -96,26 +125,119 @@ def create_asset(config: YamlConfig, cdf: CogniteClient, station: TempestStation
     )
     if config.cognite.data_set_id:
         asset.data_set_id = config.cognite.data_set_id
-    if config.extractor.cleanup:
-        cdf.assets.delete(external_id=f"{config.cognite.external_id_prefix}{config.tempest.device_id}")
-    created_asset = cdf.assets.create(asset)
-    return created_asset.id
+    return asset
 
 
-def run_extractor(cognite: CogniteClient, states: AbstractStateStore, config: YamlConfig, stop_event: Event) -> None:
-    logger = logging.getLogger(__name__)
-
+def create_assets(
+    config: YamlConfig,
+    cdf: CogniteClient,
+    collector: TempestCollector,
+    devices: List[TempestDeviceConfig],
+    registry: Optional[ProvisioningRegistry],
+) -> Dict[str, int]:
+    """
+    Make sure there is an asset in CDF for each Tempest device, with the name and location of its station. Stations
+    are fetched from the Tempest API in one request. Assets known from the registry with the same definition are not
+    looked up, the others are retrieved in one request, the missing ones created in one request, and the ones whose
+    station changed updated in one request.
+    Args:
+        config: Config parameters
+        cdf: Cognite client
+        collector: Tempest collector, to get station metadata from
+        devices: Devices to create assets for
+        registry: (Optional) Registry of assets already provisioned
+    Returns:
+        Dictionary of asset IDs per device ID
+    """
+    asset_ids = {}
+    to_check = {}
+    for device in devices:
+        asset = create_asset_object(config, device, collector.get_station(device.device_id))
+        # Renaming or moving the station changes the fingerprint, so the asset is checked again
+        key = fingerprint(asset.dump())
+        asset_id = registry.asset_id(asset.external_id, key) if registry else None
+        if asset_id is None:
+            to_check[asset.external_id] = (device, asset, key)
+        else:
+            asset_ids[device.device_id] = asset_id
+    if not to_check:
+        return asset_ids
+
+    found = {
+        asset.external_id: asset
+        for asset in cdf.assets.retrieve_multiple(external_ids=list(to_check), ignore_unknown_ids=True)
+    }
+    missing = [asset for external_id, (_, asset, _) in to_check.items() if external_id not in found]
+    changed = [
+        asset
+        for external_id, (_, asset, _) in to_check.items()
+        if external_id in found
+        and (found[external_id].name != asset.name or found[external_id].metadata != asset.metadata)
+    ]
+    if missing:
+        found.update({asset.external_id: asset for asset in cdf.assets.create(missing)})
+    if changed:
+        cdf.assets.update(changed)
+
+    for external_id, (device, _, key) in to_check.items():
+        asset_ids[device.device_id] = found[external_id].id
+        if registry:
+            registry.add_asset(external_id, key, found[external_id].id)
+    return asset_ids
+
+
+def expand_elements(config: YamlConfig) -> None:
     # If first config item is "all", load all elements
     if config.tempest.elements[0] == "all":
         config.tempest.elements = TempestObservation.get_elements()
     if config.tempest.summaries[0] == "all":
         config.tempest.summaries = TempestObsSummary.get_elements()
+    if config.rolling and config.rolling.statistics[0] == "all":
+        config.rolling.statistics = list(STATISTICS)
+
+
+def create_collector(config: YamlConfig) -> TempestCollector:
+    collector = TempestCollector(
+        config.tempest,
+        RingBuffer(
+            capacity=config.extractor.buffer.capacity,
+            overflow=config.extractor.buffer.overflow,
+            size=CollectedFrame.size,
+            spill_path=config.extractor.buffer.spill_path,
+        ),
+        pool_size=config.extractor.parallelism,
+        cache=HistoricalCache(
+            config.cache.path,
+            config.cache.max_size_mb * 1024 * 1024,
+            window=config.cache.window_hours * 60 * 60,
+            closed_after=config.cache.closed_after,
+        )
+        if config.cache
+        else None,
+    )
+    if config.recording:
+        collector.recorder = FrameRecorder(
+            config.recording.path, config.recording.max_file_mb * 1024 * 1024, config.recording.max_files
+        )
+    return collector
+
+
+def provision(
+    cognite: CogniteClient, states: AbstractStateStore, config: YamlConfig, collector: TempestCollector
+) -> None:
+    """
+    Make sure the assets and time series of all configured devices exist in CDF, deleting them first if configured to
+    clean up.
+    """
+    logger = logging.getLogger(__name__)
+    devices = config.tempest.get_devices()
+
+    registry = ProvisioningRegistry(config.extractor.registry_path) if config.extractor.registry_path else None
+    if registry and config.extractor.cleanup:
+        registry.clear()
 
-    logger.info("Starting Tempest extractor")
-    collector = TempestCollector(config.tempest)
     if config.extractor.create_assets:
-        station = collector.get_station()
-        assets = create_asset(config, cognite, station)
+        assets = create_assets(config, cognite, collector, devices, registry)
     else:
         assets = None
 
@@ -124,38 +246,248 @@ def run_extractor(cognite: CogniteClient, states: AbstractStateStore, config: Ya
     if config.extractor.cleanup:
         logger.info(f"Deleting {len(time_series)} time series in CDF")
         delete_time_series(cognite, time_series)
-        os.remove("states.json")
-        states.initialize(force=True)
-
-    logger.info(f"Ensuring that {len(time_series)} time series exist in CDF")
-    ensure_time_series(cognite, time_series)
+        if isinstance(states, LogStateStore):
+            states.clear()
+        else:
+            os.remove("states.json")
+            states.initialize(force=True)
+
+    # Time series in the registry with the same definition are known to exist, only the rest are checked
+    missing = registry.missing_time_series(time_series) if registry else time_series
+    logger.info(f"Ensuring that {len(missing)} of {len(time_series)} time series exist in CDF")
+    if missing:
+        ensure_time_series(cognite, missing)
+    if registry:
+        registry.add_time_series(missing)
+        registry.save()
+
+
+def run_pipeline(
+    cognite: CogniteClient,
+    states: AbstractStateStore,
+    config: YamlConfig,
+    stop_event: Event,
+    collector: TempestCollector,
+) -> None:
+    """
+    Collect live and historical data for the configured devices and upload it to CDF, until the stop event is set.
+    """
+    logger = logging.getLogger(__name__)
 
-    # Start the collector of data from the Tempest network
-    Thread(target=collector.run, name="Collector").start()
+    BUFFER_DEPTH.set_function(lambda: collector.buffer.depth)
+    BUFFER_DROPPED.set_function(lambda: collector.buffer.dropped)
+    BUFFER_SPILLED.set_function(lambda: collector.buffer.spilled)
+
+    sources: Optional[SourceCounter] = None
+    handler = metrics_post_upload_handler(states.post_upload_handler(), lambda count: sources.uploaded(count))
+    spill: Optional[SpillStage] = None
+    coverage = CoverageIndex(config.gapfill.path, config.gapfill.max_spacing) if config.gapfill else None
+    coverage_ids = {
+        config.external_id(device.device_id, element): device.device_id
+        for device in config.tempest.get_devices()
+        for element in coverage_elements(config)
+    }
+
+    def post_upload(uploaded: List[Dict[str, Any]]) -> None:
+        handler(uploaded)
+        if spill is not None:
+            # Spilled data points fed back before this upload are now in CDF
+            spill.confirm_upload()
+        if coverage is not None:
+            coverage.add_uploaded(uploaded, coverage_ids)
 
     with TimeSeriesUploadQueue(
         cognite,
-        post_upload_function=states.post_upload_handler(),
+        post_upload_function=post_upload,
         max_upload_interval=config.extractor.upload_interval,
         trigger_log_level="INFO",
         thread_name="CDF-Uploader",
-    ) as upload_queue:
-        if config.backfill:
-            logger.info("Starting backfiller")
-            backfiller = Backfiller(upload_queue, stop_event, collector, config, states)
-            Thread(target=backfiller.run, name="Backfiller").start()
+    ) as cdf_queue:
+        # Collected data passes through these stages on its way to the CDF upload queue
+        sources = SourceCounter(cdf_queue)
+        upload_queue = sources
+        if config.extractor.spill:
+            spill = SpillStage(
+                upload_queue,
+                config.extractor.spill.path,
+                config.extractor.spill.max_datapoints,
+                config.extractor.spill.segment_mb * 1024 * 1024,
+                config.extractor.spill.drain_rate,
+                stop_event,
+                queue_lock=cdf_queue.lock,
+            )
+            upload_queue = spill
+        # Gaps are inside the ranges already in CDF, so filled and healed gaps skip the deduplication
+        fill_queue = upload_queue
+        if config.extractor.deduplicate:
+            upload_queue = DedupFilter(upload_queue, states, config.extractor.dedup_recent)
+        compression = CompressionStage(upload_queue, config) if config.compression else None
+        upload_queue = compression or upload_queue
+        # High rate live data is aggregated, historical data from the fillers is not
+        aggregation = AggregationStage(upload_queue, config) if config.aggregation else None
+        stream_queue = aggregation or upload_queue
+        rolling = RollingStatistics(config) if config.rolling else None
+        if rolling is not None:
+            # The streamer updates the rolling statistics itself, data from the fillers arrives late and is fed to
+            # them on its way. Statistics computed again replace stored ones, so they skip the deduplication.
+            upload_queue, fill_queue = (
+                RollingFeed(upload_queue, rolling, fill_queue),
+                RollingFeed(fill_queue, rolling, fill_queue),
+            )
+
+        runtime: Optional[AsyncRuntime] = None
+        if config.extractor.runtime == "asyncio" and not config.replay and not config.tempest.udp:
+            # Created before starting any threads, as it checks that it can run with this config
+            runtime = AsyncRuntime(upload_queue, stop_event, collector, config, states, stream_queue, rolling)
+
+        if coverage is not None and not config.replay:
+            logger.info("Starting gap filler")
+            gapfiller = GapFiller(fill_queue, stop_event, collector, config, coverage, cognite)
+            Thread(target=gapfiller.run, name="GapFiller").start()
+
+        healer: Optional[GapHealer] = None
+        if config.tempest.heal_after > 0 and not config.replay:
+            # Fetch what was missed while the websocket was disconnected as soon as it reconnects
+            healer = GapHealer(fill_queue, collector, config)
+            collector.healer = healer.schedule
+
+        if runtime is not None:
+            # Collector, fillers and streamer as coroutines on one event loop in this thread
+            logger.info("Starting asyncio runtime")
+            runtime.run()
+        else:
+            if config.replay:
+                # Feed recorded frames instead of listening to the websocket. The fillers need the REST API and are
+                # not started, so a replay works without network access to Tempest.
+                replayer = FrameReplayer(
+                    collector, config.replay.path, stop_event, config.replay.speed, config.replay.loop
+                )
+                Thread(target=replayer.run, name="Collector").start()
+            else:
+                if config.tempest.udp:
+                    # Listen to the hub on the local network, falling back to the websocket when it goes quiet
+                    listener = UdpListener(collector, config.tempest.udp, stop_event)
+                    Thread(target=listener.run, name="Collector").start()
+                else:
+                    # Start the collector of data from the Tempest network, one websocket shared by all devices
+                    Thread(target=collector.run, name="Collector").start()
+
+                if config.backfill:
+                    logger.info("Starting backfiller")
+                    backfiller = Backfiller(upload_queue, stop_event, collector, config, states)
+                    Thread(target=backfiller.run, name="Backfiller").start()
+
+                # Fill in gap in data between end of last run and now
+                logger.info("Starting frontfiller")
+                frontfiller = Frontfiller(upload_queue, collector, config, states)
+                Thread(target=frontfiller.run, name="Frontfiller").start()
+
+            # Start streaming live data
+            logger.info("Starting streamer")
+            streamer = Streamer(stream_queue, stop_event, collector, config, rolling)
+            Thread(target=streamer.run, name="Streamer").start()
+
+            stop_event.wait()
+
+        if aggregation is not None:
+            # Keep the windows still open, to complete them after a restart
+            aggregation.close()
+            logger.info(f"Aggregation stored one data point per {aggregation.ratio() or 0:.1f} received")
+        if compression is not None:
+            compression.close()
+        if rolling is not None:
+            rolling.close()
+        if collector.recorder is not None:
+            collector.recorder.close()
+        if spill is not None:
+            spill.close()
+        if coverage is not None:
+            coverage.save()
+        if healer is not None:
+            healer.close()
+        collector.close()
+
+
+def run_worker(config: YamlConfig, shard: int, workers: int) -> None:
+    """
+    Run the pipeline for the devices of one shard, in a worker process started by the supervisor. The worker has its
+    own CDF client, uploader and state store partition, and stops when it receives SIGINT or SIGTERM.
+    """
+    config.logger.setup_logging()
+    logger = logging.getLogger(__name__)
+    stop_event = Event()
+    set_event_on_interrupt(stop_event)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    expand_elements(config)
+    cognite = config.cognite.get_cognite_client(f"tempest_extractor-worker-{shard}")
+    states = partition_state_store(config, cognite, shard)
+    states.initialize()
+    states.start()
+    if config.metrics:
+        config.metrics.start_pushers(cognite)
+    logger.info(f"Worker {shard + 1} of {workers} starting for {len(config.tempest.get_devices())} devices")
+    try:
+        run_pipeline(cognite, states, config, stop_event, create_collector(config))
+    finally:
+        states.stop()
+        if config.metrics:
+            config.metrics.stop_pushers()
+
+
+def open_state_log(config: YamlConfig, states: AbstractStateStore) -> LogStateStore:
+    """
+    Open the log state store, seeded with the states of the configured state store the first time it is used.
+    """
+    logger = logging.getLogger(__name__)
+    log_states = state_log_store(config.extractor.state_log)
+    log_states.initialize()
+    if len(log_states) == 0 and len(states) > 0:
+        logger.info(f"Seeding the state log with {len(states)} states from the state store")
+        for key in states:
+            low, high = states.get_state(key)
+            log_states.set_state(key, low, high)
+        log_states.synchronize()
+    log_states.start()
+    return log_states
 
-        # Fill in gap in data between end of last run and now
-        logger.info("Starting frontfiller")
-        frontfiller = Frontfiller(upload_queue, collector, config, states)
-        Thread(target=frontfiller.run, name="Frontfiller").start()
 
-        # Start streaming live data
-        logger.info("Starting streamer")
-        streamer = Streamer(upload_queue, stop_event, collector, config)
-        Thread(target=streamer.run, name="Streamer").start()
+def run_extractor(cognite: CogniteClient, states: AbstractStateStore, config: YamlConfig, stop_event: Event) -> None:
+    logger = logging.getLogger(__name__)
 
-        stop_event.wait()
+    expand_elements(config)
+    logger.info(f"Starting Tempest extractor for {len(config.tempest.get_devices())} devices")
+    if config.extractor.state_log:
+        states = open_state_log(config, states)
+    try:
+        if config.extractor.workers > 0:
+            # The workers collect, the supervisor only uses the REST API to provision, without a buffer or cache
+            provision(cognite, states, config, TempestCollector(config.tempest))
+
+            def reshard(reloaded: YamlConfig) -> None:
+                expand_elements(reloaded)
+                # Cleaning up is done once, on start
+                reloaded.extractor.cleanup = False
+                provision(cognite, states, reloaded, TempestCollector(reloaded.tempest))
+
+            supervisor = Supervisor(config, cognite, states, stop_event, run_worker, reshard=reshard)
+            supervisor.run()
+            if stop_event.is_set():
+                return
+            # The number of workers was changed to 0 in the config file, continue in this process
+            config = supervisor.config
+            expand_elements(config)
+            collector = create_collector(config)
+        else:
+            collector = create_collector(config)
+            provision(cognite, states, config, collector)
+
+        # States left in worker partitions by an earlier run in supervisor mode are moved back
+        rebalance_states(config, cognite, states, 0)
+        run_pipeline(cognite, states, config, stop_event, collector)
+    finally:
+        if config.extractor.state_log:
+            states.stop()
 
 
 def main() -> None:
@@ -166,6 +498,8 @@ def main() -> None:
         config_class=YamlConfig,
         version=__version__,
         run_handle=run_extractor,
+        # Lets the supervisor pick up a changed number of workers from the config file
+        reload_config_action=ReloadConfigAction.REPLACE_ATTRIBUTE,
         continuous_extractor=True,
         # How often the extractor will report that it's a live to CDF
         heartbeat_waiting_time=600,
@@ -1,9 +1,40 @@
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
 
 from cognite.extractorutils.configtools import BaseConfig, MetricsConfig, StateStoreConfig
 
 
+@dataclass
+class BufferConfig:
+    # Maximum number of observation rows and summaries held between the collector and the streamer
+    capacity: int = 100000
+    # What to do when the buffer is full: drop-oldest, block or spill
+    overflow: str = "drop-oldest"
+    spill_path: str = "buffer-spill"
+
+
+@dataclass
+class SpillConfig:
+    # Directory for data points that do not fit in the upload queue
+    path: str = "upload-spill"
+    # Data points held in memory by the upload queue before spilling to disk
+    max_datapoints: int = 1000000
+    segment_mb: int = 16
+    # Data points per second fed back to the upload queue when it has room again
+    drain_rate: int = 10000
+
+
+@dataclass
+class StateLogConfig:
+    # Snapshot of all states, with changes appended to a log next to it (the path with .log appended)
+    path: str = "states-snapshot.json"
+    # Seconds between appending changes to the log, and changed states held in memory before appending them sooner
+    save_interval: int = 10
+    max_pending: int = 10000
+    # Rewrite the snapshot when the log has grown larger than the snapshot and this many MB
+    compact_mb: float = 1
+
+
 @dataclass
 class ExtractorConfig:
     state_store: StateStoreConfig = None
@@ -12,21 +43,182 @@ class ExtractorConfig:
     parallelism: int = 10
     collector_interval: int = 2
     cleanup: bool = False
+    # poll: drain the collector every collector_interval seconds
+    # push: hand data to the upload queue as it arrives, flushing on flush_size or after flush_linger seconds
+    streaming_mode: str = "poll"
+    flush_size: int = 1000
+    flush_linger: float = 0.2
+    # Upload to CDF on every flush in push mode, instead of waiting for upload_interval
+    upload_on_flush: bool = False
+    # threads: one thread per role, asyncio: all roles as coroutines on one event loop (needs aiohttp)
+    runtime: str = "threads"
+    # Drop data points already uploaded, as known from the state store and the most recent timestamps per time series
+    deduplicate: bool = True
+    dedup_recent: int = 2048
+    buffer: BufferConfig = field(default_factory=BufferConfig)
+    # Local record of provisioned assets and time series, so unchanged ones are not checked in CDF on every start
+    registry_path: Optional[str] = "provisioned.json"
+    # Spill data points to disk when the upload queue is full, e.g. while CDF is unreachable
+    spill: Optional[SpillConfig] = None
+    # Run as this many worker processes, each handling a shard of the devices, or in this process if 0
+    workers: int = 0
+    # Keep states in a snapshot and an append-only log of changes, instead of the state store configured above
+    state_log: Optional[StateLogConfig] = None
 
 
 @dataclass
 class BackfillConfig:
     backfill_days: int = 5
+    # Seconds to wait before retrying windows that failed
     iteration_time: int = 30
+    # Largest historical window fetched. Windows are sized to return about target_rows rows each, at full resolution.
+    window_days: int = 7
+    target_rows: int = 1440
+    min_window_minutes: int = 60
 
 
 @dataclass
-class TempestConfig:
-    token: str
+class TempestDeviceConfig:
     device_id: str
     device_name: str
+    # Serial number of the device, e.g. ST-00012345, to pick its UDP broadcasts. Looked up from the stations if unset.
+    serial_number: Optional[str] = None
+
+
+@dataclass
+class UdpConfig:
+    # Listen for the broadcasts of Tempest hubs on the local network
+    port: int = 50222
+    # Address to bind to, all interfaces if empty
+    host: str = ""
+    # Seconds without observations from the hub before falling back to the cloud websocket, 0 to never fall back
+    fallback_after: float = 60
+
+
+@dataclass
+class TempestConfig:
+    token: str
     elements: List[str]
     summaries: List[str]
+    # A single device can be configured directly, several devices through the devices list
+    device_id: Optional[str] = None
+    device_name: Optional[str] = None
+    devices: List[TempestDeviceConfig] = field(default_factory=list)
+    rest_url: str = "https://swd.weatherflow.com/swd/rest"
+    # Seconds before a REST request times out, and how often failed requests are retried
+    timeout: float = 30
+    max_retries: int = 5
+    # Collect live data from UDP broadcasts on the local network instead of the cloud websocket
+    udp: Optional[UdpConfig] = None
+    # Also listen to the rapid_wind updates every 3 seconds on the websocket, stored as rapid_wind_avg and
+    # rapid_wind_direction
+    rapid_wind: bool = False
+    # Seconds a device may go unheard while the websocket is disconnected before the missed interval is fetched from
+    # the REST API on reconnect, 0 to not fetch it. Devices unheard for longer than their report interval are fetched
+    # sooner.
+    heal_after: int = 90
+
+    def get_devices(self) -> List[TempestDeviceConfig]:
+        """
+        Get all configured devices, including the one given by device_id/device_name if set.
+        """
+        devices = [TempestDeviceConfig(str(d.device_id), d.device_name, d.serial_number) for d in self.devices]
+        if self.device_id is not None and str(self.device_id) not in [d.device_id for d in devices]:
+            devices.insert(0, TempestDeviceConfig(str(self.device_id), self.device_name or str(self.device_id)))
+        return devices
+
+
+@dataclass
+class CacheConfig:
+    path: str = "historical-cache"
+    max_size_mb: int = 500
+    # Historical data is fetched and cached in windows of this size
+    window_hours: int = 24
+    # Seconds after its end before a window is cached, as hubs may upload buffered data late
+    closed_after: int = 3600
+
+
+@dataclass
+class AggregationConfig:
+    # Elements to aggregate in the streaming path, and the aggregate to store: average, min, max or count
+    elements: Dict[str, str] = field(
+        default_factory=lambda: {"rapid_wind_avg": "average", "rapid_wind_direction": "average"}
+    )
+    # Window size in seconds
+    window: int = 60
+    # Seconds without new points after which the open window of a time series is stored, so the last window of a
+    # device that went quiet is not held back, 0 to only store a window when a point of a later window arrives
+    flush_after: int = 120
+    # Seconds of raw points to keep in memory per aggregated time series, 0 to keep none
+    raw_tail: int = 0
+    # Where to keep the open windows between runs
+    state_path: str = "aggregation-state.json"
+
+
+@dataclass
+class CompressionElementConfig:
+    # deadband or swinging-door
+    mode: str = "deadband"
+    tolerance: float = 0
+    # Tolerance as a fraction of the last stored value, instead of in the unit of the element
+    relative: bool = False
+
+
+@dataclass
+class CompressionConfig:
+    # Elements to compress, string elements are always stored only when they change
+    elements: Dict[str, CompressionElementConfig] = field(default_factory=dict)
+    # Store a point at least this often, in seconds, even if nothing changed
+    max_interval: int = 3600
+    # Where to keep the compression state between runs, and how often to save it in seconds
+    state_path: str = "compression-state.json"
+    save_interval: int = 60
+
+
+@dataclass
+class RecordingConfig:
+    # Record raw websocket frames to gzip files in this directory
+    path: str = "recordings"
+    # Uncompressed size of each file, and number of files to keep
+    max_file_mb: int = 100
+    max_files: int = 24
+
+
+@dataclass
+class ReplayConfig:
+    # Recording file or directory to replay instead of listening to the websocket
+    path: str = "recordings"
+    # 1 replays in real time, N at N times the speed, 0 as fast as possible
+    speed: float = 1
+    loop: bool = False
+
+
+@dataclass
+class GapFillConfig:
+    # Index of the time ranges each device has data for, built from uploaded data points
+    path: str = "coverage.json"
+    # Seconds between data points before there is a gap, and the usual seconds between observations
+    max_spacing: int = 180
+    report_interval: int = 60
+    # Fill gaps at least min_gap seconds long, ended more than older_than seconds ago
+    min_gap: int = 300
+    older_than: int = 3600
+    # Seconds between looking for gaps, most windows fetched each time, and the largest window
+    interval: int = 600
+    max_fetches: int = 10
+    window_hours: int = 24
+    # Seed the index of new devices from hourly counts of data points in CDF
+    seed: bool = True
+    seed_days: int = 30
+
+
+@dataclass
+class RollingConfig:
+    # Rolling statistics to publish as extra time series per device, or all
+    statistics: List[str] = field(default_factory=lambda: ["all"])
+    # Where to keep the open windows between runs, and how often to save them in seconds
+    state_path: str = "rolling-state.json"
+    save_interval: int = 60
 
 
 @dataclass
@@ -35,3 +227,16 @@ class YamlConfig(BaseConfig):
     backfill: Optional[BackfillConfig] = None
     tempest: Optional[TempestConfig] = None
     extractor: ExtractorConfig = None
+    cache: Optional[CacheConfig] = None
+    aggregation: Optional[AggregationConfig] = None
+    compression: Optional[CompressionConfig] = None
+    recording: Optional[RecordingConfig] = None
+    replay: Optional[ReplayConfig] = None
+    gapfill: Optional[GapFillConfig] = None
+    rolling: Optional[RollingConfig] = None
+
+    def external_id(self, device_id: str, element: str) -> str:
+        """
+        External ID of the time series for an element on a device.
+        """
+        return f"{self.cognite.external_id_prefix}{device_id}:{element}"
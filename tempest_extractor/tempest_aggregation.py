@@ -0,0 +1,230 @@
+import json
+import logging
+import math
+import os
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from tempest_extractor.config import YamlConfig
+from tempest_extractor.tempest_dataclasses import TempestObservation
+from tempest_extractor.tempest_metrics import DATAPOINTS_FILTERED
+from tempest_extractor.tempest_parsers import PARSERS
+from tempest_extractor.tempest_pipeline import UploadStage
+
+_logger = logging.getLogger(__name__)
+
+_filtered = DATAPOINTS_FILTERED.labels("aggregation")
+
+AGGREGATES = ("average", "min", "max", "count")
+
+# Elements given in degrees, which are averaged as unit vectors so that 350 and 10 average to 0, not 180
+VECTOR_ELEMENTS = {"wind_direction", "rapid_wind_direction"}
+
+
+class _Window:
+    """
+    Running aggregates for one window of one time series, updated in constant time per data point. A window stays
+    after it is stored, until a later window opens, so that late points for it are recognized.
+    """
+
+    __slots__ = ("start", "count", "total", "minimum", "maximum", "sin", "cos", "stored", "seen")
+
+    def __init__(self, start: int, state: Optional[List[Any]] = None):
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.sin = 0.0
+        self.cos = 0.0
+        self.stored = False
+        # monotonic() time of the last point added
+        self.seen = time.monotonic()
+        if state:
+            self.start, self.count, self.total, self.minimum, self.maximum, self.sin, self.cos = state[:7]
+            self.stored = len(state) > 7 and state[7]
+
+    def dump(self) -> List[Any]:
+        return [self.start, self.count, self.total, self.minimum, self.maximum, self.sin, self.cos, self.stored]
+
+    def add(self, value: float, vector: bool) -> None:
+        self.count += 1
+        self.seen = time.monotonic()
+        if vector:
+            radians = math.radians(value)
+            self.sin += math.sin(radians)
+            self.cos += math.cos(radians)
+            return
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+
+    def value(self, aggregate: str, vector: bool) -> float:
+        if aggregate == "count":
+            return self.count
+        if vector:
+            # Rounded, as floating point noise around north would otherwise give 359.999...
+            return round(math.degrees(math.atan2(self.sin, self.cos)) % 360, 3) % 360
+        if aggregate == "min":
+            return self.minimum
+        if aggregate == "max":
+            return self.maximum
+        return self.total / self.count
+
+
+class AggregationStage(UploadStage):
+    """
+    Replace high rate data, like the 3 second rapid_wind updates, by one aggregate per window before upload. Windows
+    are aligned to a fixed grid, and a window is stored at its start time when the first point of a later window arrives
+    for the same time series, or when no point has arrived for flush_after seconds, so the last window of a device that
+    went quiet is stored too. Only the running aggregates of the open window are kept, not the raw points, apart from
+    an optional raw tail of the last raw_tail seconds per time series. Points for a window already stored are dropped.
+
+    Open windows are not stored on close, as that would store a partial aggregate at the start time of a window
+    completed after a restart. They are saved to a file instead, and continued after a restart.
+
+    Meant for the streaming path, where data arrives in order. Elements of the periodic observations cannot be
+    aggregated, as the fillers write them at their own timestamps. Elements in degrees are always averaged as vectors.
+
+    Args:
+        next_stage: Upload queue or stage to hand data points on to
+        config: Set of configuration parameters, aggregated elements are taken from config.aggregation
+    """
+
+    def __init__(self, next_stage: Any, config: YamlConfig):
+        super().__init__(next_stage)
+        self.window = config.aggregation.window * 1000
+        self.flush_after = config.aggregation.flush_after
+        self.raw_tail = config.aggregation.raw_tail * 1000
+        self.path = config.aggregation.state_path
+        periodic = {element for parser in PARSERS.values() if not parser.single_row for element in parser.elements}
+        for element, aggregate in config.aggregation.elements.items():
+            if element not in TempestObservation.get_elements():
+                raise ValueError(f"Unknown element {element} to aggregate")
+            if element in periodic:
+                raise ValueError(
+                    f"Cannot aggregate {element}, the fillers store it at the time of each observation. "
+                    "Aggregate rapid_wind_avg and rapid_wind_direction instead."
+                )
+            if aggregate not in AGGREGATES:
+                raise ValueError(f"Unknown aggregate {aggregate} for {element}, use one of {', '.join(AGGREGATES)}")
+
+        # Aggregate and whether it is a vector mean, per external ID
+        self._series: Dict[str, Tuple[str, bool]] = {
+            config.external_id(device.device_id, element): (aggregate, element in VECTOR_ELEMENTS)
+            for device in config.tempest.get_devices()
+            for element, aggregate in config.aggregation.elements.items()
+        }
+        self._open: Dict[str, _Window] = {}
+        self._tails: Dict[str, Deque[Tuple[int, float]]] = {}
+        self._lock = Lock()
+        self.received = 0
+        self.emitted = 0
+        self.late = 0
+        self._load()
+        self._closed = Event()
+        if self.flush_after > 0:
+            Thread(target=self._flusher, name="AggregationFlusher", daemon=True).start()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                states = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            _logger.warning(f"Ignoring unreadable aggregation state {self.path}: {str(e)}")
+            return
+        self._open = {
+            external_id: _Window(state[0], state)
+            for external_id, state in states.items()
+            if external_id in self._series
+        }
+        _logger.info(f"Loaded {len(self._open)} open aggregation windows")
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        series = self._series.get(external_id)
+        if series is None:
+            self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=datapoints)
+            return
+        aggregate, vector = series
+
+        closed = []
+        with self._lock:
+            window = self._open.get(external_id)
+            tail = self._tails.setdefault(external_id, deque()) if self.raw_tail > 0 else None
+            for timestamp, value in datapoints:
+                start = timestamp - timestamp % self.window
+                if window is None or start > window.start:
+                    if window is not None and not window.stored:
+                        closed.append((window.start, window.value(aggregate, vector)))
+                    window = _Window(start)
+                elif start < window.start or window.stored:
+                    self.late += 1
+                    continue
+                window.add(value, vector)
+                if tail is not None:
+                    tail.append((timestamp, value))
+            if window is not None:
+                self._open[external_id] = window
+            if tail:
+                while tail[0][0] < tail[-1][0] - self.raw_tail:
+                    tail.popleft()
+            self.received += len(datapoints)
+            self.emitted += len(closed)
+
+        _filtered.inc(len(datapoints) - len(closed))
+        if closed:
+            self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=closed)
+
+    def _flusher(self) -> None:
+        while not self._closed.wait(min(self.flush_after, self.window / 1000)):
+            self.flush(time.monotonic() - self.flush_after)
+
+    def flush(self, quiet_since: float) -> None:
+        """
+        Store the open windows of time series that have not received a point since a monotonic() time. Later points
+        for these windows are dropped as late.
+
+        Args:
+            quiet_since: monotonic() time
+        """
+        closed = []
+        with self._lock:
+            for external_id, window in self._open.items():
+                if not window.stored and window.seen <= quiet_since:
+                    aggregate, vector = self._series[external_id]
+                    closed.append((external_id, window.start, window.value(aggregate, vector)))
+                    window.stored = True
+            self.emitted += len(closed)
+        for external_id, start, value in closed:
+            self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=[(start, value)])
+
+    def tail(self, external_id: str) -> List[Tuple[int, float]]:
+        """
+        Get the raw points of the last raw_tail seconds for an aggregated time series.
+        """
+        with self._lock:
+            return list(self._tails.get(external_id, ()))
+
+    def close(self) -> None:
+        """
+        Stop storing quiet windows, and save the open windows of all time series, atomically, to continue them after a
+        restart.
+        """
+        self._closed.set()
+        with self._lock:
+            states = {external_id: window.dump() for external_id, window in self._open.items()}
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(states, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def ratio(self) -> Optional[float]:
+        """
+        Raw points received per aggregate stored, or None before anything is stored.
+        """
+        return self.received / self.emitted if self.emitted else None
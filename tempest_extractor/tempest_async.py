@@ -0,0 +1,293 @@
+import asyncio
+import logging
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from threading import Event
+from typing import Any, Callable, Dict, Optional
+
+from cognite.extractorutils.statestore import AbstractStateStore
+from cognite.extractorutils.uploader import TimeSeriesUploadQueue
+
+from tempest_extractor.config import TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_backfiller import Backfiller, WindowPlanner
+from tempest_extractor.tempest_client import TempestCollector, _missing_runs
+from tempest_extractor.tempest_dataclasses import TempestObservationBatch
+from tempest_extractor.tempest_decoding import loads
+from tempest_extractor.tempest_frontfiller import Frontfiller
+from tempest_extractor.tempest_http import RETRY_STATUSES, TempestApiError, backoff_delay, parse_retry_after
+from tempest_extractor.tempest_metrics import REST_ERRORS, REST_REQUEST_SECONDS
+from tempest_extractor.tempest_rolling import RollingStatistics
+from tempest_extractor.tempest_streamer import Streamer
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+_logger = logging.getLogger(__name__)
+
+WEBSOCKET_URL = "wss://ws.weatherflow.com/swd/data"
+
+
+class AsyncRuntime:
+    """
+    Runs the extractor on one asyncio event loop instead of a thread per role. Listening to the websocket, REST fetches
+    for the frontfiller and backfiller, and streaming to the upload queue are coroutines, reusing the planning and
+    conversion of the threaded Streamer, Backfiller and Frontfiller. The CDF uploader keeps running in its own thread.
+
+    Enqueueing data points may block while the uploader holds the upload queue, and the stages save state files as data
+    passes, so data is enqueued from one worker thread, in order, and cache files are read and written in the default
+    executor. The event loop only waits for them, and keeps serving the websocket meanwhile.
+
+    Requires aiohttp, which is not installed by default. The collector buffer cannot use the block overflow policy, as
+    the collector and the streamer share the event loop.
+
+    Args:
+        upload_queue: Where to put data points
+        stop: Stopping event
+        collector: Tempest collector, used for parsing and for its buffer, cache and REST settings
+        config: Set of configuration parameters
+        states: Current state of time series in CDF
+        stream_queue: Where to put live data points, if not upload_queue
+        rolling: Rolling statistics to update with live observations and publish, if any
+    """
+
+    def __init__(
+        self,
+        upload_queue: TimeSeriesUploadQueue,
+        stop: Event,
+        collector: TempestCollector,
+        config: YamlConfig,
+        states: AbstractStateStore,
+        stream_queue: Optional[Any] = None,
+        rolling: Optional[RollingStatistics] = None,
+    ):
+        if aiohttp is None:
+            raise ImportError("The asyncio runtime requires aiohttp, install it with: poetry install -E asyncio")
+        if collector.buffer.overflow == "block":
+            # The collector would wait for room on the event loop, which is also where the streamer makes room
+            raise ValueError(
+                "The block overflow policy cannot be used with the asyncio runtime, use drop-oldest or spill"
+            )
+        self.upload_queue = upload_queue
+        self.stop = stop
+        self.collector = collector
+        self.config = config
+        self.streamer = Streamer(stream_queue or upload_queue, stop, collector, config, rolling)
+        self.frontfiller = Frontfiller(upload_queue, collector, config, states)
+        self.backfiller = Backfiller(upload_queue, stop, collector, config, states) if config.backfill else None
+        self._data: Optional[asyncio.Event] = None
+        self._enqueuer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Enqueuer")
+
+    async def _sleep(self, seconds: float) -> None:
+        # Sleep, but wake up early if the extractor is stopped
+        deadline = time.monotonic() + seconds
+        while not self.stop.is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(min(0.5, deadline - time.monotonic()))
+
+    async def _enqueue(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run a function that puts data in the upload queue in the enqueuer thread, and wait for it.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._enqueuer, function, *args)
+
+    async def _get(self, session: "aiohttp.ClientSession", path: str, params: Dict[str, Any]) -> Any:
+        """
+        GET from the REST API, retrying like TempestHttpClient does.
+        """
+        http = self.collector.http
+        url = f"{http.base_url}/{path.lstrip('/')}"
+        params = {**params, "token": http.token}
+        attempt = 0
+        while True:
+            delay = backoff_delay(attempt, http.backoff_factor, http.max_backoff)
+            started = time.perf_counter()
+            try:
+                async with session.get(url, params=params) as response:
+                    REST_REQUEST_SECONDS.labels(path).observe(time.perf_counter() - started)
+                    if response.status not in RETRY_STATUSES:
+                        if response.status >= 400:
+                            REST_ERRORS.labels(str(response.status)).inc()
+                            raise TempestApiError(path, status=response.status)
+                        return loads(await response.read())
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if retry_after is not None:
+                        delay = retry_after
+                    reason = str(response.status)
+                    error = TempestApiError(path, status=response.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # The exception message may hold the full URL, including the token, so it is not passed on
+                reason = type(e).__name__
+                error = TempestApiError(path, reason=reason)
+            except aiohttp.ClientError as e:
+                REST_ERRORS.labels(type(e).__name__).inc()
+                raise TempestApiError(path, reason=type(e).__name__) from None
+            REST_ERRORS.labels(reason).inc()
+
+            if attempt >= http.max_retries:
+                # Not chained, the original exception may hold the token
+                raise error from None
+            attempt += 1
+            _logger.warning(f"Request to {path} failed ({reason}), retry {attempt} in {delay:.1f} seconds")
+            await asyncio.sleep(delay)
+
+    async def _get_historical(
+        self, session: "aiohttp.ClientSession", device_id: str, time_start: int, time_end: int
+    ) -> TempestObservationBatch:
+        collector = self.collector
+        cache = collector.cache
+        loop = asyncio.get_running_loop()
+        pieces = collector._historical_pieces(time_start, time_end)
+        # The cache reads and writes gzip files
+        responses = [
+            await loop.run_in_executor(None, cache.get, device_id, start, end) if cacheable else None
+            for start, end, cacheable in pieces
+        ]
+        for first, last in _missing_runs(responses):
+            run = pieces[first:last]
+            merged = await self._get_observations(session, device_id, run[0][0], run[-1][1])
+            if len(run) == 1 or collector._full_resolution(merged):
+                fetched = collector._split_historical(merged, run)
+            else:
+                # The API answers long ranges at a coarser resolution, which must not be cached as the windows
+                fetched = [await self._get_observations(session, device_id, start, end) for start, end, _ in run]
+            await loop.run_in_executor(None, collector._cache_pieces, device_id, run, fetched)
+            responses[first:last] = fetched
+        batch = TempestObservationBatch()
+        for (start, end, cacheable), response in zip(pieces, responses):
+            collector._add_historical(response, start, end, cacheable, time_start, time_end, batch)
+        return batch
+
+    async def _get_observations(
+        self, session: "aiohttp.ClientSession", device_id: str, time_start: int, time_end: int
+    ) -> Dict[str, Any]:
+        return await self._get(
+            session, "observations/", {"device_id": device_id, "time_start": time_start, "time_end": time_end}
+        )
+
+    async def _listen(self, session: "aiohttp.ClientSession") -> None:
+        """
+        Listen to all devices over one websocket, reconnecting when the connection drops.
+        """
+        url = f"{WEBSOCKET_URL}?token={self.collector.config.token}"
+        while not self.stop.is_set():
+            try:
+                async with session.ws_connect(url, heartbeat=5) as ws:
+                    self.collector.connected()
+                    for message in self.collector._listen_messages():
+                        await ws.send_str(message)
+                    _logger.info(f"Listening to {len(self.collector.devices)} devices")
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            try:
+                                self.collector._on_message(None, message.data)
+                            except Exception as e:
+                                # Skip the frame and keep listening, like websocket-client does for its callbacks
+                                _logger.error(f"Error handling websocket message: {type(e).__name__}: {str(e)}")
+                                continue
+                            self._data.set()
+                        elif message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _logger.warning(f"Websocket connection failed: {type(e).__name__}")
+            await self._sleep(5)
+
+    async def _stream(self) -> None:
+        """
+        Push data to the upload queue as it arrives, flushing on flush_size or after flush_linger seconds.
+        """
+        buffer = self.collector.buffer
+        loop = asyncio.get_running_loop()
+        while not self.stop.is_set():
+            try:
+                await asyncio.wait_for(self._data.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            deadline = loop.time() + self.config.extractor.flush_linger
+            while buffer.depth < self.config.extractor.flush_size and loop.time() < deadline:
+                self._data.clear()
+                try:
+                    await asyncio.wait_for(self._data.wait(), timeout=deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            self._data.clear()
+            await self._enqueue(self.streamer._extract)
+            if self.config.extractor.upload_on_flush:
+                await loop.run_in_executor(None, self.streamer.upload_queue.upload)
+
+    async def _frontfill(self, session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore) -> None:
+        async def frontfill_device(device: TempestDeviceConfig) -> None:
+            time_range = self.frontfiller._range(device)
+            if time_range is None:
+                return
+            from_time, to_time = time_range
+            async with semaphore:
+                observations = await self._get_historical(
+                    session, device.device_id, from_time.int_timestamp, to_time.int_timestamp
+                )
+            await self._enqueue(self.frontfiller._enqueue, device, observations)
+
+        results = await asyncio.gather(
+            *[frontfill_device(device) for device in self.frontfiller.devices], return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                _logger.error(f"Frontfilling failed: {str(result)}")
+        _logger.info("Frontfilling done")
+
+    async def _backfill(self, session: "aiohttp.ClientSession", semaphore: asyncio.Semaphore) -> None:
+        async def backfill_device(planner: WindowPlanner) -> None:
+            while not planner.done and not self.stop.is_set():
+                window = planner.next_window()
+                try:
+                    async with semaphore:
+                        observations = await self._get_historical(
+                            session, window.device.device_id, window.time_start, window.time_end
+                        )
+                    await self._enqueue(self.backfiller.complete, planner, window, observations)
+                except Exception as e:
+                    planner.retry(window)
+                    _logger.warning(
+                        f"Backfilling window {window} failed, retrying in {self.backfiller.retry_delay} seconds: "
+                        f"{str(e)}"
+                    )
+                    await self._sleep(self.backfiller.retry_delay)
+
+        await asyncio.gather(*[backfill_device(planner) for planner in self.backfiller.plan()])
+        if not self.stop.is_set():
+            _logger.info("Backfilling done")
+
+    async def run_async(self) -> None:
+        self._data = asyncio.Event()
+        parallelism = self.config.extractor.parallelism
+        # REST fetches share the parallelism limit, the websocket gets a connection of its own
+        semaphore = asyncio.Semaphore(parallelism)
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=self.collector.http.timeout, sock_read=self.collector.http.timeout
+        )
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=parallelism + 1), timeout=timeout
+        ) as session:
+            tasks = [
+                asyncio.create_task(self._listen(session), name="Collector"),
+                asyncio.create_task(self._stream(), name="Streamer"),
+                asyncio.create_task(self._frontfill(session, semaphore), name="Frontfiller"),
+            ]
+            if self.backfiller is not None:
+                tasks.append(asyncio.create_task(self._backfill(session, semaphore), name="Backfiller"))
+
+            while not self.stop.is_set():
+                await asyncio.sleep(0.5)
+
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self) -> None:
+        """
+        Run the event loop until the stop event is set.
+        """
+        try:
+            asyncio.run(self.run_async())
+        finally:
+            self._enqueuer.shutdown()
@@ -1,22 +1,183 @@
 import logging
+import math
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from concurrent.futures.thread import ThreadPoolExecutor
+from dataclasses import dataclass
+from statistics import median
 from threading import Event
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import arrow
 from cognite.extractorutils.statestore import AbstractStateStore
 from cognite.extractorutils.uploader import TimeSeriesUploadQueue
-from cognite.extractorutils.util import throttled_loop
 from tempest_client import TempestCollector
 
-from tempest_extractor.config import YamlConfig
+from tempest_extractor.config import TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_dataclasses import TempestObservationBatch
+from tempest_extractor.tempest_metrics import (
+    BACKFILL_WINDOWS_DONE,
+    BACKFILL_WINDOWS_PENDING,
+    DATAPOINTS_ENQUEUED,
+    datapoint_source,
+)
 
 _logger = logging.getLogger(__name__)
 
 
+@dataclass(frozen=True)
+class BackfillWindow:
+    device: TempestDeviceConfig
+    time_start: int
+    time_end: int
+
+    def __str__(self) -> str:
+        return (
+            f"{self.device.device_id} {arrow.get(self.time_start).isoformat()}-{arrow.get(self.time_end).isoformat()}"
+        )
+
+
+class WindowPlanner:
+    """
+    Size the backfill windows of one device as the backfill goes, from the newest backfilled data down to the backfill
+    limit. Each window is sized from the density of the latest response, to return about target_rows rows, and kept
+    below the smallest window the API answered at a coarser resolution than the report interval of the device. Such a
+    coarse response is fetched again in smaller windows. Empty windows are stepped over with a growing window, so gaps
+    in the data do not end the backfill.
+
+    Several windows may be fetched at once, and complete in any order. The backfill only counts as done down to where
+    the completed windows are contiguous from the top, which is end.
+
+    Args:
+        device: Device to backfill
+        end: Epoch seconds to backfill from, everything newer is done
+        stop_at: Epoch seconds to backfill down to
+        size: Seconds in the first window
+        min_size: Smallest window in seconds
+        max_size: Largest window in seconds
+        target_rows: Rows to aim for per response
+    """
+
+    def __init__(
+        self,
+        device: TempestDeviceConfig,
+        end: int,
+        stop_at: int,
+        size: int,
+        min_size: int,
+        max_size: int,
+        target_rows: int,
+    ):
+        self.device = device
+        self.top = end
+        self.end = end
+        self.stop_at = stop_at
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_rows = target_rows
+        # Seconds between observations, as reported by the device
+        self.interval = 60.0
+        # Smallest window answered at a coarser resolution than the interval, and largest answered at full resolution
+        self.coarse_size: Optional[int] = None
+        self.fine_size = 0
+        self.size = self._clamp(size)
+        # Everything newer than planned has been handed out by next_window
+        self._planned = end
+        # Ranges handed out before, to fetch again, and completed windows below end, by their end
+        self._refetch: List[Tuple[int, int]] = []
+        self._completed: Dict[int, int] = {}
+
+    @property
+    def done(self) -> bool:
+        return self.end <= self.stop_at
+
+    @property
+    def has_next(self) -> bool:
+        """
+        Whether next_window has a window to hand out. Without one, the backfill is done once the windows handed out
+        complete.
+        """
+        return bool(self._refetch) or self._planned > self.stop_at
+
+    def _clamp(self, size: float) -> int:
+        upper = self.max_size
+        if self.coarse_size is not None:
+            if self.coarse_size - self.fine_size > self.coarse_size / 100:
+                # Narrow down the largest window at full resolution, halving the range at every coarse response
+                upper = min(upper, (self.fine_size + self.coarse_size) // 2)
+            else:
+                upper = min(upper, self.fine_size)
+        return int(max(self.min_size, min(upper, size)))
+
+    def next_window(self) -> BackfillWindow:
+        """
+        The next window to fetch, the newest range to fetch again first.
+        """
+        if self._refetch:
+            start, end = self._refetch.pop()
+            window = BackfillWindow(self.device, max(start, end - self.size), end)
+            if window.time_start > start:
+                self._refetch.append((start, window.time_start))
+            return window
+        window = BackfillWindow(self.device, max(self.stop_at, self._planned - self.size), self._planned)
+        self._planned = window.time_start
+        return window
+
+    def retry(self, window: BackfillWindow) -> None:
+        """
+        Hand back a window from next_window() that could not be fetched, to fetch it again.
+        """
+        self._refetch.append((window.time_start, window.time_end))
+        self._refetch.sort()
+
+    def remaining(self) -> int:
+        """
+        Estimated number of windows left.
+        """
+        return max(0, math.ceil((self.end - self.stop_at) / self.size))
+
+    def complete(self, window: BackfillWindow, observations: TempestObservationBatch) -> bool:
+        """
+        Take the response to the window from next_window(), and size the next window from it.
+
+        Returns:
+            True if the response is at full resolution, False if the window is to be fetched again in smaller windows
+        """
+        span = window.time_end - window.time_start
+        rows = len(observations)
+        intervals = [v for _, v in observations.datapoints("report_interval") if v] if rows else []
+        if intervals:
+            # Reported in minutes
+            self.interval = median(intervals) * 60
+        if rows > 1 and span > self.min_size:
+            # The smallest step between rows is the resolution, the mean would count gaps in the data
+            epochs = sorted(set(observations.epochs))
+            step = min(b - a for a, b in zip(epochs, epochs[1:])) if len(epochs) > 1 else 0
+            if step > 1.5 * self.interval:
+                self.coarse_size = span if self.coarse_size is None else min(self.coarse_size, span)
+                self.size = self._clamp(span * self.interval / step)
+                self.retry(window)
+                return False
+
+        self._completed[window.time_end] = window.time_start
+        while self.end in self._completed:
+            self.end = self._completed.pop(self.end)
+        if rows > 1:
+            self.fine_size = max(self.fine_size, span)
+        if rows == 0:
+            self.size = self._clamp(self.size * 4)
+        else:
+            self.size = self._clamp(span * self.target_rows / rows)
+        return True
+
+
 class Backfiller:
     """
-    Periodically query the Tempest API for a day of historical data for all the configured elements.
+    Query the Tempest API for historical data for all the configured elements on all devices. Each device is backfilled
+    from its oldest data down to the configured limit in windows sized by a WindowPlanner, with up to parallelism
+    windows fetched concurrently, shared between the devices, so a single device is fetched with several windows at
+    once. Progress is recorded in the state store, so it survives restarts.
 
     Args:
         upload_queue: Where to put data points
@@ -38,72 +199,157 @@ class Backfiller:
         self.stop = stop
         self.collector = collector
         self.config = config
-        self.target_iteration_time = self.config.backfill.iteration_time
+        self.retry_delay = self.config.backfill.iteration_time
         self.states = states
         self.stop_at = arrow.utcnow().shift(days=-config.backfill.backfill_days)
-        self.done = False
+        self.devices = config.tempest.get_devices()
+
+    def _state_key(self, device: TempestDeviceConfig) -> str:
+        return f"backfill:{device.device_id}"
 
-    def _extract_weather_station(self) -> None:
+    def _planner(self, device: TempestDeviceConfig) -> WindowPlanner:
         """
-        Perform a query for a given weather station. Function to send to thread pool in run().
+        Plan the backfill of a device, from where an earlier run got to, or else from its oldest data.
         """
-        timestamps: List[float] = []
-        for element in self.config.tempest.elements:
-            ts = self.states.get_state(
-                f"{self.config.cognite.external_id_prefix}{self.config.tempest.device_id}:{element}"
-            )[0]
-            if ts is not None:
-                timestamps.append(ts)
-
-        if len(timestamps) == 0:
-            # No previous data for weather station, backfill from now
-            timestamps.append(arrow.utcnow().float_timestamp * 1000)
+        end = self.states.get_state(self._state_key(device))[0]
+        if end is None:
+            timestamps: List[float] = []
+            for element in self.config.tempest.elements:
+                ts = self.states.get_state(self.config.external_id(device.device_id, element))[0]
+                if ts is not None:
+                    timestamps.append(ts)
 
-        to_time = arrow.get(max(timestamps) / 1000)
-        from_time = to_time.shift(days=-7)
+            if len(timestamps) == 0:
+                # No previous data for weather station, backfill from now
+                timestamps.append(arrow.utcnow().float_timestamp * 1000)
+            end = max(timestamps) / 1000
 
-        _logger.debug(
-            f"Backfilling from {from_time.isoformat()} to {to_time.isoformat()}, stop at {self.stop_at.isoformat()}"
-        )
-        previous_from_time = self.states.get_state(external_id="last_from")[0] or arrow.utcnow().int_timestamp
-        if from_time.int_timestamp >= previous_from_time:
-            _logger.info(f"Backfilling has reached the end or a gap wider than 7 days at {from_time.isoformat()}")
-            from_time = self.stop_at
-            self.done = True
-            return
-        if from_time < self.stop_at:
-            _logger.info(f"Backfilling reached configured limit at {self.stop_at.isoformat()}")
-            from_time = self.stop_at
-            self.done = True
-            return
-
-        _logger.info(
-            f"Getting backfill data for {self.config.tempest.device_name} from {from_time.isoformat()} to {to_time.isoformat()}"
+        backfill = self.config.backfill
+        return WindowPlanner(
+            device,
+            int(end),
+            self.stop_at.int_timestamp,
+            size=backfill.target_rows * 60,
+            min_size=backfill.min_window_minutes * 60,
+            max_size=backfill.window_days * 24 * 60 * 60,
+            target_rows=backfill.target_rows,
         )
 
-        data = self.collector.datapoints_per_element(
-            self.config.tempest.elements,
-            self.collector.get_historical(time_start=from_time.int_timestamp, time_end=to_time.int_timestamp),
+    def _migrate(self) -> None:
+        """
+        Replace the states of completed windows on a fixed grid, keyed backfill:<device>:<grid start> by earlier
+        versions, by the backfilled range of the device. Windows were fetched concurrently, so the range is where the
+        completed windows are contiguous from the newest one, and older windows are fetched again.
+        """
+        devices = {device.device_id: device for device in self.devices}
+        windows: Dict[str, List[Tuple[str, int, int]]] = {}
+        for key in list(self.states):
+            parts = key.split(":")
+            if len(parts) == 3 and parts[0] == "backfill" and parts[1] in devices:
+                low, high = self.states.get_state(key)
+                windows.setdefault(parts[1], []).append((key, low, high))
+        for device_id, completed in windows.items():
+            key = self._state_key(devices[device_id])
+            completed.sort(key=lambda window: window[2] or 0, reverse=True)
+            if self.states.get_state(key)[0] is None and None not in completed[0][1:]:
+                low, high = completed[0][1:]
+                for _, window_low, window_high in completed[1:]:
+                    if window_high is None or window_high < low:
+                        break
+                    low = min(low, window_low)
+                self.states.set_state(key, low=low, high=high)
+            for window_key, _, _ in completed:
+                self.states.delete_state(window_key)
+            _logger.info(f"Migrated {len(completed)} backfill window states of {devices[device_id].device_name}")
+
+    def plan(self) -> List[WindowPlanner]:
+        """
+        Planners for the devices with backfilling left to do.
+        """
+        self._migrate()
+        planners = [planner for planner in map(self._planner, self.devices) if not planner.done]
+        for planner in planners:
+            BACKFILL_WINDOWS_PENDING.labels(planner.device.device_id).set(planner.remaining())
+        _logger.info(f"Backfilling {len(planners)} of {len(self.devices)} devices")
+        return planners
+
+    def _fetch(self, window: BackfillWindow) -> TempestObservationBatch:
+        """
+        Fetch and parse one window. Function to send to thread pool in run().
+        """
+        _logger.debug(f"Getting backfill data for {window.device.device_name} for {window}")
+        return self.collector.get_historical(
+            window.device.device_id, time_start=window.time_start, time_end=window.time_end
         )
-        _logger.info(f"Got {len(data)} backfiller observations")
-        for element in data:
-            self.upload_queue.add_to_upload_queue(
-                external_id=f"{self.config.cognite.external_id_prefix}{self.config.tempest.device_id}:{element}",
-                datapoints=data[element],
-            )
-        self.states.set_state(external_id="last_from", low=from_time.int_timestamp)
+
+    def _enqueue(self, planner: WindowPlanner, window: BackfillWindow, observations: TempestObservationBatch) -> None:
+        data = self.collector.datapoints_per_element(self.config.tempest.elements, observations)
+        with datapoint_source("backfiller"):
+            for element in data:
+                self.upload_queue.add_to_upload_queue(
+                    external_id=self.config.external_id(window.device.device_id, element),
+                    datapoints=data[element],
+                )
+                DATAPOINTS_ENQUEUED.labels("backfiller").inc(len(data[element]))
+        if planner.end < planner.top:
+            # Only the contiguous range, so a restart fetches windows that had not completed below it
+            self.states.expand_state(self._state_key(window.device), low=planner.end, high=planner.top)
+        BACKFILL_WINDOWS_DONE.labels(window.device.device_id).inc()
+
+    def complete(self, planner: WindowPlanner, window: BackfillWindow, observations: TempestObservationBatch) -> None:
+        """
+        Hand a fetched window to its planner, and enqueue its data if it is at full resolution.
+        """
+        if planner.complete(window, observations):
+            self._enqueue(planner, window, observations)
+        else:
+            _logger.debug(f"Window {window} came back at a coarser resolution, fetching it in smaller windows")
+        BACKFILL_WINDOWS_PENDING.labels(window.device.device_id).set(planner.remaining())
 
     def run(self) -> None:
         """
-        Run backfiller until the low watermark has reached the configured backfill-to limit, or until the stop event is
-        set.
+        Run backfiller until all devices are backfilled down to the configured backfill-to limit, or until the stop
+        event is set. Devices whose fetch failed are retried after iteration_time seconds.
         """
+        planners = self.plan()
+        retry_at: Dict[WindowPlanner, float] = {}
+        in_flight: Dict[Future, Tuple[WindowPlanner, BackfillWindow]] = {}
+        fetching: Counter = Counter()
+
         with ThreadPoolExecutor(
             max_workers=self.config.extractor.parallelism, thread_name_prefix="Backfiller"
         ) as executor:
-            for _ in throttled_loop(self.target_iteration_time, self.stop):
-                executor.submit(self._extract_weather_station).result()
-                if self.done:
-                    # All backfilling reached the end
-                    _logger.info("Backfilling done")
-                    return
+            while planners and not self.stop.is_set():
+                # Keep up to parallelism windows fetching, enqueueing results while others fetch. The device with the
+                # fewest windows fetching goes first, so devices share the pool and a single device fills it.
+                now = time.monotonic()
+                while len(in_flight) < self.config.extractor.parallelism:
+                    ready = [p for p in planners if p.has_next and retry_at.get(p, 0) <= now]
+                    if not ready:
+                        break
+                    planner = min(ready, key=lambda p: fetching[p])
+                    window = planner.next_window()
+                    in_flight[executor.submit(self._fetch, window)] = (planner, window)
+                    fetching[planner] += 1
+                if not in_flight:
+                    # Only devices waiting to retry
+                    self.stop.wait(min(retry_at[p] for p in planners if p in retry_at) - now)
+                    continue
+
+                done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    planner, window = in_flight.pop(future)
+                    fetching[planner] -= 1
+                    try:
+                        self.complete(planner, window, future.result())
+                    except Exception as e:
+                        _logger.warning(
+                            f"Backfilling window {window} failed, retrying in {self.retry_delay} seconds: {str(e)}"
+                        )
+                        planner.retry(window)
+                        retry_at[planner] = time.monotonic() + self.retry_delay
+                    if planner.done:
+                        planners.remove(planner)
+
+        if not self.stop.is_set():
+            _logger.info("Backfilling done")
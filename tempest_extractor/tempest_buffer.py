@@ -0,0 +1,217 @@
+import logging
+import os
+import pickle
+import time
+from collections import deque
+from threading import Event, Lock
+from typing import Callable, Deque, Generic, List, Optional, TypeVar
+
+_logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+OVERFLOW_POLICIES = ("drop-oldest", "block", "spill")
+
+
+class RingBuffer(Generic[T]):
+    """
+    Bounded buffer between one producer thread and one consumer thread, with drain-all semantics.
+
+    The hot path is lock free: items go through a deque, whose append and popleft are atomic, and every counter is
+    only ever written by one of the two threads. Capacity is counted in the size of the items, e.g. rows, not in the
+    number of items. When the buffer is full, the overflow policy decides what happens:
+
+    * drop-oldest: the oldest items are dropped to make room, and counted in dropped
+    * block: the producer waits until the consumer has drained the buffer
+    * spill: new items are written to files in spill_path until the consumer has drained them, so nothing is lost
+      and ordering is kept
+
+    Args:
+        capacity: Maximum total size of the items held in memory
+        overflow: Overflow policy, one of drop-oldest, block or spill
+        size: Function giving the size of an item
+        spill_path: Directory to spill items to, used by the spill policy
+        block_timeout: How long the producer waits for room at a time under the block policy, before checking again
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        overflow: str = "drop-oldest",
+        size: Callable[[T], int] = lambda _: 1,
+        spill_path: Optional[str] = None,
+        block_timeout: float = 1.0,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}, must be one of {', '.join(OVERFLOW_POLICIES)}")
+        if overflow == "spill" and not spill_path:
+            raise ValueError("The spill overflow policy needs a spill path")
+        self.capacity = capacity
+        self.overflow = overflow
+        self.size = size
+        self.block_timeout = block_timeout
+
+        self._items: Deque[T] = deque()
+        self._drained = Event()
+        self._available = Event()
+
+        # Written by the producer only
+        self._put = 0
+        self._dropped = 0
+        self._spilled = 0
+        self._overflowing = False
+        # Written by the consumer only
+        self._taken = 0
+        self._unspilled = 0
+
+        self._spill = _SpillFiles(spill_path) if overflow == "spill" else None
+
+    @property
+    def depth(self) -> int:
+        """
+        Total size of the items currently held in memory.
+        """
+        return self._put - self._taken - self._dropped
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def spilled(self) -> int:
+        """
+        Total size of the items currently spilled to disk.
+        """
+        return self._spilled - self._unspilled
+
+    def put(self, item: T) -> None:
+        """
+        Add an item to the buffer. Must only be called from the producer thread.
+        """
+        item_size = self.size(item)
+
+        if self._spill is not None and self._spill.active:
+            # Keep ordering: while anything is spilled, everything newer goes to the spill files as well
+            self._spill.write(item)
+            self._spilled += item_size
+            self._available.set()
+            return
+
+        if self.depth + item_size > self.capacity:
+            if self.overflow == "drop-oldest":
+                while self._items and self.depth + item_size > self.capacity:
+                    try:
+                        dropped = self._items.popleft()
+                    except IndexError:
+                        # The consumer drained the buffer in the meantime
+                        break
+                    self._dropped += self.size(dropped)
+                if not self._overflowing:
+                    _logger.warning(
+                        f"Buffer full at capacity {self.capacity}, dropping oldest items ({self._dropped} dropped so far)"
+                    )
+                    self._overflowing = True
+            elif self.overflow == "block":
+                while self._items and self.depth + item_size > self.capacity:
+                    self._drained.clear()
+                    self._drained.wait(self.block_timeout)
+            else:
+                self._spill.write(item)
+                self._spilled += item_size
+                self._available.set()
+                return
+        else:
+            self._overflowing = False
+
+        self._items.append(item)
+        self._put += item_size
+        self._available.set()
+
+    def wait(self, min_size: int, timeout: float) -> bool:
+        """
+        Wait until the buffer holds items of at least min_size in total, in memory or spilled, or until the timeout
+        has passed. Must only be called from the consumer thread.
+
+        Returns:
+            True if the buffer holds at least min_size
+        """
+        deadline = time.monotonic() + timeout
+        while self.depth + self.spilled < min_size:
+            self._available.clear()
+            # Check again after clearing, in case the producer put an item in between
+            if self.depth + self.spilled >= min_size:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._available.wait(remaining)
+        return True
+
+    def drain(self) -> List[T]:
+        """
+        Take all items out of the buffer, oldest first. Must only be called from the consumer thread.
+        """
+        items = []
+        taken = 0
+        while True:
+            try:
+                item = self._items.popleft()
+            except IndexError:
+                break
+            items.append(item)
+            taken += self.size(item)
+        self._taken += taken
+
+        if self._spill is not None:
+            spilled = self._spill.read_all()
+            self._unspilled += sum(self.size(item) for item in spilled)
+            items.extend(spilled)
+
+        self._drained.set()
+        return items
+
+
+class _SpillFiles:
+    """
+    Spill files for a ring buffer. The producer appends pickled items to the current file, the consumer rotates the
+    current file out and reads everything spilled so far. The lock is only taken on this slow path.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.active = False
+        self._lock = Lock()
+        self._sequence = 0
+        self._file = None
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            # Items spilled before a crash or restart are lost with the in-memory buffer, start clean
+            if name.endswith(".spill"):
+                os.remove(os.path.join(path, name))
+
+    def write(self, item: object) -> None:
+        with self._lock:
+            if self._file is None:
+                self._file = open(os.path.join(self.path, f"{self._sequence:08d}.spill"), "wb")
+                self._sequence += 1
+            pickle.dump(item, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.active = True
+
+    def read_all(self) -> List:
+        with self._lock:
+            if self._file is None:
+                return []
+            spill_file = self._file
+            spill_file.close()
+            self._file = None
+            self.active = False
+
+        items = []
+        with open(spill_file.name, "rb") as f:
+            while True:
+                try:
+                    items.append(pickle.load(f))
+                except EOFError:
+                    break
+        os.remove(spill_file.name)
+        return items
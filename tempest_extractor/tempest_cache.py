@@ -0,0 +1,107 @@
+import gzip
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Optional
+
+from tempest_extractor.tempest_decoding import dumps, loads
+
+_logger = logging.getLogger(__name__)
+
+
+class HistoricalCache:
+    """
+    On-disk cache of historical REST responses, one gzip compressed file per device and window. Windows are aligned to
+    a fixed grid so that different requests share them, and only windows fully in the past are stored, as their content
+    never changes. The least recently used files are evicted when the total size goes above max_size. Each file holds
+    the full response, including the message type.
+
+    Args:
+        path: Directory to keep the cache in
+        max_size: Maximum total size of the cache files, in bytes
+        window: Size of the cached windows in seconds
+        closed_after: Seconds after its end before a window is considered closed, to allow for late data from hubs
+    """
+
+    def __init__(self, path: str, max_size: int, window: int = 24 * 60 * 60, closed_after: int = 60 * 60):
+        self.path = path
+        self.max_size = max_size
+        self.window = window
+        self.closed_after = closed_after
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+
+        os.makedirs(path, exist_ok=True)
+        entries = []
+        for name in os.listdir(path):
+            if name.endswith(".json.gz"):
+                stat = os.stat(os.path.join(path, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._size += size
+        _logger.info(f"Historical cache has {len(self._files)} windows, {self._size // 1024} KiB")
+
+    def _name(self, device_id: str, time_start: int, time_end: int) -> str:
+        return f"{device_id}-{time_start}-{time_end}.json.gz"
+
+    def get(self, device_id: str, time_start: int, time_end: int) -> Optional[Dict[str, Any]]:
+        """
+        Get a cached response, or None if the window is not cached.
+        """
+        name = self._name(device_id, time_start, time_end)
+        with self._lock:
+            if name not in self._files:
+                self.misses += 1
+                return None
+            self._files.move_to_end(name)
+        try:
+            with gzip.open(os.path.join(self.path, name), "rb") as f:
+                response = loads(f.read())
+            # Modification time tracks last use, so the LRU order survives restarts
+            os.utime(os.path.join(self.path, name))
+        except (OSError, ValueError) as e:
+            _logger.warning(f"Dropping unreadable cache file {name}: {str(e)}")
+            self._remove(name)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return response
+
+    def put(self, device_id: str, time_start: int, time_end: int, response: Dict[str, Any]) -> None:
+        """
+        Store the response for a window, evicting the least recently used windows if the cache is full.
+        """
+        name = self._name(device_id, time_start, time_end)
+        file_path = os.path.join(self.path, name)
+        data = gzip.compress(dumps(response), compresslevel=6)
+        # Write to a temporary file first, so a crash never leaves a truncated file behind
+        with open(f"{file_path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{file_path}.tmp", file_path)
+
+        with self._lock:
+            self._size += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            evict = []
+            while self._size > self.max_size and len(self._files) > 1:
+                oldest, size = self._files.popitem(last=False)
+                self._size -= size
+                evict.append(oldest)
+        for oldest in evict:
+            try:
+                os.remove(os.path.join(self.path, oldest))
+            except FileNotFoundError:
+                pass
+
+    def _remove(self, name: str) -> None:
+        with self._lock:
+            self._size -= self._files.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
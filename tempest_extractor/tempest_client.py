@@ -1,154 +1,263 @@
 import json
 import logging
+import sys
+from collections import Counter
 from random import randint
-from typing import Any, Dict, List
+from statistics import median
+from time import perf_counter
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import arrow
-import requests
 import websocket
 
 from tempest_extractor.config import TempestConfig
-from tempest_extractor.tempest_dataclasses import TempestObservation, TempestObsSummary, TempestStation
+from tempest_extractor.tempest_buffer import RingBuffer
+from tempest_extractor.tempest_cache import HistoricalCache
+from tempest_extractor.tempest_dataclasses import TempestObservationBatch, TempestObsSummary, TempestStation
+from tempest_extractor.tempest_decoding import loads, record_decoder
+from tempest_extractor.tempest_http import TempestHttpClient
+from tempest_extractor.tempest_metrics import FRAME_PARSE_SECONDS, FRAMES_RECEIVED
+from tempest_extractor.tempest_parsers import PARSERS, get_parser
+from tempest_extractor.tempest_replay import FrameRecorder
 
 _logger = logging.getLogger(__name__)
 
+# Built once, building a schema through dataclasses_json is expensive. Summaries arrive with every observation and
+# are flat, so they skip marshmallow altogether.
+_STATION_SCHEMA = TempestStation.schema()
+_decode_summary = record_decoder(TempestObsSummary)
+
+# Observation types the REST API has history of, as opposed to rapid wind and events
+HISTORICAL_TYPES = {o_type for o_type, parser in PARSERS.items() if not parser.single_row}
+
+
+def _missing_runs(responses: List[Optional[Dict[str, Any]]]) -> List[Tuple[int, int]]:
+    """
+    Runs of consecutive responses that are None, as (first, last) index ranges.
+    """
+    runs: List[Tuple[int, int]] = []
+    for index, response in enumerate(responses):
+        if response is None:
+            if runs and runs[-1][1] == index:
+                runs[-1] = (runs[-1][0], index + 1)
+            else:
+                runs.append((index, index + 1))
+    return runs
+
+
+class CollectedFrame(NamedTuple):
+    device_id: str
+    observations: TempestObservationBatch
+    summary: Optional[TempestObsSummary]
+
+    def size(self) -> int:
+        return len(self.observations) + (1 if self.summary is not None else 0)
+
 
 class TempestCollector:
-    def __init__(self, config: TempestConfig):
+    """
+    Collects observations from all configured Tempest devices over one shared websocket, and fetches station and
+    historical data from the Tempest REST API. Parsed frames are handed from the websocket thread to the consumer
+    through a bounded buffer.
+
+    Args:
+        config: Tempest configuration, including the list of devices to listen to
+        buffer: Buffer for parsed frames, defaults to an unbounded buffer dropping nothing
+        pool_size: Number of connections to keep open to the REST API, should match the number of concurrent fetches
+        cache: Cache for closed historical windows, if any
+    """
+
+    def __init__(
+        self,
+        config: TempestConfig,
+        buffer: Optional[RingBuffer[CollectedFrame]] = None,
+        pool_size: int = 10,
+        cache: Optional[HistoricalCache] = None,
+    ):
         self.config = config
-        self.observations: List[TempestObservation] = []
-        self.summaries: List[TempestObsSummary] = []
+        self.cache = cache
+        self.devices = {d.device_id: d for d in config.get_devices()}
+        self.buffer = buffer or RingBuffer(capacity=sys.maxsize, size=CollectedFrame.size)
+        self.http = TempestHttpClient(
+            config.rest_url,
+            config.token,
+            pool_size=pool_size,
+            timeout=config.timeout,
+            max_retries=config.max_retries,
+        )
+        self._stations: Optional[List[TempestStation]] = None
+        self.unknown_types: Counter = Counter()
+        # Set to a FrameRecorder to record raw websocket frames
+        self.recorder: Optional[FrameRecorder] = None
+        self._frame_counters: Dict[Optional[str], Any] = {}
+        self._wsapp: Optional[websocket.WebSocketApp] = None
+        # Newest and first epoch received per device and message type, overall and since the websocket connected
+        self.last_epochs: Dict[Tuple[str, str], int] = {}
+        self._resumed_epochs: Dict[Tuple[str, str], int] = {}
+        # Seconds between the last two observations per device, of a type the REST API has history of
+        self._report_intervals: Dict[str, int] = {}
+        # Set to a function taking a device ID, start and end epoch, to fetch what was missed while disconnected
+        self.healer: Optional[Callable[[str, int, int], None]] = None
 
     def _station_from_response(self, json_response: Dict[str, Any]) -> TempestStation:
-        return TempestStation.schema().load(json_response)
+        return _STATION_SCHEMA.load(json_response)
 
     def _summary_from_response(self, json_response: Dict[str, Any]) -> TempestObsSummary:
-        s = TempestObsSummary.schema().load(json_response["summary"])
+        s = _decode_summary(json_response["summary"])
         s.epoch = json_response["obs"][0][0]
         return s
 
-    def _observations_from_response(self, json_response: Dict[str, Any]) -> List[TempestObservation]:
+    def _observations_from_response(
+        self, json_response: Dict[str, Any], batch: Optional[TempestObservationBatch] = None
+    ) -> TempestObservationBatch:
+        """
+        Parse the observations of a websocket message or REST response into a batch, appending to the given batch if
+        any. Message types without a registered parser are counted and skipped.
+        """
+        if batch is None:
+            batch = TempestObservationBatch()
         if json_response == None:
-            return []
-        obs = []
-        o_type = json_response["type"]
-        if json_response["obs"] == None:
-            return []
-        for a in json_response["obs"]:
-            if o_type == "obs_st":
-                obs.append(
-                    TempestObservation(
-                        a[0],
-                        "obs_st",
-                        a[1],
-                        a[2],
-                        a[3],
-                        a[4],
-                        a[5],
-                        a[6],
-                        a[7],
-                        a[8],
-                        a[9],
-                        a[10],
-                        a[11],
-                        a[12],
-                        a[13],
-                        a[14],
-                        a[15],
-                        a[16],
-                        a[17],
-                        a[18],
-                        a[19],
-                        a[20],
-                        a[21],
-                    )
-                )
-            elif o_type == "obs_sky":
-                obs.append(
-                    TempestObservation(
-                        a[0],
-                        "obs_sky",
-                        a[4],
-                        a[5],
-                        a[6],
-                        a[7],
-                        a[13],
-                        None,
-                        None,
-                        None,
-                        a[1],
-                        a[2],
-                        a[10],
-                        a[3],
-                        a[12],
-                        None,
-                        None,
-                        a[8],
-                        a[9],
-                        a[15],
-                        a[14],
-                        None,
-                        None,
-                        a[16],
-                    )
-                )
-            elif o_type == "rapid_wind":
-                obs.append(TempestObservation(a[0], "rapid_wind", None, None, a[1], a[2]))
-            elif o_type == "obs_air":
-                obs.append(
-                    TempestObservation(
-                        a[0],
-                        "obs_air",
-                        None,
-                        None,
-                        None,
-                        None,
-                        None,
-                        a[1],
-                        a[2],
-                        a[3],
-                        None,
-                        None,
-                        None,
-                        None,
-                        None,
-                        a[5],
-                        a[4],
-                        a[6],
-                        a[7],
-                    )
-                )
-            else:
-                raise ("Unknown Tempest observation type")
-        return obs
+            return batch
+        o_type = json_response.get("type")
+        parser = get_parser(o_type)
+        if parser is None:
+            if self.unknown_types[o_type] == 0:
+                _logger.warning(f"Skipping unknown Tempest observation type {o_type}")
+            self.unknown_types[o_type] += 1
+            return batch
+        parser.parse(json_response, batch)
+        return batch
 
-    def get_station(self):
-        response = requests.get("https://swd.weatherflow.com/swd/rest/stations", {"token": self.config.token})
-        response.raise_for_status()
-        return self._station_from_response(response.json()["stations"][0])
+    def get_stations(self) -> List[TempestStation]:
+        # All stations share the same token, so one request covers the whole fleet
+        if self._stations is None:
+            response = self.http.get("stations")
+            self._stations = [self._station_from_response(s) for s in response["stations"]]
+        return self._stations
 
-    def get_historical(self, days: int = 0, time_start: int = 0, time_end: int = 0) -> List[TempestObservation]:
+    def get_station(self, device_id: Optional[str] = None) -> TempestStation:
+        stations = self.get_stations()
+        if device_id is None:
+            return stations[0]
+        for station in stations:
+            if any(str(d.device_id) == device_id for d in station.devices):
+                return station
+        raise ValueError(f"Device {device_id} not found in any station available to the token")
+
+    def get_historical(
+        self, device_id: str, days: int = 0, time_start: int = 0, time_end: int = 0
+    ) -> TempestObservationBatch:
         if days > 0 and time_start == 0 and time_end == 0:
             time_end = arrow.utcnow().int_timestamp
             time_start = time_end - (days * (60 * 60 * 24))
-        response = requests.get(
-            f"https://swd.weatherflow.com/swd/rest/observations/",
+        pieces = self._historical_pieces(time_start, time_end)
+        responses = [self.cache.get(device_id, start, end) if cacheable else None for start, end, cacheable in pieces]
+        for first, last in _missing_runs(responses):
+            responses[first:last] = self._fetch_pieces(device_id, pieces[first:last])
+        batch = TempestObservationBatch()
+        for (start, end, cacheable), response in zip(pieces, responses):
+            self._add_historical(response, start, end, cacheable, time_start, time_end, batch)
+        return batch
+
+    def _fetch_pieces(self, device_id: str, pieces: List[Tuple[int, int, bool]]) -> List[Dict[str, Any]]:
+        """
+        Fetch consecutive pieces missing from the cache as one range, and cache the cacheable ones.
+        """
+        merged = self._fetch_historical(device_id, pieces[0][0], pieces[-1][1])
+        if len(pieces) == 1 or self._full_resolution(merged):
+            responses = self._split_historical(merged, pieces)
+        else:
+            # The API answers long ranges at a coarser resolution, which must not be cached as the windows
+            responses = [self._fetch_historical(device_id, start, end) for start, end, _ in pieces]
+        self._cache_pieces(device_id, pieces, responses)
+        return responses
+
+    def _cache_pieces(
+        self, device_id: str, pieces: List[Tuple[int, int, bool]], responses: List[Dict[str, Any]]
+    ) -> None:
+        for (start, end, cacheable), response in zip(pieces, responses):
+            if cacheable:
+                self.cache.put(device_id, start, end, response)
+
+    def _historical_pieces(self, time_start: int, time_end: int) -> List[Tuple[int, int, bool]]:
+        """
+        Split a historical range into the pieces to fetch, as (start, end, cacheable). With a cache, closed windows on
+        the cache grid are cacheable, and only the open tail is not. Pieces are half open, except the last one, which
+        ends at time_end.
+        """
+        if self.cache is None:
+            return [(time_start, time_end, False)]
+        pieces = []
+        closed_before = arrow.utcnow().int_timestamp - self.cache.closed_after
+        start = time_start - time_start % self.cache.window
+        while True:
+            end = start + self.cache.window
+            if end > closed_before:
+                pieces.append((max(start, time_start), time_end, False))
+                break
+            pieces.append((start, end, True))
+            if end >= time_end:
+                break
+            start = end
+        return pieces
+
+    def _split_historical(self, response: Dict[str, Any], pieces: List[Tuple[int, int, bool]]) -> List[Dict[str, Any]]:
+        """
+        Split the response to a range fetched at once into the responses to its pieces, as if each had been fetched.
+        """
+        if len(pieces) == 1:
+            return [response]
+        rows = response.get("obs") or []
+        return [{**response, "obs": [r for r in rows if start <= r[0] <= end]} for start, end, _ in pieces]
+
+    def _full_resolution(self, response: Dict[str, Any]) -> bool:
+        """
+        Whether a response is at the resolution of the report interval of the device, as far as it tells.
+        """
+        batch = self._observations_from_response(response)
+        epochs = sorted(set(batch.epochs))
+        intervals = [v for _, v in batch.datapoints("report_interval") if v]
+        if len(epochs) < 2 or not intervals:
+            return True
+        # Reported in minutes
+        return min(b - a for a, b in zip(epochs, epochs[1:])) <= 1.5 * median(intervals) * 60
+
+    def _add_historical(
+        self,
+        response: Dict[str, Any],
+        start: int,
+        end: int,
+        cacheable: bool,
+        time_start: int,
+        time_end: int,
+        batch: TempestObservationBatch,
+    ) -> None:
+        if cacheable and response.get("obs"):
+            # Cached windows are clipped to the requested range. Windows are half open, except where the requested
+            # range ends, so rows on the boundaries are not repeated.
+            lower, upper = max(start, time_start), min(end, time_end)
+            rows = [r for r in response["obs"] if lower <= r[0] < upper or r[0] == time_end]
+            response = {**response, "obs": rows}
+        self._observations_from_response(response, batch)
+
+    def _fetch_historical(self, device_id: str, time_start: int, time_end: int) -> Dict[str, Any]:
+        return self.http.get(
+            "observations/",
             {
-                "device_id": self.config.device_id,
-                "token": self.config.token,
+                "device_id": device_id,
                 "time_start": time_start,
                 "time_end": time_end,
             },
         )
-        response.raise_for_status()
-        return self._observations_from_response(response.json())
 
-    # Helper function to convert a list of observations or summaries to a set of data elements
+    # Helper function to convert a batch of observations or a list of summaries to a set of data elements
     def datapoints_per_element(
-        self, elements: List[str], observations: List[TempestObservation | TempestObsSummary]
-    ) -> List[Any]:
+        self, elements: List[str], observations: TempestObservationBatch | List[TempestObsSummary]
+    ) -> Dict[str, List[Any]]:
         if len(observations) == 0:
             return {}
+        if isinstance(observations, TempestObservationBatch):
+            return {element: observations.datapoints(element) for element in elements}
         data = {}
         for element in elements:
             data[element] = []
@@ -162,45 +271,129 @@ class TempestCollector:
                         data[element].append((obs.epoch * 1000, getattr(obs, element)))
         return data
 
-    # Retrieve summaries and reset queue
-    def get_summaries(self):
-        s = self.summaries
-        self.summaries = []
-        return s
+    # Drain the buffer, returning observations and summaries per device
+    def get_collected(self) -> Tuple[Dict[str, TempestObservationBatch], Dict[str, List[TempestObsSummary]]]:
+        observations: Dict[str, TempestObservationBatch] = {}
+        summaries: Dict[str, List[TempestObsSummary]] = {}
+        for frame in self.buffer.drain():
+            if len(frame.observations) > 0:
+                if frame.device_id in observations:
+                    observations[frame.device_id].extend(frame.observations)
+                else:
+                    observations[frame.device_id] = frame.observations
+            if frame.summary is not None:
+                summaries.setdefault(frame.device_id, []).append(frame.summary)
+        return observations, summaries
+
+    def _listen_messages(self) -> List[str]:
+        # One listen_start per device, and listen_rapid_start if configured, all multiplexed over the same websocket
+        self.ws_id = randint(100000000, 999999999)
+        types = ["listen_start", "listen_rapid_start"] if self.config.rapid_wind else ["listen_start"]
+        return [
+            json.dumps({"type": o_type, "device_id": device_id, "id": f"{self.ws_id}"})
+            for device_id in self.devices
+            for o_type in types
+        ]
+
+    def last_epoch(self, device_id: str) -> Optional[int]:
+        """
+        Epoch of the newest observation received from a device of a type the REST API has history of, if any.
+        """
+        epochs = [self.last_epochs.get((device_id, o_type)) for o_type in HISTORICAL_TYPES]
+        return max((epoch for epoch in epochs if epoch is not None), default=None)
 
-    # Retrieve observations and reset queue
-    def get_observations(self):
-        o = self.observations
-        self.observations = []
-        return o
+    def resumed_epoch(self, device_id: str) -> Optional[int]:
+        """
+        Epoch of the first observation received from a device since the websocket last connected, of a type the REST
+        API has history of, if any.
+        """
+        epochs = [self._resumed_epochs.get((device_id, o_type)) for o_type in HISTORICAL_TYPES]
+        return min((epoch for epoch in epochs if epoch is not None), default=None)
+
+    def connected(self) -> None:
+        """
+        Call when the websocket has connected, before listening. Devices that were heard from before, but not since
+        their report interval or heal_after seconds, whichever is shorter, are handed to the healer with the interval
+        since their last observation. So a blip shorter than heal_after still heals the observation it missed.
+        """
+        self._resumed_epochs.clear()
+        if self.healer is None or self.config.heal_after <= 0:
+            return
+        now = arrow.utcnow().int_timestamp
+        for device_id in self.devices:
+            last = self.last_epoch(device_id)
+            after = min(self.config.heal_after, self._report_intervals.get(device_id, self.config.heal_after))
+            if last is not None and now - last > after:
+                _logger.info(f"Device {device_id} was not heard from for {now - last} seconds, healing the gap")
+                self.healer(device_id, last + 1, now)
 
     def _on_open(self, wsapp):
-        self.ws_id = randint(100000000, 999999999)
-        msg = {"type": "listen_start", "device_id": f"{self.config.device_id}", "id": f"{self.ws_id}"}
-        wsapp.send(json.dumps(msg))
+        self.connected()
+        for msg in self._listen_messages():
+            wsapp.send(msg)
+        _logger.info(f"Listening to {len(self.devices)} devices")
 
     def _on_message(self, wsapp, message):
-        obs = json.loads(message)
-        _logger.debug("Websocket message:" + json.dumps(obs, indent=2))
-        if "obs" in obs and "type" in obs:
-            resp_obs = self._observations_from_response(obs)
-            for o in resp_obs:
-                self.observations.append(o)
-            _logger.info(f"Collector has {len(self.observations)+1} observations")
-            if "summary" in obs:
-                self.summaries.append(self._summary_from_response(obs))
-                _logger.info(f"Collector has {len(self.summaries)+1} summaries")
+        started = perf_counter()
+        if self.recorder is not None:
+            self.recorder.record(message)
+        obs = loads(message)
+        # Formatted lazily, only if debug logging is on
+        _logger.debug("Websocket message: %s", message)
+        self.collect(obs, started)
+
+    def collect(self, obs: Dict[str, Any], started: float) -> None:
+        """
+        Parse a decoded message from a configured device and put it in the buffer. Messages without observations, like
+        acknowledgements and status messages, are only counted.
+
+        Args:
+            obs: Decoded message, with the device_id of the device it is from
+            started: perf_counter() value when the message was received, to measure parse time from
+        """
+        o_type = obs.get("type")
+        counter = self._frame_counters.get(o_type)
+        if counter is None:
+            counter = self._frame_counters[o_type] = FRAMES_RECEIVED.labels(str(o_type))
+        counter.inc()
+        if "type" in obs and ("obs" in obs or obs["type"] in PARSERS):
+            device_id = str(obs.get("device_id"))
+            if device_id not in self.devices:
+                _logger.debug("Ignoring message for unknown device %s", device_id)
+                return
+            frame = CollectedFrame(
+                device_id,
+                self._observations_from_response(obs),
+                self._summary_from_response(obs) if "summary" in obs else None,
+            )
+            FRAME_PARSE_SECONDS.observe(perf_counter() - started)
+            if len(frame.observations) > 0:
+                key = (device_id, o_type)
+                newest = max(frame.observations.epochs)
+                previous = self.last_epochs.get(key)
+                if previous is not None and newest > previous and o_type in HISTORICAL_TYPES:
+                    self._report_intervals[device_id] = newest - previous
+                self.last_epochs[key] = max(previous or 0, newest)
+                self._resumed_epochs.setdefault(key, min(frame.observations.epochs))
+            self.buffer.put(frame)
+            _logger.debug("Collector buffer has %d observations and summaries", self.buffer.depth)
 
     def run(self):
         # websocket.enableTrace(True)
-        station = self.get_station()
-        wsapp = websocket.WebSocketApp(
+        self._wsapp = websocket.WebSocketApp(
             "wss://ws.weatherflow.com/swd/data?token=" + self.config.token,
             on_message=self._on_message,
             on_open=self._on_open,
         )
-        wsapp.run_forever(
+        self._wsapp.run_forever(
             ping_interval=5,
             reconnect=5,
             ping_payload="ping",
         )
+
+    def close(self) -> None:
+        """
+        Close the websocket, making run() return.
+        """
+        if self._wsapp is not None:
+            self._wsapp.close()
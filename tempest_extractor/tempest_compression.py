@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from tempest_extractor.config import YamlConfig
+from tempest_extractor.tempest_dataclasses import TempestObservation, TempestObsSummary
+from tempest_extractor.tempest_metrics import DATAPOINTS_FILTERED
+from tempest_extractor.tempest_pipeline import UploadStage
+from tempest_extractor.tempest_rolling import STATISTICS
+
+_logger = logging.getLogger(__name__)
+
+_filtered = DATAPOINTS_FILTERED.labels("compression")
+
+MODES = ("deadband", "swinging-door")
+
+
+class _Series:
+    """
+    Compression state of one time series. The last stored point, the last received point and, for swinging door, the
+    slopes of the door opened from the last stored point.
+    """
+
+    __slots__ = ("stored", "last", "upper", "lower")
+
+    def __init__(self, state: Optional[List[Any]] = None):
+        self.stored: Optional[Tuple[int, Any]] = None
+        self.last: Optional[Tuple[int, Any]] = None
+        self.upper = float("inf")
+        self.lower = float("-inf")
+        if state:
+            stored, last, self.upper, self.lower = state
+            self.stored = tuple(stored) if stored else None
+            self.last = tuple(last) if last else None
+
+    def dump(self) -> List[Any]:
+        return [self.stored, self.last, self.upper, self.lower]
+
+
+class CompressionStage(UploadStage):
+    """
+    Only store data points that carry information, for elements configured in config.compression.
+
+    In deadband mode a point is stored when it differs from the last stored point by more than the tolerance. In
+    swinging door mode a point is stored when the points received since the last stored one can no longer be
+    interpolated from it within the tolerance; the last point inside the door is then stored. Tolerances are absolute,
+    or relative to the last stored value. String elements, like pressure_trend, are stored when they change, and cannot
+    have a rule. A point is always stored if max_interval seconds have passed since the last stored one, after storing
+    the point where a swinging door closed, if any.
+
+    Points older than the last one received for a time series, like backfilled data, are passed on unchanged. The
+    state is saved to a file regularly and on close, so compression continues where it left off after a restart.
+
+    Args:
+        next_stage: Upload queue or stage to hand data points on to
+        config: Set of configuration parameters
+    """
+
+    def __init__(self, next_stage: Any, config: YamlConfig):
+        super().__init__(next_stage)
+        compression = config.compression
+        self.path = compression.state_path
+        self.max_interval = compression.max_interval * 1000
+        self.save_interval = compression.save_interval
+
+        known = set(TempestObservation.get_elements()) | set(TempestObsSummary.get_elements()) | set(STATISTICS)
+        for element in compression.elements:
+            if element not in known:
+                raise ValueError(f"Unknown element {element} to compress")
+            if TempestObservation.is_string(element) or TempestObsSummary.is_string(element):
+                raise ValueError(f"Element {element} is a string, and is always compressed on change")
+
+        # (mode, tolerance, relative) per external ID, mode is None for strings, compressed on change
+        self._rules: Dict[str, Tuple[Optional[str], float, bool]] = {}
+        for device in config.tempest.get_devices():
+            for element in config.tempest.elements + config.tempest.summaries:
+                if TempestObservation.is_string(element) or TempestObsSummary.is_string(element):
+                    self._rules[config.external_id(device.device_id, element)] = (None, 0, False)
+            for element, rule in compression.elements.items():
+                if rule.mode not in MODES:
+                    raise ValueError(
+                        f"Unknown compression mode {rule.mode} for {element}, use one of {', '.join(MODES)}"
+                    )
+                self._rules[config.external_id(device.device_id, element)] = (rule.mode, rule.tolerance, rule.relative)
+
+        self._series: Dict[str, _Series] = {}
+        self._lock = Lock()
+        # Saves may be triggered from several threads, and write the same temporary file
+        self._save_lock = Lock()
+        self._saved = time.monotonic()
+        self.received = 0
+        self.stored = 0
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                states = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            _logger.warning(f"Ignoring unreadable compression state {self.path}: {str(e)}")
+            return
+        self._series = {
+            external_id: _Series(state) for external_id, state in states.items() if external_id in self._rules
+        }
+        _logger.info(f"Loaded compression state for {len(self._series)} time series")
+
+    def save(self) -> None:
+        """
+        Save the compression state, atomically.
+        """
+        with self._save_lock:
+            with self._lock:
+                states = {external_id: series.dump() for external_id, series in self._series.items()}
+                self._saved = time.monotonic()
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(states, f)
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def close(self) -> None:
+        self.save()
+        _logger.info(f"Compression stored {self.stored} of {self.received} data points, ratio {self.ratio() or 0:.1f}")
+
+    def ratio(self) -> Optional[float]:
+        """
+        Points received per point stored, or None before anything is stored.
+        """
+        return self.received / self.stored if self.stored else None
+
+    def _tolerance(self, series: _Series, tolerance: float, relative: bool) -> float:
+        return tolerance * abs(series.stored[1]) if relative else tolerance
+
+    def _deadband(self, series: _Series, timestamp: int, value: Any, tolerance: float, relative: bool) -> bool:
+        return abs(value - series.stored[1]) > self._tolerance(series, tolerance, relative)
+
+    def _swinging_door(self, series: _Series, timestamp: int, value: Any, tolerance: float, relative: bool) -> List:
+        """
+        Narrow the door with a new point, returning the points to store.
+        """
+        stored_time, stored_value = series.stored
+        width = self._tolerance(series, tolerance, relative)
+        elapsed = timestamp - stored_time
+        upper = min(series.upper, (value + width - stored_value) / elapsed)
+        lower = max(series.lower, (value - width - stored_value) / elapsed)
+        if lower <= upper:
+            series.upper, series.lower = upper, lower
+            return []
+
+        # The door closed, store the last point inside it and open a new door from there
+        series.stored = series.last
+        stored_time, stored_value = series.stored
+        width = self._tolerance(series, tolerance, relative)
+        elapsed = timestamp - stored_time
+        series.upper = (value + width - stored_value) / elapsed
+        series.lower = (value - width - stored_value) / elapsed
+        return [series.stored]
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        rule = self._rules.get(external_id)
+        if rule is None:
+            self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=datapoints)
+            return
+        mode, tolerance, relative = rule
+
+        keep = []
+        with self._lock:
+            series = self._series.get(external_id)
+            if series is None:
+                series = self._series[external_id] = _Series()
+            for datapoint in datapoints:
+                timestamp, value = datapoint
+                if series.last is not None and timestamp <= series.last[0]:
+                    keep.append(datapoint)
+                    continue
+
+                if series.stored is None:
+                    store = True
+                else:
+                    store = timestamp - series.stored[0] >= self.max_interval
+                    if mode is None:
+                        store = store or value != series.stored[1]
+                    elif mode == "deadband":
+                        store = store or self._deadband(series, timestamp, value, tolerance, relative)
+                    else:
+                        # Checked even when the point is stored anyway, so the point where the door closed is not
+                        # lost to max_interval
+                        keep.extend(self._swinging_door(series, timestamp, value, tolerance, relative))
+
+                if store:
+                    keep.append(datapoint)
+                    series.stored = datapoint
+                    series.upper, series.lower = float("inf"), float("-inf")
+                series.last = datapoint
+
+            self.received += len(datapoints)
+            self.stored += len(keep)
+            save = time.monotonic() - self._saved > self.save_interval
+
+        _filtered.inc(len(datapoints) - len(keep))
+        if keep:
+            self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=keep)
+        if save:
+            self.save()
@@ -0,0 +1,147 @@
+import bisect
+import json
+import logging
+import os
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Tuple
+
+from tempest_extractor.config import YamlConfig
+from tempest_extractor.tempest_dataclasses import TempestObservation
+from tempest_extractor.tempest_parsers import PARSERS
+
+_logger = logging.getLogger(__name__)
+
+
+def coverage_elements(config: YamlConfig) -> List[str]:
+    """
+    Elements whose data points show that a device was reporting: numeric elements of the periodic observations that are
+    stored as received. Events are sparse, compressed elements skip data points, and string elements are only stored
+    when they change.
+    """
+    periodic = {element for parser in PARSERS.values() if not parser.single_row for element in parser.elements}
+    compressed = set(config.compression.elements) if config.compression else set()
+    return [
+        element
+        for element in config.tempest.elements
+        if element in periodic and element not in compressed and TempestObservation.is_string(element) is False
+    ]
+
+
+class CoverageIndex:
+    """
+    Persistent index of the time ranges each device has data for in CDF, as sorted lists of [start, end] intervals in
+    epoch seconds. Data points less than max_spacing seconds apart are merged into one interval, so the index stays
+    small, and the holes between intervals are the gaps in the data.
+
+    Args:
+        path: File to keep the index in
+        max_spacing: Seconds between data points before there is a gap between them
+    """
+
+    def __init__(self, path: str, max_spacing: int):
+        self.path = path
+        self.max_spacing = max_spacing
+        self._lock = Lock()
+        self._changed = False
+        self._intervals: Dict[str, List[List[int]]] = {}
+        try:
+            with open(path) as f:
+                self._intervals = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            _logger.warning(f"Ignoring unreadable coverage index {path}: {str(e)}")
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self._intervals
+
+    def intervals(self, device_id: str) -> List[Tuple[int, int]]:
+        with self._lock:
+            return [(start, end) for start, end in self._intervals.get(device_id, [])]
+
+    def _add(self, device_id: str, start: int, end: int) -> None:
+        # Called with the lock held
+        intervals = self._intervals.setdefault(device_id, [])
+        index = bisect.bisect_left(intervals, [start, end])
+        if index > 0 and intervals[index - 1][1] + self.max_spacing >= start:
+            index -= 1
+            start = min(start, intervals[index][0])
+            end = max(end, intervals[index][1])
+            del intervals[index]
+        while index < len(intervals) and intervals[index][0] - self.max_spacing <= end:
+            end = max(end, intervals[index][1])
+            del intervals[index]
+        intervals.insert(index, [start, end])
+        self._changed = True
+
+    def add(self, device_id: str, start: int, end: int) -> None:
+        """
+        Mark a time range as covered.
+        """
+        with self._lock:
+            self._add(device_id, start, end)
+
+    def seed(self, device_id: str, ranges: Iterable[Tuple[int, int]]) -> None:
+        """
+        Add a device to the index with the given covered ranges, which may be none.
+        """
+        with self._lock:
+            self._intervals.setdefault(device_id, [])
+            for start, end in ranges:
+                self._add(device_id, start, end)
+            self._changed = True
+
+    def add_timestamps(self, device_id: str, timestamps: Iterable[int]) -> None:
+        """
+        Mark the runs of data points in a set of epoch seconds as covered.
+        """
+        timestamps = sorted(timestamps)
+        if not timestamps:
+            return
+        with self._lock:
+            start = previous = timestamps[0]
+            for timestamp in timestamps[1:]:
+                if timestamp - previous > self.max_spacing:
+                    self._add(device_id, start, previous)
+                    start = timestamp
+                previous = timestamp
+            self._add(device_id, start, previous)
+
+    def add_uploaded(self, uploaded: List[Dict[str, Any]], devices: Dict[str, str]) -> None:
+        """
+        Index the data points of an upload. Call from the post upload function of the upload queue.
+
+        Args:
+            uploaded: Time series and data points uploaded, as given to the post upload function
+            devices: Device ID per external ID of the time series to index
+        """
+        timestamps: Dict[str, set] = {}
+        for item in uploaded:
+            device_id = devices.get(item.get("externalId"))
+            if device_id is not None and item["datapoints"]:
+                # CDF uses milliseconds
+                timestamps.setdefault(device_id, set()).update(datapoint[0] // 1000 for datapoint in item["datapoints"])
+        for device_id, device_timestamps in timestamps.items():
+            self.add_timestamps(device_id, device_timestamps)
+
+    def gaps(self, device_id: str, before: int, min_gap: int) -> List[Tuple[int, int]]:
+        """
+        Holes between covered intervals of a device that are at least min_gap seconds long and ended before the given
+        epoch second, newest first. Time before the first and after the last interval is not a hole.
+        """
+        intervals = self.intervals(device_id)
+        holes = [
+            (previous[1], following[0])
+            for previous, following in zip(intervals, intervals[1:])
+            if following[0] <= before and following[0] - previous[1] >= min_gap
+        ]
+        return holes[::-1]
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._changed:
+                return
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(self._intervals, f)
+            os.replace(f"{self.path}.tmp", self.path)
+            self._changed = False
@@ -1,5 +1,9 @@
+from array import array
 from dataclasses import dataclass
-from typing import List, Optional
+from functools import partial
+from itertools import compress, repeat
+from operator import is_not, mul
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from dataclasses_json import Undefined, dataclass_json
 
@@ -182,6 +186,18 @@ Observation Layout
 15 - Local Day NC Rain Accumulation (mm)
 16 - Precipitation Analysis Type (0 = none, 1 = Rain Check with user display on, 2 = Rain Check with user display off)
 
+Rapid Wind (type="rapid_wind", one row in "ob")
+Observation Layout
+0 - Epoch (seconds UTC)
+1 - Wind Speed (m/s)
+2 - Wind Direction (degrees)
+
+Lightning Strike Event (type="evt_strike", one row in "evt")
+Event Layout
+0 - Epoch (seconds UTC)
+1 - Distance (km)
+2 - Energy
+
 """
 
 
@@ -210,6 +226,11 @@ class TempestObservation:
     nc_rain_accumulation: int = None
     local_day_nc_rain_accumulation: int = None
     precipitation_analysis_type: int = 0
+    strike_distance: Optional[int] = None
+    strike_energy: Optional[int] = None
+    # Wind of the rapid_wind updates every 3 seconds, kept apart from the wind of the periodic observations
+    rapid_wind_avg: Optional[float] = None
+    rapid_wind_direction: Optional[int] = None
 
     @classmethod
     # Returns True for str, False for numeric, and None for does not exist
@@ -227,3 +248,73 @@ class TempestObservation:
         e.remove("epoch")
         e.remove("type")
         return e
+
+
+class TempestObservationBatch:
+    """
+    Column oriented batch of Tempest observations. For every element of TempestObservation, the values that are
+    present are kept densely in an array of doubles, along with a null mask with one byte per row. Rows are appended
+    as columns once per frame, and datapoints per element are produced without touching individual rows in Python.
+    """
+
+    elements: List[str] = TempestObservation.get_elements()
+
+    def __init__(self) -> None:
+        self.epochs = array("q")
+        self.values: Dict[str, array] = {e: array("d") for e in self.elements}
+        self.present: Dict[str, bytearray] = {e: bytearray() for e in self.elements}
+        self._epochs_ms: Optional[List[int]] = None
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    def extend_columns(self, epochs: Sequence[int], columns: Dict[str, Sequence[Any]]) -> None:
+        """
+        Append rows of one observation type, given as columns.
+
+        Args:
+            epochs: Epoch of each row
+            columns: Values of each row per element, with None for missing values. Elements not in the dictionary are
+                not reported by the observation type.
+        """
+        rows = len(epochs)
+        if rows == 0:
+            return
+        self.epochs.extend(epochs)
+        for element in self.elements:
+            column = columns.get(element)
+            if column is None:
+                self.present[element].extend(bytes(rows))
+            elif None not in column:
+                # Fast path for the common case of a fully populated column
+                self.present[element].extend(b"\x01" * rows)
+                self.values[element].extend(column)
+            else:
+                self.present[element].extend(map(is_not, column, repeat(None)))
+                self.values[element].extend(filter(_is_not_none, column))
+        self._epochs_ms = None
+
+    def extend(self, other: "TempestObservationBatch") -> None:
+        self.epochs.extend(other.epochs)
+        for element in self.elements:
+            self.values[element].extend(other.values[element])
+            self.present[element].extend(other.present[element])
+        self._epochs_ms = None
+
+    def epochs_ms(self) -> List[int]:
+        # Tempest uses epoch in seconds, CDF uses milliseconds. Kept as a list, as it is shared by all elements.
+        if self._epochs_ms is None:
+            self._epochs_ms = list(map(mul, self.epochs, repeat(1000)))
+        return self._epochs_ms
+
+    def datapoints(self, element: str) -> List[Tuple[int, float]]:
+        """
+        Get (timestamp in ms, value) pairs for all rows having a value for the element.
+        """
+        present = self.present[element]
+        if 0 not in present:
+            return list(zip(self.epochs_ms(), self.values[element]))
+        return list(zip(compress(self.epochs_ms(), present), self.values[element]))
+
+
+_is_not_none = partial(is_not, None)
@@ -0,0 +1,47 @@
+import json
+from dataclasses import MISSING, fields
+from typing import Any, Callable, Dict, Type, TypeVar, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+T = TypeVar("T")
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """
+    Decode JSON, with orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Encode JSON compactly as UTF-8, with orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def record_decoder(cls: Type[T]) -> Callable[[Dict[str, Any]], T]:
+    """
+    Compile a decoder that makes an instance of a flat dataclass straight from a decoded JSON object, without going
+    through a marshmallow schema. Keys that are not fields are ignored, like with Undefined.EXCLUDE, and missing
+    fields get their default, or None if they have none. Values are not converted or validated.
+    """
+    names = frozenset(field.name for field in fields(cls))
+    defaults = {field.name: None if field.default is MISSING else field.default for field in fields(cls)}
+    new = object.__new__
+
+    def decode(message: Dict[str, Any]) -> T:
+        record = new(cls)
+        record.__dict__.update(defaults)
+        record.__dict__.update({name: message[name] for name in names & message.keys()})
+        return record
+
+    return decode
@@ -1,14 +1,16 @@
 import logging
 from concurrent.futures.thread import ThreadPoolExecutor
 from threading import Event
-from typing import List
+from typing import List, Optional, Tuple
 
 import arrow
 from cognite.extractorutils.statestore import AbstractStateStore
 from cognite.extractorutils.uploader import TimeSeriesUploadQueue
 from tempest_client import TempestCollector
 
-from tempest_extractor.config import YamlConfig
+from tempest_extractor.config import TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_dataclasses import TempestObservationBatch
+from tempest_extractor.tempest_metrics import DATAPOINTS_ENQUEUED, datapoint_source
 
 _logger = logging.getLogger(__name__)
 
@@ -37,40 +39,55 @@ class Frontfiller:
         self.config = config
         self.target_iteration_time = self.config.backfill.iteration_time
         self.states = states
+        self.devices = config.tempest.get_devices()
         self.done = False
 
-    def _extract_weather_station(self) -> None:
+    def _range(self, device: TempestDeviceConfig) -> Optional[Tuple[arrow.Arrow, arrow.Arrow]]:
         """
-        Perform a query for a given weather station. Function to send to thread pool in run().
+        Get the range to frontfill for a device, from the oldest high watermark to now, or None if there is no state.
         """
         timestamps: List[float] = []
         for element in self.config.tempest.elements:
-            ts = self.states.get_state(
-                f"{self.config.cognite.external_id_prefix}{self.config.tempest.device_id}:{element}"
-            )[1]
+            ts = self.states.get_state(self.config.external_id(device.device_id, element))[1]
             if ts is not None:
                 timestamps.append(ts)
 
         if len(timestamps) == 0:
             # No state, skip
-            return
+            return None
+
+        return arrow.get(min(timestamps) / 1000), arrow.utcnow()
+
+    def _enqueue(self, device: TempestDeviceConfig, observations: TempestObservationBatch) -> None:
+        data = self.collector.datapoints_per_element(self.config.tempest.elements, observations)
+        _logger.info(f"Got {len(data)} frontfiller observations for {device.device_name}")
+        with datapoint_source("frontfiller"):
+            for element in data:
+                self.upload_queue.add_to_upload_queue(
+                    external_id=self.config.external_id(device.device_id, element),
+                    datapoints=data[element],
+                )
+                DATAPOINTS_ENQUEUED.labels("frontfiller").inc(len(data[element]))
 
-        from_time, to_time = arrow.get(min(timestamps) / 1000), arrow.utcnow()
+    def _extract_weather_station(self, device: TempestDeviceConfig) -> None:
+        """
+        Perform a query for a given weather station. Function to send to thread pool in run().
+        """
+        time_range = self._range(device)
+        if time_range is None:
+            return
+        from_time, to_time = time_range
 
         _logger.info(
-            f"Getting frontfill data for {self.config.tempest.device_name} from {from_time.isoformat()} to {to_time.isoformat()}"
+            f"Getting frontfill data for {device.device_name} from {from_time.isoformat()} to {to_time.isoformat()}"
         )
 
-        data = self.collector.datapoints_per_element(
-            self.config.tempest.elements,
-            self.collector.get_historical(time_start=from_time.int_timestamp, time_end=to_time.int_timestamp),
+        self._enqueue(
+            device,
+            self.collector.get_historical(
+                device.device_id, time_start=from_time.int_timestamp, time_end=to_time.int_timestamp
+            ),
         )
-        _logger.info(f"Got {len(data)} frontfiller observations")
-        for element in data:
-            self.upload_queue.add_to_upload_queue(
-                external_id=f"{self.config.cognite.external_id_prefix}{self.config.tempest.device_id}:{element}",
-                datapoints=data[element],
-            )
 
     def run(self) -> None:
         """
@@ -80,5 +97,7 @@ class Frontfiller:
         with ThreadPoolExecutor(
             max_workers=self.config.extractor.parallelism, thread_name_prefix="Frontfiller"
         ) as executor:
-            executor.submit(self._extract_weather_station).result()
+            futures = [executor.submit(self._extract_weather_station, device) for device in self.devices]
+            for future in futures:
+                future.result()
             _logger.info("Frontfilling done")
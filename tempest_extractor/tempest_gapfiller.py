@@ -0,0 +1,138 @@
+import logging
+from threading import Event
+from typing import Dict, List, Optional, Tuple
+
+import arrow
+from cognite.client import CogniteClient
+from cognite.extractorutils.uploader import TimeSeriesUploadQueue
+from cognite.extractorutils.util import throttled_loop
+
+from tempest_extractor.config import TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_coverage import CoverageIndex, coverage_elements
+from tempest_extractor.tempest_metrics import DATAPOINTS_ENQUEUED, datapoint_source
+
+_logger = logging.getLogger(__name__)
+
+_enqueued = DATAPOINTS_ENQUEUED.labels("gapfiller")
+
+
+class GapFiller:
+    """
+    Periodically look up holes in the data of each device in the coverage index, and fetch only those from the Tempest
+    API, in windows of at most window_hours. Holes must be at least min_gap seconds long and have ended more than
+    older_than seconds ago, so data still on its way is not fetched. Fetched ranges are marked as covered, also if the
+    API has no data for them, so a hole in the source is only fetched once.
+
+    Holes lie inside the (low, high) range of their time series in the state store, so data from the gap filler must
+    be put in a stage after the deduplication.
+
+    Devices new to the index are seeded from hourly counts of their data points in CDF, if configured.
+
+    Args:
+        upload_queue: Where to put data points
+        stop: Stopping event
+        collector: Tempest collector to use
+        config: Set of configuration parameters
+        index: Coverage index to find holes in
+        cdf: Cognite client, to seed the index from
+    """
+
+    def __init__(
+        self,
+        upload_queue: TimeSeriesUploadQueue,
+        stop: Event,
+        collector: TempestCollector,
+        config: YamlConfig,
+        index: CoverageIndex,
+        cdf: Optional[CogniteClient] = None,
+    ):
+        self.upload_queue = upload_queue
+        self.stop = stop
+        self.collector = collector
+        self.config = config
+        self.index = index
+        self.cdf = cdf
+        self.devices = config.tempest.get_devices()
+        self.filled = 0
+
+    def _seed(self) -> None:
+        gapfill = self.config.gapfill
+        devices = [device for device in self.devices if device.device_id not in self.index]
+        if not devices or not gapfill.seed or self.cdf is None:
+            return
+        end = arrow.utcnow().int_timestamp
+        start = end - gapfill.seed_days * 24 * 60 * 60
+        # An hour is covered if it has no hole longer than max_spacing, as far as a count can tell
+        expected = (3600 - gapfill.max_spacing) / gapfill.report_interval
+        elements = coverage_elements(self.config)
+        for device in devices:
+            try:
+                series = self.cdf.time_series.data.retrieve(
+                    external_id=[self.config.external_id(device.device_id, element) for element in elements],
+                    start=start * 1000,
+                    end=end * 1000,
+                    aggregates="count",
+                    granularity="1h",
+                    ignore_unknown_ids=True,
+                )
+            except Exception as e:
+                _logger.warning(f"Could not seed coverage of device {device.device_id} from CDF: {str(e)}")
+                continue
+            counts: Dict[int, int] = {}
+            for datapoints in series:
+                for timestamp, count in zip(datapoints.timestamp, datapoints.count):
+                    counts[timestamp // 1000] = max(counts.get(timestamp // 1000, 0), count)
+            hours = [(hour, hour + 3600) for hour, count in sorted(counts.items()) if count >= expected]
+            self.index.seed(device.device_id, hours)
+            _logger.info(f"Seeded coverage of device {device.device_id} with {len(hours)} hours of data in CDF")
+
+    def _windows(self, device: TempestDeviceConfig, before: int) -> List[Tuple[int, int]]:
+        window = self.config.gapfill.window_hours * 60 * 60
+        windows = []
+        for start, end in self.index.gaps(device.device_id, before, self.config.gapfill.min_gap):
+            while end > start:
+                windows.append((max(start, end - window), end))
+                end -= window
+        return windows
+
+    def _fill(self, device: TempestDeviceConfig, start: int, end: int) -> None:
+        observations = self.collector.get_historical(device.device_id, time_start=start, time_end=end)
+        data = self.collector.datapoints_per_element(self.config.tempest.elements, observations)
+        with datapoint_source("gapfiller"):
+            for element in data:
+                self.upload_queue.add_to_upload_queue(
+                    external_id=self.config.external_id(device.device_id, element),
+                    datapoints=data[element],
+                )
+                _enqueued.inc(len(data[element]))
+        self.index.add(device.device_id, start, end)
+        self.filled += 1
+        _logger.info(
+            f"Filled gap for {device.device_name} from {arrow.get(start).isoformat()} to {arrow.get(end).isoformat()} "
+            f"with {len(observations)} observations"
+        )
+
+    def _fill_round(self) -> None:
+        before = arrow.utcnow().int_timestamp - self.config.gapfill.older_than
+        windows = [(device, start, end) for device in self.devices for start, end in self._windows(device, before)]
+        if not windows:
+            return
+        _logger.info(f"Found {len(windows)} gap windows, filling up to {self.config.gapfill.max_fetches}")
+        for device, start, end in windows[: self.config.gapfill.max_fetches]:
+            if self.stop.is_set():
+                break
+            try:
+                self._fill(device, start, end)
+            except Exception as e:
+                _logger.warning(f"Filling gap for {device.device_name} failed, retrying next round: {str(e)}")
+
+    def run(self) -> None:
+        """
+        Fill gaps every interval seconds until the stop event is set.
+        """
+        self._seed()
+        for _ in throttled_loop(self.config.gapfill.interval, self.stop):
+            self._fill_round()
+            self.index.save()
+        self.index.save()
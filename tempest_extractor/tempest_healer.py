@@ -0,0 +1,86 @@
+import logging
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import arrow
+from cognite.extractorutils.uploader import TimeSeriesUploadQueue
+
+from tempest_extractor.config import YamlConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_metrics import DATAPOINTS_ENQUEUED, datapoint_source
+
+_logger = logging.getLogger(__name__)
+
+_enqueued = DATAPOINTS_ENQUEUED.labels("healer")
+
+
+class GapHealer:
+    """
+    Fetch the observations missed while the websocket was disconnected from the Tempest API, as soon as it reconnects.
+    The collector calls schedule with the interval from the last observation of a device until the reconnect, and the
+    fetch runs in the background while live data streams in again.
+
+    Fetched rows are clipped to before the first observation received since the reconnect, so they do not repeat live
+    data. By the time a fetch returns, the uploader may have moved the high watermark of a time series past the missed
+    interval with live data, so data from the healer must be put in a stage after the deduplication.
+
+    Args:
+        upload_queue: Where to put data points
+        collector: Tempest collector to use
+        config: Set of configuration parameters
+    """
+
+    def __init__(self, upload_queue: TimeSeriesUploadQueue, collector: TempestCollector, config: YamlConfig):
+        self.upload_queue = upload_queue
+        self.collector = collector
+        self.config = config
+        self.devices = {device.device_id: device for device in config.tempest.get_devices()}
+        self.healed = 0
+        self._executor = ThreadPoolExecutor(max_workers=config.extractor.parallelism, thread_name_prefix="Healer")
+
+    def schedule(self, device_id: str, start: int, end: int) -> None:
+        """
+        Fetch and enqueue the observations of a device from start to end, in epoch seconds, in the background.
+        """
+        self._executor.submit(self._heal, device_id, start, end)
+
+    def _clip(self, device_id: str, start: int, end: int, data: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+        resumed = self.collector.resumed_epoch(device_id)
+        if resumed is not None:
+            end = min(end, resumed - 1)
+        # CDF uses milliseconds
+        return {
+            element: [d for d in datapoints if start * 1000 <= d[0] <= end * 1000]
+            for element, datapoints in data.items()
+        }
+
+    def _heal(self, device_id: str, start: int, end: int) -> None:
+        device = self.devices[device_id]
+        try:
+            observations = self.collector.get_historical(device_id, time_start=start, time_end=end)
+        except Exception as e:
+            # Left to the gap filler, or the frontfiller on the next start
+            _logger.warning(f"Healing gap for {device.device_name} failed: {str(e)}")
+            return
+        data = self._clip(
+            device_id, start, end, self.collector.datapoints_per_element(self.config.tempest.elements, observations)
+        )
+        with datapoint_source("healer"):
+            for element in data:
+                if data[element]:
+                    self.upload_queue.add_to_upload_queue(
+                        external_id=self.config.external_id(device_id, element),
+                        datapoints=data[element],
+                    )
+                    _enqueued.inc(len(data[element]))
+        self.healed += 1
+        _logger.info(
+            f"Healed gap for {device.device_name} from {arrow.get(start).isoformat()} to {arrow.get(end).isoformat()} "
+            f"with {len(observations)} observations"
+        )
+
+    def close(self) -> None:
+        """
+        Cancel fetches not started yet.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,141 @@
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tempest_extractor.tempest_decoding import loads
+from tempest_extractor.tempest_metrics import REST_ERRORS, REST_REQUEST_SECONDS
+
+_logger = logging.getLogger(__name__)
+
+# Status codes that are worth retrying, anything else fails right away
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TempestApiError(Exception):
+    """
+    A failed request to the Tempest REST API. Only the path and the status code or reason are kept, the URL of the
+    request holds the API token and must not end up in logs.
+
+    Args:
+        path: Path of the request, relative to the base URL
+        status: HTTP status code of the response, if there was one
+        reason: Why there was no response, e.g. ConnectionError or Timeout
+    """
+
+    def __init__(self, path: str, status: Optional[int] = None, reason: Optional[str] = None):
+        self.path = path
+        self.status = status
+        self.reason = reason
+        super().__init__(f"Request to {path} failed with {status if status is not None else reason}")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header, given either as seconds or as an HTTP date, into seconds to wait.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, backoff_factor: float, max_backoff: float) -> float:
+    # Full jitter, to keep parallel fetchers from retrying in lockstep
+    return random.uniform(0, min(max_backoff, backoff_factor * 2**attempt))
+
+
+class TempestHttpClient:
+    """
+    HTTP client for the Tempest REST API, shared by all threads. Connections are kept alive in a pool sized to the
+    number of concurrent fetches, responses are gzip compressed, and failed requests are retried with jittered
+    exponential backoff, honoring Retry-After.
+
+    Args:
+        base_url: Base URL of the REST API
+        token: Tempest API token, sent with every request
+        pool_size: Maximum number of connections kept open to the API
+        timeout: Seconds to wait for connecting and for each read
+        max_retries: Maximum number of retries for a request
+        backoff_factor: Base delay in seconds, doubled for each retry
+        max_backoff: Maximum delay in seconds between retries
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        pool_size: int = 10,
+        timeout: float = 30,
+        max_retries: int = 5,
+        backoff_factor: float = 1,
+        max_backoff: float = 60,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate", "Accept": "application/json"})
+
+    def _backoff(self, attempt: int) -> float:
+        return backoff_delay(attempt, self.backoff_factor, self.max_backoff)
+
+    def get(self, path: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        GET a path relative to the base URL and return the decoded JSON response.
+
+        Raises:
+            TempestApiError: If the response has an error status that is not retried, or if retries are exhausted
+        """
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        params = {**(params or {}), "token": self.token}
+
+        attempt = 0
+        while True:
+            delay = self._backoff(attempt)
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+                REST_REQUEST_SECONDS.labels(path).observe(time.perf_counter() - started)
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code >= 400:
+                        REST_ERRORS.labels(str(response.status_code)).inc()
+                        raise TempestApiError(path, status=response.status_code)
+                    return loads(response.content)
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    delay = retry_after
+                error = TempestApiError(path, status=response.status_code)
+                reason = str(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # The exception message holds the full URL, including the token, so it is not passed on
+                reason = type(e).__name__
+                error = TempestApiError(path, reason=reason)
+            except requests.RequestException as e:
+                REST_ERRORS.labels(type(e).__name__).inc()
+                raise TempestApiError(path, reason=type(e).__name__) from None
+            REST_ERRORS.labels(reason).inc()
+
+            if attempt >= self.max_retries:
+                # Not chained, the original exception holds the token
+                raise error from None
+            attempt += 1
+            _logger.warning(f"Request to {path} failed ({reason}), retry {attempt} in {delay:.1f} seconds")
+            time.sleep(delay)
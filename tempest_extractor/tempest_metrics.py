@@ -0,0 +1,115 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Metrics are registered in the default Prometheus registry, like those of the extractor-utils upload queues, and are
+# pushed or served as set up in the metrics section of the config.
+
+FRAMES_RECEIVED = Counter(
+    "tempest_extractor_frames_received", "Websocket frames received, per message type", labelnames=["type"]
+)
+FRAME_PARSE_SECONDS = Histogram(
+    "tempest_extractor_frame_parse_seconds",
+    "Time to decode and parse a websocket frame",
+    buckets=(0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1),
+)
+BUFFER_DEPTH = Gauge("tempest_extractor_buffer_depth", "Observation rows and summaries between collector and streamer")
+BUFFER_DROPPED = Gauge(
+    "tempest_extractor_buffer_dropped", "Observation rows and summaries dropped by the collector buffer since start"
+)
+BUFFER_SPILLED = Gauge(
+    "tempest_extractor_buffer_spilled",
+    "Observation rows and summaries currently spilled to disk by the collector buffer",
+)
+
+DATAPOINTS_ENQUEUED = Counter(
+    "tempest_extractor_datapoints_enqueued",
+    "Data points handed to the upload pipeline, per source",
+    labelnames=["source"],
+)
+DATAPOINTS_FILTERED = Counter(
+    "tempest_extractor_datapoints_filtered",
+    "Data points removed in the upload pipeline, per stage",
+    labelnames=["stage"],
+)
+DATAPOINTS_SPILLED = Counter(
+    "tempest_extractor_datapoints_spilled", "Data points spilled to disk because the upload queue was full"
+)
+DATAPOINTS_UPLOADED = Counter(
+    "tempest_extractor_datapoints_uploaded", "Data points uploaded to CDF, per source", labelnames=["source"]
+)
+END_TO_END_LAG = Gauge(
+    "tempest_extractor_end_to_end_lag_seconds", "Seconds from the newest observation in an upload until it was uploaded"
+)
+
+REST_REQUEST_SECONDS = Histogram(
+    "tempest_extractor_rest_request_seconds",
+    "Latency of requests to the Tempest REST API, per path",
+    labelnames=["path"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REST_ERRORS = Counter(
+    "tempest_extractor_rest_errors", "Failed requests to the Tempest REST API, per reason", labelnames=["reason"]
+)
+
+BACKFILL_WINDOWS_PENDING = Gauge(
+    "tempest_extractor_backfill_windows_pending", "Backfill windows left, per device", labelnames=["device"]
+)
+BACKFILL_WINDOWS_DONE = Counter(
+    "tempest_extractor_backfill_windows_done", "Backfill windows completed, per device", labelnames=["device"]
+)
+
+# Source of the data points handed to the upload pipeline in the current thread or task, as labelled in the metrics
+_SOURCE: ContextVar[str] = ContextVar("tempest_extractor_source", default="unknown")
+
+
+@contextmanager
+def datapoint_source(source: str) -> Iterator[None]:
+    """
+    Attribute the data points handed to the upload pipeline within the block to a source.
+    """
+    token = _SOURCE.set(source)
+    try:
+        yield
+    finally:
+        _SOURCE.reset(token)
+
+
+def current_source() -> str:
+    """
+    Source of the data points handed to the upload pipeline in the current thread or task.
+    """
+    return _SOURCE.get()
+
+
+def post_upload_handler(
+    then: Callable[[List[Dict[str, Any]]], None], count_uploaded: Optional[Callable[[int], None]] = None
+) -> Callable[[List[Dict[str, Any]]], None]:
+    """
+    Wrap a post upload function of a TimeSeriesUploadQueue, counting uploaded data points and measuring the lag of the
+    newest one before calling it.
+
+    Args:
+        then: Post upload function to call
+        count_uploaded: Called with the number of data points uploaded, to count them per source. Without it they are
+            counted with an unknown source.
+    """
+    count_uploaded = count_uploaded or DATAPOINTS_UPLOADED.labels("unknown").inc
+
+    def handler(uploaded: List[Dict[str, Any]]) -> None:
+        count = 0
+        newest = 0
+        for item in uploaded:
+            datapoints = item["datapoints"]
+            count += len(datapoints)
+            if datapoints:
+                newest = max(newest, max(datapoint[0] for datapoint in datapoints))
+        count_uploaded(count)
+        if newest:
+            END_TO_END_LAG.set(time.time() - newest / 1000)
+        then(uploaded)
+
+    return handler
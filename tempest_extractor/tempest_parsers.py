@@ -0,0 +1,137 @@
+import logging
+from operator import itemgetter
+from typing import Any, Dict, List, Optional
+
+from tempest_extractor.tempest_dataclasses import TempestObservationBatch
+
+_logger = logging.getLogger(__name__)
+
+
+class ObservationParser:
+    """
+    Parser for one Tempest message type, compiled once from the raw row layout documented in tempest_dataclasses.py.
+    A frame is transposed into columns, and the columns of the reported elements are picked out with one itemgetter.
+
+    Args:
+        o_type: Message type, e.g. obs_st
+        columns: Index in the raw rows of each element reported by the message type. Index 0 is always the epoch.
+        rows_key: Key holding the rows in the message
+        single_row: True if the message holds one row instead of a list of rows, as for events
+    """
+
+    def __init__(self, o_type: str, columns: Dict[str, int], rows_key: str = "obs", single_row: bool = False):
+        unknown = set(columns) - set(TempestObservationBatch.elements)
+        if unknown:
+            raise ValueError(f"Unknown elements in layout for {o_type}: {', '.join(sorted(unknown))}")
+        self.o_type = o_type
+        self.rows_key = rows_key
+        self.single_row = single_row
+        self.elements = tuple(columns)
+        self.width = max(columns.values()) + 1
+        self._getter = itemgetter(0, *columns.values())
+
+    def parse(self, message: Dict[str, Any], batch: TempestObservationBatch) -> int:
+        """
+        Append the rows of a message to a batch.
+
+        Returns:
+            Number of rows parsed
+        """
+        rows: Optional[List[List[Any]]] = message.get(self.rows_key)
+        if not rows:
+            return 0
+        if self.single_row:
+            rows = [rows]
+        if min(map(len, rows)) < self.width:
+            # Older firmware may send shorter rows, pad them so no column is cut off by the transpose
+            rows = [r + [None] * (self.width - len(r)) for r in rows]
+        epochs, *columns = self._getter(list(zip(*rows)))
+        batch.extend_columns(epochs, dict(zip(self.elements, columns)))
+        return len(rows)
+
+
+PARSERS: Dict[str, ObservationParser] = {}
+
+
+def register_parser(parser: ObservationParser) -> None:
+    """
+    Add a parser to the registry, replacing any existing parser for the same message type.
+    """
+    PARSERS[parser.o_type] = parser
+
+
+def get_parser(o_type: str) -> Optional[ObservationParser]:
+    return PARSERS.get(o_type)
+
+
+register_parser(
+    ObservationParser(
+        "obs_st",
+        {
+            "wind_lull": 1,
+            "wind_avg": 2,
+            "wind_gust": 3,
+            "wind_direction": 4,
+            "wind_sample_interval": 5,
+            "pressure": 6,
+            "air_temperature": 7,
+            "relative_humidity": 8,
+            "lux": 9,
+            "uv_index": 10,
+            "solar_radiation": 11,
+            "rain_accumulation": 12,
+            "precipitation_type": 13,
+            "avg_strike_distance": 14,
+            "strike_count": 15,
+            "battery_volts": 16,
+            "report_interval": 17,
+            "local_day_rain_accumulation": 18,
+            "nc_rain_accumulation": 19,
+            "local_day_nc_rain_accumulation": 20,
+            "precipitation_analysis_type": 21,
+        },
+    )
+)
+register_parser(
+    ObservationParser(
+        "obs_sky",
+        {
+            "lux": 1,
+            "uv_index": 2,
+            "rain_accumulation": 3,
+            "wind_lull": 4,
+            "wind_avg": 5,
+            "wind_gust": 6,
+            "wind_direction": 7,
+            "battery_volts": 8,
+            "report_interval": 9,
+            "solar_radiation": 10,
+            "local_day_rain_accumulation": 11,
+            "precipitation_type": 12,
+            "wind_sample_interval": 13,
+            "nc_rain_accumulation": 14,
+            "local_day_nc_rain_accumulation": 15,
+            "precipitation_analysis_type": 16,
+        },
+    )
+)
+register_parser(
+    ObservationParser(
+        "obs_air",
+        {
+            "pressure": 1,
+            "air_temperature": 2,
+            "relative_humidity": 3,
+            "strike_count": 4,
+            "avg_strike_distance": 5,
+            "battery_volts": 6,
+            "report_interval": 7,
+        },
+    )
+)
+register_parser(
+    ObservationParser("rapid_wind", {"rapid_wind_avg": 1, "rapid_wind_direction": 2}, rows_key="ob", single_row=True)
+)
+register_parser(
+    ObservationParser("evt_strike", {"strike_distance": 1, "strike_energy": 2}, rows_key="evt", single_row=True)
+)
@@ -0,0 +1,123 @@
+import logging
+from collections import deque
+from threading import Lock
+from typing import Any, Deque, Dict, List
+
+from cognite.extractorutils.statestore import AbstractStateStore
+
+from tempest_extractor.tempest_metrics import DATAPOINTS_FILTERED, DATAPOINTS_UPLOADED, current_source
+
+_logger = logging.getLogger(__name__)
+
+_filtered = DATAPOINTS_FILTERED.labels("dedup")
+
+
+class UploadStage:
+    """
+    A processing stage in front of the upload queue. Stages look like a TimeSeriesUploadQueue to the streamer and the
+    fillers, and hand what they keep on to the next stage, so they can be chained in front of the real queue.
+
+    Args:
+        next_stage: Upload queue or stage to hand data points on to
+    """
+
+    def __init__(self, next_stage: Any):
+        self.next_stage = next_stage
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=datapoints)
+
+    def upload(self) -> None:
+        self.next_stage.upload()
+
+
+class DedupFilter(UploadStage):
+    """
+    Drop data points that are already in CDF, or already on their way there. A point is dropped if its timestamp is
+    inside the (low, high) range the state store has for the time series, or if it is among the most recent timestamps
+    seen for it, which covers overlap between the streamer and the fillers before the uploader has moved the state.
+
+    Args:
+        next_stage: Upload queue or stage to hand new data points on to
+        states: State store updated by the uploader
+        recent_size: Number of recent timestamps to remember per time series
+    """
+
+    def __init__(self, next_stage: Any, states: AbstractStateStore, recent_size: int = 2048):
+        super().__init__(next_stage)
+        self.states = states
+        self.recent_size = recent_size
+        self.passed = 0
+        self.dropped = 0
+        self._lock = Lock()
+        # Timestamps in insertion order, used as a bounded ordered set
+        self._recent: Dict[str, Dict[int, None]] = {}
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        low, high = self.states.get_state(external_id)
+        fresh = []
+        with self._lock:
+            recent = self._recent.setdefault(external_id, {})
+            for datapoint in datapoints:
+                timestamp = datapoint[0]
+                if (low is not None and low <= timestamp <= high) or timestamp in recent:
+                    continue
+                recent[timestamp] = None
+                fresh.append(datapoint)
+            for _ in range(len(recent) - self.recent_size):
+                del recent[next(iter(recent))]
+            self.passed += len(fresh)
+            self.dropped += len(datapoints) - len(fresh)
+
+        if len(fresh) < len(datapoints):
+            _filtered.inc(len(datapoints) - len(fresh))
+            _logger.debug(f"Dropped {len(datapoints) - len(fresh)} duplicate data points for {external_id}")
+        if fresh:
+            self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=fresh)
+
+
+class SourceCounter(UploadStage):
+    """
+    Count uploaded data points per source, as set with datapoint_source by the streamer and the fillers. Put right in
+    front of the CDF upload queue, where everything handed on is uploaded in the order it was added, and pass uploaded
+    to the metrics post upload handler: the sizes of the uploads are attributed to the sources first in, first out.
+
+    Args:
+        next_stage: The CDF upload queue, having an upload_queue_size attribute
+    """
+
+    def __init__(self, next_stage: Any):
+        super().__init__(next_stage)
+        self._lock = Lock()
+        # Sources and sizes of the runs of data points added since the last upload, oldest first
+        self._pending: Deque[List[Any]] = deque()
+
+    @property
+    def upload_queue_size(self) -> int:
+        return self.next_stage.upload_queue_size
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        source = current_source()
+        with self._lock:
+            if self._pending and self._pending[-1][0] == source:
+                self._pending[-1][1] += len(datapoints)
+            else:
+                self._pending.append([source, len(datapoints)])
+        # The queue is called without holding the lock, as its uploader calls uploaded holding its own lock
+        self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=datapoints)
+
+    def uploaded(self, count: int) -> None:
+        """
+        Count data points uploaded, oldest first. Call from the post upload function of the upload queue.
+        """
+        with self._lock:
+            while count > 0 and self._pending:
+                run = self._pending[0]
+                taken = min(count, run[1])
+                DATAPOINTS_UPLOADED.labels(run[0]).inc(taken)
+                count -= taken
+                run[1] -= taken
+                if not run[1]:
+                    self._pending.popleft()
+        if count:
+            DATAPOINTS_UPLOADED.labels("unknown").inc(count)
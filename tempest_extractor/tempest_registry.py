@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+_logger = logging.getLogger(__name__)
+
+
+def fingerprint(definition: Dict[str, Any]) -> str:
+    """
+    Fingerprint of the definition of an asset or time series.
+    """
+    return hashlib.sha1(json.dumps(definition, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ProvisioningRegistry:
+    """
+    Local record of the assets and time series this extractor has made sure exist in CDF, with a fingerprint of their
+    definition. On a warm start only items that are new, have changed, or were checked more than max_age seconds ago
+    need to be provisioned, so an unchanged configuration starts without any provisioning requests.
+
+    Args:
+        path: File to keep the registry in
+        max_age: Seconds before an item is checked against CDF again, in case it was deleted there
+    """
+
+    def __init__(self, path: str, max_age: float = 7 * 24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        # Per external ID, [fingerprint, CDF ID, time of last check]
+        self._assets: Dict[str, List[Any]] = {}
+        self._time_series: Dict[str, List[Any]] = {}
+        try:
+            with open(path) as f:
+                registry = json.load(f)
+            self._assets = registry.get("assets", {})
+            self._time_series = registry.get("time_series", {})
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            _logger.warning(f"Ignoring unreadable provisioning registry {path}: {str(e)}")
+
+    def _fresh(self, entries: Dict[str, List[Any]], external_id: str, item_fingerprint: str) -> bool:
+        entry = entries.get(external_id)
+        return entry is not None and entry[0] == item_fingerprint and time.time() - entry[2] < self.max_age
+
+    def asset_id(self, external_id: str, item_fingerprint: str) -> Optional[int]:
+        """
+        CDF ID of a provisioned asset, or None if it needs to be provisioned.
+        """
+        if self._fresh(self._assets, external_id, item_fingerprint):
+            return self._assets[external_id][1]
+        return None
+
+    def add_asset(self, external_id: str, item_fingerprint: str, asset_id: int) -> None:
+        self._assets[external_id] = [item_fingerprint, asset_id, time.time()]
+
+    def missing_time_series(self, time_series: List[Any]) -> List[Any]:
+        """
+        Time series that need to be provisioned, out of the given ones.
+        """
+        return [ts for ts in time_series if not self._fresh(self._time_series, ts.external_id, fingerprint(ts.dump()))]
+
+    def add_time_series(self, time_series: List[Any]) -> None:
+        now = time.time()
+        for ts in time_series:
+            self._time_series[ts.external_id] = [fingerprint(ts.dump()), None, now]
+
+    def clear(self) -> None:
+        self._assets = {}
+        self._time_series = {}
+
+    def save(self) -> None:
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"assets": self._assets, "time_series": self._time_series}, f)
+        os.replace(f"{self.path}.tmp", self.path)
@@ -0,0 +1,144 @@
+import gzip
+import logging
+import os
+import time
+import zlib
+from threading import Event, Lock
+from typing import IO, TYPE_CHECKING, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    # Only for type checking, tempest_client imports FrameRecorder from this module
+    from tempest_extractor.tempest_client import TempestCollector
+
+_logger = logging.getLogger(__name__)
+
+SUFFIX = ".frames.gz"
+
+
+def recording_files(path: str) -> List[str]:
+    """
+    Recording files in a directory, oldest first.
+    """
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(SUFFIX))
+
+
+def read_frames(path: str) -> Iterator[Tuple[float, str]]:
+    """
+    Read (receive time, frame) pairs from a recording file, or from all recording files in a directory. A file cut
+    short by a crash is read up to the last complete frame.
+    """
+    for file_path in recording_files(path) if os.path.isdir(path) else [path]:
+        try:
+            with gzip.open(file_path, "rt") as f:
+                for line in f:
+                    received, _, frame = line.rstrip("\n").partition("\t")
+                    if frame:
+                        yield float(received), frame
+        except (EOFError, zlib.error) as e:
+            _logger.warning(f"Recording {file_path} is truncated: {str(e)}")
+
+
+class FrameRecorder:
+    """
+    Record raw websocket frames with their receive time, one frame per line in gzip compressed files. A new file is
+    started when the current one has max_size bytes of frames, and the oldest files are removed to keep at most
+    max_files. Files are flushed every flush_interval seconds, so a crash loses at most that much.
+
+    Args:
+        path: Directory to write recordings to
+        max_size: Uncompressed bytes of frames per file
+        max_files: Number of files to keep
+        flush_interval: Seconds between flushes to disk
+    """
+
+    def __init__(self, path: str, max_size: int, max_files: int, flush_interval: float = 5):
+        self.path = path
+        self.max_size = max_size
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._lock = Lock()
+        self._file: Optional[IO[str]] = None
+        self._size = 0
+        self._flushed = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        name = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+        file_path = os.path.join(self.path, f"{name}-{self.recorded:012d}{SUFFIX}")
+        self._file = gzip.open(file_path, "wt", compresslevel=6)
+        self._size = 0
+        _logger.info(f"Recording websocket frames to {file_path}")
+        for old in recording_files(self.path)[: -self.max_files]:
+            os.remove(old)
+
+    def record(self, frame: str) -> None:
+        # Newlines can only be whitespace between tokens in a JSON frame, so they are safe to replace
+        frame = frame.replace("\n", " ")
+        line = f"{time.time():.3f}\t{frame}\n"
+        with self._lock:
+            if self._file is None or self._size >= self.max_size:
+                self._rotate()
+            self._file.write(line)
+            self._size += len(line)
+            self.recorded += 1
+            if time.monotonic() - self._flushed > self.flush_interval:
+                self._file.flush()
+                self._flushed = time.monotonic()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class FrameReplayer:
+    """
+    Feed recorded frames to a collector in place of the websocket, keeping the recorded spacing between frames, sped
+    up by the given factor. A speed of 0 replays as fast as the collector takes the frames.
+
+    Args:
+        collector: Tempest collector to feed
+        path: Recording file, or directory of recording files
+        stop: Stopping event
+        speed: Replay speed relative to the recording, 0 for unthrottled
+        loop: Start over from the beginning when the recording ends
+    """
+
+    def __init__(self, collector: "TempestCollector", path: str, stop: Event, speed: float = 1, loop: bool = False):
+        self.collector = collector
+        self.path = path
+        self.stop = stop
+        self.speed = speed
+        self.loop = loop
+        self.replayed = 0
+
+    def _replay_once(self) -> None:
+        start = time.monotonic()
+        first: Optional[float] = None
+        for received, frame in read_frames(self.path):
+            if self.stop.is_set():
+                return
+            if self.speed > 0:
+                if first is None:
+                    first = received
+                delay = start + (received - first) / self.speed - time.monotonic()
+                if delay > 0 and self.stop.wait(delay):
+                    return
+            self.collector._on_message(None, frame)
+            self.replayed += 1
+
+    def run(self) -> None:
+        """
+        Replay until the recording ends, or forever if looping, or until the stop event is set.
+        """
+        _logger.info(f"Replaying websocket frames from {self.path} at speed {self.speed or 'unthrottled'}")
+        start = time.monotonic()
+        self._replay_once()
+        while self.loop and not self.stop.is_set():
+            self._replay_once()
+        elapsed = time.monotonic() - start
+        _logger.info(f"Replayed {self.replayed} frames in {elapsed:.1f} seconds")
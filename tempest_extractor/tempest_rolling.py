@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+import time
+from collections import deque
+from threading import Lock
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from tempest_extractor.config import YamlConfig
+from tempest_extractor.tempest_pipeline import UploadStage
+
+_logger = logging.getLogger(__name__)
+
+# A window counts as full when it has seen data from this close to its start, in milliseconds
+SLACK = 300 * 1000
+
+
+class RollingStatistic(NamedTuple):
+    # Element the statistic is computed from, how, and over how many seconds
+    element: str
+    kind: str
+    window: int
+
+
+STATISTICS: Dict[str, RollingStatistic] = {
+    "rain_accumulation_1h": RollingStatistic("rain_accumulation", "sum", 60 * 60),
+    "rain_accumulation_24h": RollingStatistic("rain_accumulation", "sum", 24 * 60 * 60),
+    "air_temperature_min_24h": RollingStatistic("air_temperature", "min", 24 * 60 * 60),
+    "air_temperature_max_24h": RollingStatistic("air_temperature", "max", 24 * 60 * 60),
+    "wind_gust_max_1h": RollingStatistic("wind_gust", "max", 60 * 60),
+    "pressure_change_3h": RollingStatistic("pressure", "change", 3 * 60 * 60),
+}
+
+
+class _Window:
+    """
+    Rolling window over the data points of one element, in milliseconds, updated in amortized constant time per point.
+    Sums keep the points in the window and a running total, min and max keep a monotonic deque of the points that can
+    still become the extreme, and changes keep the points back to the newest one a full window ago.
+
+    The raw points of the last two windows are kept too, so a late point within a window of the newest one can be merged
+    in, and the statistics at the points after it computed again.
+    """
+
+    __slots__ = ("kind", "window", "since", "last", "points", "total", "raw")
+
+    def __init__(self, kind: str, window: int, state: Optional[List[Any]] = None):
+        self.kind = kind
+        self.window = window
+        self.since: Optional[int] = None
+        self.last: Optional[int] = None
+        self.points: Deque[Tuple[int, float]] = deque()
+        self.total = 0.0
+        self.raw: Deque[Tuple[int, float]] = deque()
+        if state:
+            # The incremental state is built again from the raw points, so rounding errors do not build up across
+            # restarts. Earlier versions saved the incremental points, which rebuild the same state.
+            since, last, raw = state
+            self._rebuild(sorted(tuple(point) for point in raw), since)
+            self.last = last
+
+    def add(self, timestamp: int, value: float) -> Optional[float]:
+        """
+        Add a data point newer than the last one, and get the statistic over the window ending at it, or None while the
+        window is not full.
+        """
+        if self.since is None:
+            self.since = timestamp
+        self.last = timestamp
+        raw = self.raw
+        raw.append((timestamp, value))
+        while raw[0][0] < timestamp - 2 * self.window - SLACK:
+            raw.popleft()
+        return self._slide(timestamp, value)
+
+    def merge(self, datapoints: List[Tuple[int, float]]) -> Tuple[List[Tuple[int, Optional[float]]], int]:
+        """
+        Add data points older than the last one, and compute the statistic again at every point from the oldest added.
+        Points from more than a window before the last one, and points already seen, are ignored.
+
+        Returns:
+            Statistics from the oldest point added, with None where the window is not full, and the number of points
+            ignored
+        """
+        seen = {timestamp for timestamp, _ in self.raw}
+        added = [(t, v) for t, v in datapoints if t > self.last - self.window and t not in seen]
+        if not added:
+            return [], len(datapoints)
+        oldest = min(t for t, _ in added)
+        results = self._rebuild(sorted([*self.raw, *added]), min(self.since, oldest))
+        return [(t, result) for t, result in results if t >= oldest], len(datapoints) - len(added)
+
+    def _rebuild(self, raw: List[Tuple[int, float]], since: int) -> List[Tuple[int, Optional[float]]]:
+        self.since = since
+        self.points.clear()
+        self.total = 0.0
+        self.raw = deque(raw)
+        return [(timestamp, self._slide(timestamp, value)) for timestamp, value in raw]
+
+    def _slide(self, timestamp: int, value: float) -> Optional[float]:
+        points = self.points
+        start = timestamp - self.window
+        if self.kind == "sum":
+            points.append((timestamp, value))
+            self.total += value
+            while points[0][0] <= start:
+                self.total -= points.popleft()[1]
+        elif self.kind == "change":
+            points.append((timestamp, value))
+            while len(points) > 1 and points[1][0] <= start:
+                points.popleft()
+        else:
+            maximum = self.kind == "max"
+            while points and (points[-1][1] <= value if maximum else points[-1][1] >= value):
+                points.pop()
+            points.append((timestamp, value))
+            while points[0][0] <= start:
+                points.popleft()
+
+        if self.since > start + SLACK:
+            return None
+        if self.kind == "sum":
+            # Adding 0.0 turns the -0.0 left by rounding a tiny negative total into 0.0
+            return round(self.total, 6) + 0.0
+        if self.kind == "change":
+            reference_time, reference = points[0]
+            if abs(reference_time - start) > SLACK:
+                # No data point from a window ago, the device was quiet then
+                return None
+            return round(value - reference, 6)
+        return points[0][1]
+
+    def dump(self) -> List[Any]:
+        return [self.since, self.last, list(self.raw)]
+
+
+class RollingStatistics:
+    """
+    Rolling statistics over live data, like rain totals and temperature extremes over the last hours, published as
+    extra time series per device named after the statistic. Every data point of an element gives a data point of each
+    statistic computed from it, over the window ending at its timestamp, once the window has seen data from its start.
+
+    Windows are kept per device in memory and updated incrementally, so nothing is read back from CDF. Points older than
+    the last one seen for a window, like healed, gap filled or frontfilled data, are merged in, and the statistics at
+    the points after them computed again, as long as they are less than a window older than the last one. Older points
+    and duplicates are ignored. The windows are saved to a file regularly and on close, and continue where they left
+    off after a restart.
+
+    Args:
+        config: Set of configuration parameters, statistics are taken from config.rolling
+    """
+
+    def __init__(self, config: YamlConfig):
+        rolling = config.rolling
+        for name in rolling.statistics:
+            if name not in STATISTICS:
+                raise ValueError(f"Unknown rolling statistic {name}, use one of {', '.join(STATISTICS)}")
+        self.config = config
+        self.path = rolling.state_path
+        self.save_interval = rolling.save_interval
+        self.statistics = {name: STATISTICS[name] for name in rolling.statistics}
+        # Elements to get data points of, as from datapoints_per_element
+        self.elements = sorted({statistic.element for statistic in self.statistics.values()})
+        # Device and element per external ID of the elements
+        self.inputs = {
+            config.external_id(device.device_id, element): (device.device_id, element)
+            for device in config.tempest.get_devices()
+            for element in self.elements
+        }
+        self._windows: Dict[str, _Window] = {}
+        self._lock = Lock()
+        # Saves may be triggered from several threads, and write the same temporary file
+        self._save_lock = Lock()
+        self._saved = time.monotonic()
+        self.late = 0
+        self._load()
+
+    def _window(self, external_id: str, statistic: RollingStatistic) -> _Window:
+        window = self._windows.get(external_id)
+        if window is None:
+            window = self._windows[external_id] = _Window(statistic.kind, statistic.window * 1000)
+        return window
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                states = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            _logger.warning(f"Ignoring unreadable rolling statistics state {self.path}: {str(e)}")
+            return
+        for device in self.config.tempest.get_devices():
+            for name, statistic in self.statistics.items():
+                external_id = self.config.external_id(device.device_id, name)
+                if external_id in states:
+                    self._windows[external_id] = _Window(statistic.kind, statistic.window * 1000, states[external_id])
+        _logger.info(f"Loaded rolling statistics windows for {len(self._windows)} time series")
+
+    def update(self, device_id: str, data: Dict[str, List[Any]]) -> Dict[str, List[Any]]:
+        """
+        Add data points of a device, and get the new data points of its statistics, including those computed again
+        because of late data points.
+
+        Args:
+            device_id: Device the data points are from
+            data: Data points per element, in time order, as returned by datapoints_per_element for self.elements
+        Returns:
+            Data points per statistic, in time order
+        """
+        derived: Dict[str, List[Any]] = {}
+        with self._lock:
+            for name, statistic in self.statistics.items():
+                datapoints = data.get(statistic.element)
+                if not datapoints:
+                    continue
+                window = self._window(self.config.external_id(device_id, name), statistic)
+                results: Dict[int, Optional[float]] = {}
+                late = []
+                for timestamp, value in datapoints:
+                    if window.last is not None and timestamp <= window.last:
+                        late.append((timestamp, value))
+                    else:
+                        results[timestamp] = window.add(timestamp, value)
+                if late:
+                    merged, ignored = window.merge(late)
+                    results.update(merged)
+                    self.late += ignored
+                statistics = [(t, result) for t, result in sorted(results.items()) if result is not None]
+                if statistics:
+                    derived[name] = statistics
+            save = time.monotonic() - self._saved > self.save_interval
+        if save:
+            self.save()
+        return derived
+
+    def save(self) -> None:
+        """
+        Save the windows, atomically.
+        """
+        with self._save_lock:
+            with self._lock:
+                states = {external_id: window.dump() for external_id, window in self._windows.items()}
+                self._saved = time.monotonic()
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(states, f)
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def close(self) -> None:
+        self.save()
+
+
+class RollingFeed(UploadStage):
+    """
+    Feed the data points of the elements the rolling statistics are computed from to them, on the way to the next
+    stage. Meant for the fillers, whose data arrives after live data, so the statistics of an interval they fill are
+    computed again. The statistics are put in derived_queue, which should be after the deduplication, as they replace
+    data points already stored.
+
+    Args:
+        next_stage: Upload queue or stage to hand data points on to
+        rolling: Rolling statistics to update
+        derived_queue: Where to put the statistics
+    """
+
+    def __init__(self, next_stage: Any, rolling: RollingStatistics, derived_queue: Any):
+        super().__init__(next_stage)
+        self.rolling = rolling
+        self.derived_queue = derived_queue
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=datapoints)
+        source = self.rolling.inputs.get(external_id)
+        if source is None or not datapoints:
+            return
+        device_id, element = source
+        for name, statistics in self.rolling.update(device_id, {element: sorted(datapoints)}).items():
+            self.derived_queue.add_to_upload_queue(
+                external_id=self.rolling.config.external_id(device_id, name), datapoints=statistics
+            )
@@ -0,0 +1,189 @@
+import logging
+import os
+import pickle
+from threading import Event, Lock, Thread
+from typing import Any, BinaryIO, List, Optional, Tuple
+
+from tempest_extractor.tempest_metrics import DATAPOINTS_SPILLED, current_source, datapoint_source
+from tempest_extractor.tempest_pipeline import UploadStage
+
+_logger = logging.getLogger(__name__)
+
+SUFFIX = ".segment"
+
+# Seconds to wait for an upload in progress before spilling instead
+BUSY_WAIT = 1.0
+
+
+class SpillStage(UploadStage):
+    """
+    Keep the number of data points waiting in the CDF upload queue within a memory budget. When the queue holds
+    max_datapoints, for instance because CDF is slow or unreachable, or an upload holding the queue lock has not
+    completed within BUSY_WAIT seconds, further data points are appended to a log of segment files on disk instead.
+    The stage counts the data points it has handed on since the last upload itself, so it never waits for the queue to
+    decide. A drain thread feeds the segments back to the queue, oldest first and each sorted by
+    time, at up to drain_rate data points per second once the queue has room again. While there is data on disk, new
+    data points go to the log too, so they are uploaded in order.
+
+    A segment is only removed after an upload that includes all of its data points has completed, which the upload
+    queue signals by calling confirm_upload from its post upload function. Segments left by a crash or a restart are
+    drained on start.
+
+    Args:
+        next_stage: The CDF upload queue or a stage in front of it
+        path: Directory to keep segment files in
+        max_datapoints: Data points allowed in the upload queue before spilling to disk
+        segment_size: Bytes written to a segment before starting a new one
+        drain_rate: Data points per second fed back to the upload queue
+        stop: Stopping event, ends the drain thread
+        queue_lock: Lock the upload queue holds while uploading, if any
+    """
+
+    def __init__(
+        self,
+        next_stage: Any,
+        path: str,
+        max_datapoints: int,
+        segment_size: int,
+        drain_rate: float,
+        stop: Event,
+        queue_lock: Optional[Any] = None,
+    ):
+        super().__init__(next_stage)
+        self.path = path
+        self.max_datapoints = max_datapoints
+        self.segment_size = segment_size
+        self.drain_rate = drain_rate
+        self.stop = stop
+        self.queue_lock = queue_lock
+        self.spilled = 0
+        # Data points handed on since the last upload
+        self.queued = 0
+        self._lock = Lock()
+        self._file: Optional[BinaryIO] = None
+        # Segments fed back to the queue, waiting for an upload to complete
+        self._unconfirmed: List[str] = []
+        self._wakeup = Event()
+
+        os.makedirs(path, exist_ok=True)
+        self._segments = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(SUFFIX))
+        self._sequence = int(os.path.basename(self._segments[-1])[: -len(SUFFIX)]) + 1 if self._segments else 0
+        if self._segments:
+            _logger.info(f"Found {len(self._segments)} spilled segments, draining them to CDF")
+        self._thread = Thread(target=self._drain, name="SpillDrainer", daemon=True)
+        self._thread.start()
+
+    def _busy(self) -> bool:
+        # Whether an upload holds the queue lock, and does not let go of it within BUSY_WAIT
+        if self.queue_lock is None:
+            return False
+        if not self.queue_lock.acquire(timeout=BUSY_WAIT):
+            return True
+        self.queue_lock.release()
+        return False
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        # Checked before taking the lock, as the uploader calls confirm_upload holding the queue lock
+        busy = not self._segments and self._busy()
+        with self._lock:
+            spill = busy or self._segments or self.queued + len(datapoints) > self.max_datapoints
+            if spill:
+                self._write([(external_id, datapoints, current_source())])
+            else:
+                self.queued += len(datapoints)
+        # The queue is called without holding the lock, as its uploader calls confirm_upload holding its own lock
+        if spill:
+            self._wakeup.set()
+        else:
+            self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=datapoints)
+
+    def _write(self, records: List[Tuple[str, List[Any], str]]) -> None:
+        # Called with the lock held. One pickled batch per call, appended to the newest segment.
+        if self._file is None or self._file.tell() >= self.segment_size:
+            if self._file is not None:
+                self._file.close()
+            if not self._segments:
+                _logger.warning(f"Upload queue is full, spilling data points to {self.path}")
+            self._file = open(os.path.join(self.path, f"{self._sequence:012d}{SUFFIX}"), "ab")
+            self._segments.append(self._file.name)
+            self._sequence += 1
+        pickle.dump(records, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        spilled = sum(len(record[1]) for record in records)
+        self.spilled += spilled
+        DATAPOINTS_SPILLED.inc(spilled)
+
+    def _next_segment(self) -> Optional[str]:
+        with self._lock:
+            if not self._segments:
+                return None
+            if self._file is not None and self._file.name == self._segments[0]:
+                # Draining the segment being written, new data goes to a fresh one
+                self._file.close()
+                self._file = None
+            return self._segments[0]
+
+    def _read(self, segment: str) -> List[Tuple[str, List[Any], str]]:
+        # Merged per time series and source, segments written before sources were kept have none
+        merged = {}
+        with open(segment, "rb") as f:
+            while True:
+                try:
+                    records = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError) as e:
+                    _logger.warning(f"Segment {segment} is truncated: {str(e)}")
+                    break
+                for external_id, datapoints, *source in records:
+                    merged.setdefault((external_id, source[0] if source else "unknown"), []).extend(datapoints)
+        return [
+            (external_id, sorted(datapoints, key=lambda d: d[0]), source)
+            for (external_id, source), datapoints in merged.items()
+        ]
+
+    def _drain(self) -> None:
+        while not self.stop.is_set():
+            if not self._segments or self.queued > self.max_datapoints // 2:
+                # Wait for data on disk, or for the queue to go down
+                self._wakeup.wait(1)
+                self._wakeup.clear()
+                continue
+            segment = self._next_segment()
+            for external_id, datapoints, source in self._read(segment):
+                for start in range(0, len(datapoints), max(1, int(self.drain_rate))):
+                    if self.stop.is_set():
+                        return
+                    chunk = datapoints[start : start + max(1, int(self.drain_rate))]
+                    with self._lock:
+                        self.queued += len(chunk)
+                    with datapoint_source(source):
+                        self.next_stage.add_to_upload_queue(external_id=external_id, datapoints=chunk)
+                    self.stop.wait(len(chunk) / self.drain_rate)
+            with self._lock:
+                self._segments.remove(segment)
+                self._unconfirmed.append(segment)
+                if not self._segments:
+                    _logger.info("Spilled data points are back in the upload queue")
+
+    def close(self) -> None:
+        """
+        Close the segment being written. Data points still on disk are drained on the next start.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._segments:
+                _logger.info(f"Leaving {len(self._segments)} spilled segments for the next run")
+
+    def confirm_upload(self) -> None:
+        """
+        Remove segments whose data points were all in the upload queue before this upload, and start counting the data
+        points handed on again. Call from the post upload function of the upload queue.
+        """
+        with self._lock:
+            confirmed, self._unconfirmed = self._unconfirmed, []
+            self.queued = 0
+        for segment in confirmed:
+            os.remove(segment)
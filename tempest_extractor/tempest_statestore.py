@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+from threading import Event, Lock
+from typing import Any, Dict, Optional, Set, TextIO
+
+from cognite.extractorutils.statestore import AbstractStateStore
+
+from tempest_extractor.config import StateLogConfig
+
+_logger = logging.getLogger(__name__)
+
+
+class LogStateStore(AbstractStateStore):
+    """
+    A state store keeping states in a JSON snapshot and an append-only log of changes next to it. Changed states are
+    collected in memory, and appended to the log as one line with a sequence number every save_interval seconds, or as
+    soon as max_pending states have changed. Each append is flushed to disk, so writes scale with the number of states
+    changed, not with the number of states.
+
+    When the log has grown larger than the snapshot, and at least compact_bytes, the snapshot is rewritten, atomically,
+    with the sequence number of the last line in the log, and the log is emptied. On initialize, lines of the log newer
+    than the snapshot are replayed on top of it, so a crash at any point leaves the states of the last completed append.
+    A line left incomplete by a crash is cut off.
+
+    Args:
+        path: File to keep the snapshot in, the log is kept in the same path with .log appended
+        save_interval: Seconds between appending changes to the log, when run as a thread (use start/stop methods)
+        max_pending: Changed states held in memory before appending them right away
+        compact_bytes: Smallest log size to rewrite the snapshot at
+        thread_name: Thread name of the thread appending changes
+    """
+
+    def __init__(
+        self,
+        path: str,
+        save_interval: Optional[int] = None,
+        max_pending: int = 10000,
+        compact_bytes: int = 1024 * 1024,
+        thread_name: Optional[str] = None,
+    ):
+        # An own cancellation token, the default one is shared by all state stores
+        super().__init__(save_interval, thread_name=thread_name, cancellation_token=Event())
+        self.path = path
+        self.log_path = f"{path}.log"
+        self.max_pending = max_pending
+        self.compact_bytes = compact_bytes
+        self._pending: Set[str] = set()
+        self._sequence = 0
+        self._snapshot_size = 0
+        self._log_size = 0
+        self._log: Optional[TextIO] = None
+        # Serializes appends and compactions, without blocking state updates while writing
+        self._write_lock = Lock()
+
+    def initialize(self, force: bool = False) -> None:
+        """
+        Load the snapshot and replay the log on top of it.
+
+        Args:
+            force: Enable re-initialization, ie overwrite when called multiple times
+        """
+        if self._initialized and not force:
+            return
+        with self._write_lock, self.lock:
+            self._local_state = {}
+            self._sequence = 0
+            self._snapshot_size = 0
+            try:
+                with open(self.path) as f:
+                    snapshot = json.load(f)
+                self._local_state = snapshot["states"]
+                self._sequence = snapshot["sequence"]
+                self._snapshot_size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"Invalid state snapshot {self.path}: {str(e)}") from e
+            replayed = self._replay()
+            self._pending.clear()
+            self._deleted.clear()
+            if self._log is not None:
+                self._log.close()
+            self._log = open(self.log_path, "a")
+        self._initialized = True
+        _logger.info(f"Loaded {len(self._local_state)} states, replaying {replayed} changes from {self.log_path}")
+
+    def _replay(self) -> int:
+        # Called with the locks held. Returns the number of states changed by the log.
+        replayed = 0
+        valid = 0
+        try:
+            f = open(self.log_path, "rb")
+        except FileNotFoundError:
+            self._log_size = 0
+            return 0
+        with f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("no end of line")
+                    record = json.loads(line)
+                except ValueError as e:
+                    _logger.warning(f"Cutting off incomplete change at byte {valid} of {self.log_path}: {str(e)}")
+                    break
+                valid += len(line)
+                if record["sequence"] <= self._sequence:
+                    # Already in the snapshot, left by a compaction interrupted before emptying the log
+                    continue
+                for key, state in record["changes"].items():
+                    if state is None:
+                        self._local_state.pop(key, None)
+                    else:
+                        self._local_state[key] = state
+                self._sequence = record["sequence"]
+                replayed += len(record["changes"])
+            size = f.tell()
+        if valid < size:
+            with open(self.log_path, "r+b") as f:
+                f.truncate(valid)
+        self._log_size = valid
+        return replayed
+
+    def _changed(self, external_id: str) -> bool:
+        # Called with the lock held. Returns True when enough changes are pending to append them.
+        self._pending.add(external_id)
+        return len(self._pending) >= self.max_pending
+
+    def set_state(self, external_id: str, low: Optional[Any] = None, high: Optional[Any] = None) -> None:
+        with self.lock:
+            before = dict(self._local_state.get(external_id, {}))
+            super().set_state(external_id, low, high)
+            flush = self._local_state[external_id] != before and self._changed(external_id)
+        if flush:
+            self.synchronize()
+
+    def expand_state(self, external_id: str, low: Optional[Any] = None, high: Optional[Any] = None) -> None:
+        with self.lock:
+            before = dict(self._local_state.get(external_id, {}))
+            super().expand_state(external_id, low, high)
+            flush = self._local_state[external_id] != before and self._changed(external_id)
+        if flush:
+            self.synchronize()
+
+    def delete_state(self, external_id: str) -> None:
+        with self.lock:
+            super().delete_state(external_id)
+            flush = self._changed(external_id)
+        if flush:
+            self.synchronize()
+
+    def synchronize(self) -> None:
+        """
+        Append the changed states to the log, and rewrite the snapshot if the log has grown large.
+        """
+        with self._write_lock:
+            if self._log is None:
+                return
+            with self.lock:
+                if not self._pending:
+                    return
+                changes: Dict[str, Any] = {key: self._local_state.get(key) for key in self._pending}
+                self._pending.clear()
+                self._deleted.clear()
+                self._sequence += 1
+                sequence = self._sequence
+            line = json.dumps({"sequence": sequence, "changes": changes}) + "\n"
+            self._log.write(line)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log_size += len(line)
+            if self._log_size > max(self._snapshot_size, self.compact_bytes):
+                self._compact(sequence)
+
+    def _compact(self, sequence: int) -> None:
+        # Called with the write lock held. States changed after the last append are in the snapshot too, and are
+        # appended again later with a higher sequence number.
+        with self.lock:
+            snapshot = json.dumps({"sequence": sequence, "states": self._local_state})
+        with open(f"{self.path}.tmp", "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.path}.tmp", self.path)
+        self._log.seek(0)
+        self._log.truncate()
+        _logger.debug(f"Compacted {self._log_size} bytes of state changes into a snapshot of {len(snapshot)} bytes")
+        self._snapshot_size = len(snapshot)
+        self._log_size = 0
+
+    def clear(self) -> None:
+        """
+        Remove all states, from memory and disk.
+        """
+        with self._write_lock, self.lock:
+            self._local_state = {}
+            self._pending.clear()
+            self._deleted.clear()
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            for path in (self.path, self.log_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.initialize(force=True)
+
+
+def state_log_store(config: StateLogConfig, path: Optional[str] = None) -> LogStateStore:
+    """
+    Create a log state store from its configuration, optionally at another path.
+    """
+    return LogStateStore(
+        path or config.path,
+        save_interval=config.save_interval,
+        max_pending=config.max_pending,
+        compact_bytes=int(config.compact_mb * 1024 * 1024),
+        thread_name="StateLog",
+    )
@@ -1,25 +1,32 @@
 import logging
 from concurrent.futures.thread import ThreadPoolExecutor
 from threading import Event
+from typing import Optional
 
 from cognite.extractorutils.uploader import TimeSeriesUploadQueue
 from cognite.extractorutils.util import throttled_loop
 
 from tempest_extractor.config import YamlConfig
 from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_metrics import DATAPOINTS_ENQUEUED, datapoint_source
+from tempest_extractor.tempest_rolling import RollingStatistics
 
 _logger = logging.getLogger(__name__)
 
+_enqueued = DATAPOINTS_ENQUEUED.labels("streamer")
+
 
 class Streamer:
     """
-    Periodically query the sensor API for the current state of all the configured elements.
+    Move live data from the collector to the upload queue. In poll mode the collector is drained periodically, in push
+    mode as soon as data arrives, in batches of up to flush_size or after flush_linger seconds.
 
     Args:
         upload_queue: Where to put data points
         stop: Stopping event
         collector: Collector API to query
         config: Set of configuration parameters
+        rolling: Rolling statistics to update with live observations and publish, if any
     """
 
     def __init__(
@@ -28,6 +35,7 @@ class Streamer:
         stop: Event,
         collector: TempestCollector,
         config: YamlConfig,
+        rolling: Optional[RollingStatistics] = None,
     ):
         self.upload_queue = upload_queue
         self.stop = stop
@@ -35,28 +43,58 @@ class Streamer:
         self.target_iteration_time = config.extractor.collector_interval
 
         self.config = config
+        self.rolling = rolling
 
     def _extract(self) -> None:
         """
-        Collect data from a given Tempest device using the api. Function to send to thread pool in run().
+        Collect data from all Tempest devices fed by the collector. Function to send to thread pool in run().
         """
-        _logger.info(f"Checking data feed from collector for {self.config.tempest.device_id}")
-
-        data = self.collector.datapoints_per_element(self.config.tempest.elements, self.collector.get_observations())
-        data.update(
-            self.collector.datapoints_per_element(self.config.tempest.summaries, self.collector.get_summaries())
+        observations, summaries = self.collector.get_collected()
+        _logger.debug(
+            f"Checking data feed from collector, got data from {len(observations)} devices "
+            f"({self.collector.buffer.dropped} dropped, {self.collector.buffer.spilled} spilled)"
         )
 
-        for element in data:
-            self.upload_queue.add_to_upload_queue(
-                external_id=f"{self.config.cognite.external_id_prefix}{self.config.tempest.device_id}:{element}",
-                datapoints=data[element],
+        for device_id in set(observations) | set(summaries):
+            data = self.collector.datapoints_per_element(self.config.tempest.elements, observations.get(device_id, []))
+            data.update(
+                self.collector.datapoints_per_element(self.config.tempest.summaries, summaries.get(device_id, []))
             )
+            if self.rolling is not None and device_id in observations:
+                data.update(
+                    self.rolling.update(
+                        device_id,
+                        self.collector.datapoints_per_element(self.rolling.elements, observations[device_id]),
+                    )
+                )
+
+            with datapoint_source("streamer"):
+                for element in data:
+                    self.upload_queue.add_to_upload_queue(
+                        external_id=self.config.external_id(device_id, element),
+                        datapoints=data[element],
+                    )
+                    _enqueued.inc(len(data[element]))
+
+    def _run_push(self) -> None:
+        buffer = self.collector.buffer
+        while not self.stop.is_set():
+            # Wake up regularly to check the stop event
+            if not buffer.wait(1, timeout=1):
+                continue
+            # Linger a little to let a batch build up, unless it is already big enough
+            buffer.wait(self.config.extractor.flush_size, timeout=self.config.extractor.flush_linger)
+            self._extract()
+            if self.config.extractor.upload_on_flush:
+                self.upload_queue.upload()
 
     def run(self) -> None:
         """
         Run streamer until the stop event is set.
         """
+        if self.config.extractor.streaming_mode == "push":
+            self._run_push()
+            return
         with ThreadPoolExecutor(
             max_workers=self.config.extractor.parallelism, thread_name_prefix="Streamer"
         ) as executor:
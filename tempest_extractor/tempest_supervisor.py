@@ -0,0 +1,386 @@
+import copy
+import json
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+from multiprocessing.process import BaseProcess
+from threading import Event
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from cognite.client import CogniteClient
+from cognite.extractorutils import Extractor
+from cognite.extractorutils.statestore import AbstractStateStore, LocalStateStore, RawStateStore
+
+from tempest_extractor.config import TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_statestore import state_log_store
+
+_logger = logging.getLogger(__name__)
+
+# Kept in the main state store, the number of workers the states are partitioned for
+WORKERS_KEY = "supervisor:workers"
+
+
+def shard_of(device_id: str, workers: int) -> int:
+    # crc32 is the same in every process and run, unlike hash()
+    return zlib.crc32(device_id.encode()) % workers
+
+
+def shard_devices(devices: List[TempestDeviceConfig], shard: int, workers: int) -> List[TempestDeviceConfig]:
+    return [device for device in devices if shard_of(device.device_id, workers) == shard]
+
+
+def _suffixed(path: str, shard: int) -> str:
+    root, extension = os.path.splitext(path)
+    return f"{root}-{shard}{extension}"
+
+
+def worker_config(config: YamlConfig, shard: int, workers: int) -> YamlConfig:
+    """
+    Configuration of one worker: the devices of its shard, its own local files, and its own metrics endpoints.
+    Provisioning is done by the supervisor, so workers do not use the registry.
+    """
+    config = copy.deepcopy(config)
+    config.tempest.devices = shard_devices(config.tempest.get_devices(), shard, workers)
+    config.tempest.device_id = None
+    config.tempest.device_name = None
+    config.extractor.workers = 0
+    config.extractor.registry_path = None
+    config.extractor.buffer.spill_path = _suffixed(config.extractor.buffer.spill_path, shard)
+    if config.extractor.spill:
+        config.extractor.spill.path = _suffixed(config.extractor.spill.path, shard)
+    if config.cache:
+        config.cache.path = _suffixed(config.cache.path, shard)
+    if config.aggregation:
+        config.aggregation.state_path = _suffixed(config.aggregation.state_path, shard)
+    if config.compression:
+        config.compression.state_path = _suffixed(config.compression.state_path, shard)
+    if config.recording:
+        config.recording.path = _suffixed(config.recording.path, shard)
+    if config.gapfill:
+        config.gapfill.path = _suffixed(config.gapfill.path, shard)
+    if config.rolling:
+        config.rolling.state_path = _suffixed(config.rolling.state_path, shard)
+    if config.metrics:
+        if config.metrics.server:
+            config.metrics.server.port += shard + 1
+        for push_gateway in config.metrics.push_gateways or []:
+            push_gateway.job_name = f"{push_gateway.job_name}-worker-{shard}"
+        if config.metrics.cognite:
+            config.metrics.cognite.external_id_prefix = f"{config.metrics.cognite.external_id_prefix}worker-{shard}:"
+    return config
+
+
+def partition_state_store(config: YamlConfig, cdf: CogniteClient, shard: int) -> AbstractStateStore:
+    """
+    State store partition of one worker, stored next to the configured state store: in a RAW table or local file with
+    the shard number appended.
+    """
+    if config.extractor.state_log:
+        return state_log_store(config.extractor.state_log, _suffixed(config.extractor.state_log.path, shard))
+    store_config = config.extractor.state_store
+    if store_config and store_config.raw:
+        return RawStateStore(
+            cdf_client=cdf,
+            database=store_config.raw.database,
+            table=f"{store_config.raw.table}-{shard}",
+            save_interval=store_config.raw.upload_interval.seconds,
+        )
+    if store_config and store_config.local:
+        return LocalStateStore(
+            _suffixed(store_config.local.path, shard), save_interval=store_config.local.save_interval.seconds
+        )
+    return LocalStateStore(_suffixed("states.json", shard))
+
+
+def _key_device(key: str, prefix: str, devices: Set[str]) -> Optional[str]:
+    # Time series states are keyed by prefix, device ID and element, other states like backfill progress by a kind,
+    # the device ID and more
+    if prefix and key.startswith(prefix):
+        key = key[len(prefix) :]
+    for part in key.split(":")[:2]:
+        if part in devices:
+            return part
+    return None
+
+
+def _state_files(config: YamlConfig) -> List[str]:
+    # Local files of the pipeline holding a JSON object keyed by time series external ID or device ID
+    paths = []
+    if config.aggregation:
+        paths.append(config.aggregation.state_path)
+    if config.compression:
+        paths.append(config.compression.state_path)
+    if config.gapfill:
+        paths.append(config.gapfill.path)
+    if config.rolling:
+        paths.append(config.rolling.state_path)
+    return paths
+
+
+def _write_json(path: str, content: Dict[str, Any]) -> None:
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(content, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def rebalance_files(config: YamlConfig, previous: int, workers: int) -> int:
+    """
+    Move the entries of the local state files of the pipeline, like rolling statistics windows and the coverage index,
+    between the files of the worker partitions, the same way rebalance_states moves states. Entries are written to their
+    new file before they are removed from the old one, so an interrupted rebalance loses nothing.
+
+    Args:
+        config: Configuration, with all devices and the unsuffixed paths
+        previous: Number of workers the files are partitioned for
+        workers: Number of workers to partition for
+    Returns:
+        Number of entries moved
+    """
+    devices = {device.device_id for device in config.tempest.get_devices()}
+    prefix = config.cognite.external_id_prefix or ""
+    moved = 0
+    for path in _state_files(config):
+        paths = [path] + [_suffixed(path, shard) for shard in range(max(previous, workers))]
+        contents: Dict[str, Dict[str, Any]] = {}
+        for source in paths:
+            try:
+                with open(source) as f:
+                    contents[source] = json.load(f)
+            except FileNotFoundError:
+                contents[source] = {}
+            except ValueError as e:
+                _logger.warning(f"Not rebalancing unreadable state file {source}: {str(e)}")
+
+        targets: Dict[str, Dict[str, Any]] = {target: {} for target in contents}
+        for source, content in contents.items():
+            for key, value in content.items():
+                device = _key_device(key, prefix, devices)
+                # Entries of devices no longer configured are kept in the main file
+                target = _suffixed(path, shard_of(device, workers)) if workers > 0 and device is not None else path
+                if target not in targets:
+                    # The file it belongs in is unreadable, keep it where it is
+                    target = source
+                if target != source:
+                    moved += 1
+                # Left in both files by an interrupted rebalance, the copy already moved wins
+                if target == source or key not in targets[target]:
+                    targets[target][key] = value
+
+        for target, content in targets.items():
+            if content.keys() - contents[target].keys():
+                _write_json(target, {**contents[target], **content})
+        for target, content in targets.items():
+            if content:
+                _write_json(target, content)
+            elif os.path.exists(target):
+                os.remove(target)
+    return moved
+
+
+def rebalance_states(
+    config: YamlConfig,
+    cdf: CogniteClient,
+    states: AbstractStateStore,
+    workers: int,
+    clear: bool = False,
+    force: bool = False,
+) -> None:
+    """
+    Move states between the main state store and the worker partitions, so the states of each device are in the
+    partition of the worker it is sharded to, or all in the main state store for 0 workers. The local state files of the
+    pipeline are rebalanced with rebalance_files. Must run while no workers are running. States are copied before they
+    are removed from where they were, so an interrupted rebalance is completed on the next start.
+
+    Args:
+        config: Configuration, with all devices
+        cdf: Cognite client, for RAW state stores
+        states: Main state store
+        workers: Number of workers to partition for
+        clear: Empty the partitions, after the main state store has been cleaned up
+        force: Rebalance even if the number of workers is unchanged, after the configured devices have changed
+    """
+    previous = int(states.get_state(WORKERS_KEY)[0] or 0)
+    if previous == workers and not clear and not force:
+        return
+    partitions = [partition_state_store(config, cdf, shard) for shard in range(max(previous, workers))]
+    for partition in partitions:
+        partition.initialize()
+    devices = {device.device_id for device in config.tempest.get_devices()}
+    prefix = config.cognite.external_id_prefix or ""
+
+    moves = []
+    for store in [states] + partitions:
+        for key in list(store):
+            device = _key_device(key, prefix, devices)
+            if clear and store is not states:
+                store.delete_state(key)
+                continue
+            if key == WORKERS_KEY:
+                continue
+            # States of devices no longer configured are kept in the main state store
+            target = partitions[shard_of(device, workers)] if workers > 0 and device is not None else states
+            if target is not store:
+                low, high = store.get_state(key)
+                target.expand_state(key, low, high)
+                moves.append((store, key))
+    for store in partitions + [states]:
+        store.synchronize()
+
+    for store, key in moves:
+        store.delete_state(key)
+    moved_files = rebalance_files(config, previous, workers) if previous != workers or force else 0
+    states.set_state(WORKERS_KEY, workers)
+    for store in partitions + [states]:
+        store.synchronize()
+    _logger.info(
+        f"Moved {len(moves)} states and {moved_files} state file entries from {previous} to {workers} worker partitions"
+    )
+
+
+class Supervisor:
+    """
+    Run the extractor as a number of worker processes, each collecting and uploading the devices of one shard, sharded
+    by a hash of the device ID. Each worker has its own collector, upload queue and state store partition, so workers
+    never write to the same state. Crashed workers are restarted, with a growing delay if they keep crashing. When the
+    number of workers or the devices change in a reloaded config file, all workers are stopped, the states
+    repartitioned, and the workers started again with the new shards. When the number of workers changes to 0, run
+    returns after moving the states back to the main state store, so the caller can run the pipeline in its own process.
+
+    Args:
+        config: Set of configuration parameters
+        cdf: Cognite client
+        states: Main state store, holding states not belonging to any configured device
+        stop: Stopping event
+        worker: Function run in each worker process, given the worker configuration, its shard and number of workers
+        reshard: (Optional) Function run with a reloaded configuration whose devices changed, before its workers are
+            started, to provision the new devices
+        restart_delay: Seconds before restarting a crashed worker, doubled for each crash in a row
+        max_restart_delay: Longest delay before restarting a worker, also how long it must run to reset the delay
+        stop_timeout: Seconds to wait for a worker to stop before killing it
+    """
+
+    def __init__(
+        self,
+        config: YamlConfig,
+        cdf: CogniteClient,
+        states: AbstractStateStore,
+        stop: Event,
+        worker: Callable[[YamlConfig, int, int], None],
+        reshard: Optional[Callable[[YamlConfig], None]] = None,
+        restart_delay: float = 5,
+        max_restart_delay: float = 300,
+        stop_timeout: float = 60,
+    ):
+        self.config = config
+        self.cdf = cdf
+        self.states = states
+        self.stop = stop
+        self.worker = worker
+        self.reshard = reshard
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stop_timeout = stop_timeout
+        self.workers = config.extractor.workers
+        self.restarts = 0
+        # Spawned rather than forked, the parent has threads running
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: List[Optional[BaseProcess]] = []
+        self._started: List[float] = []
+        self._crashes: List[int] = []
+        self._restart_at: List[Optional[float]] = []
+
+    def _start(self, shard: int) -> None:
+        process = self._context.Process(
+            target=self.worker,
+            args=(worker_config(self.config, shard, self.workers), shard, self.workers),
+            name=f"Worker-{shard}",
+        )
+        process.start()
+        self._processes[shard] = process
+        self._started[shard] = time.monotonic()
+        self._restart_at[shard] = None
+
+    def _start_all(self) -> None:
+        devices = self.config.tempest.get_devices()
+        _logger.info(f"Starting {self.workers} workers for {len(devices)} devices")
+        self._processes = [None] * self.workers
+        self._started = [0.0] * self.workers
+        self._crashes = [0] * self.workers
+        self._restart_at = [None] * self.workers
+        for shard in range(self.workers):
+            if not shard_devices(devices, shard, self.workers):
+                _logger.warning(f"No devices in shard {shard}, consider fewer workers")
+            self._start(shard)
+
+    def _stop_all(self) -> None:
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                # Workers stop gracefully on SIGTERM, uploading and storing their states
+                process.terminate()
+        deadline = time.monotonic() + self.stop_timeout
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                _logger.warning(f"{process.name} did not stop in {self.stop_timeout} seconds, killing it")
+                process.kill()
+                process.join()
+
+    def _check(self, shard: int) -> None:
+        process = self._processes[shard]
+        if process.is_alive():
+            return
+        now = time.monotonic()
+        if self._restart_at[shard] is None:
+            if now - self._started[shard] > self.max_restart_delay:
+                self._crashes[shard] = 0
+            self._crashes[shard] += 1
+            delay = min(self.max_restart_delay, self.restart_delay * 2 ** (self._crashes[shard] - 1))
+            _logger.warning(f"{process.name} exited with code {process.exitcode}, restarting in {delay:.0f} seconds")
+            self._restart_at[shard] = now + delay
+        elif now >= self._restart_at[shard]:
+            self.restarts += 1
+            self._start(shard)
+
+    def _reloaded_config(self) -> YamlConfig:
+        # The config singleton is replaced when the config file is reloaded
+        try:
+            return Extractor.get_current_config()
+        except ValueError:
+            return self.config
+
+    def run(self) -> None:
+        """
+        Run workers until the stop event is set, or the number of workers is changed to 0, then stop them.
+        """
+        if self.config.extractor.cleanup:
+            rebalance_states(self.config, self.cdf, self.states, self.workers, clear=True)
+        rebalance_states(self.config, self.cdf, self.states, self.workers)
+        self._start_all()
+        while not self.stop.wait(1):
+            config = self._reloaded_config()
+            workers = max(0, config.extractor.workers)
+            resharded = config.tempest.get_devices() != self.config.tempest.get_devices()
+            if workers != self.workers or resharded:
+                if resharded:
+                    _logger.info(f"Devices changed, resharding {len(config.tempest.get_devices())} devices")
+                else:
+                    _logger.info(f"Number of workers changed from {self.workers} to {workers}, rebalancing")
+                self._stop_all()
+                self.config = config
+                self.workers = workers
+                if resharded and self.reshard is not None:
+                    self.reshard(config)
+                rebalance_states(self.config, self.cdf, self.states, self.workers, force=resharded)
+                if not self.workers:
+                    _logger.info("Running without workers")
+                    return
+                self._start_all()
+                continue
+            for shard in range(self.workers):
+                self._check(shard)
+        _logger.info("Stopping workers")
+        self._stop_all()
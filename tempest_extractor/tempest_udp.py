@@ -0,0 +1,137 @@
+import logging
+import socket
+import time
+from threading import Event, Thread
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+
+from tempest_extractor.config import UdpConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_decoding import dumps, loads
+from tempest_extractor.tempest_parsers import PARSERS
+
+_logger = logging.getLogger(__name__)
+
+# Largest datagram a hub sends is well below this
+MAX_DATAGRAM = 65535
+
+
+class UdpListener:
+    """
+    Collect live data from the UDP broadcasts of Tempest hubs on the local network, instead of over the cloud
+    websocket. Hubs broadcast obs_st, obs_sky, obs_air, rapid_wind and evt_strike messages from their devices, and
+    hub_status and device_status messages. Messages are picked by the serial number of the configured devices, given
+    the device ID of the device, and parsed and buffered by the collector like websocket messages. Broadcasts carry no
+    summaries, those are only available from the websocket.
+
+    If no observations from configured devices arrive for fallback_after seconds, the collector is started on the cloud
+    websocket, and it is closed again as soon as broadcasts resume. Data received from both while switching over is
+    removed by the deduplication in the upload pipeline.
+
+    Args:
+        collector: Tempest collector to parse and buffer messages, and to fall back to
+        config: UDP configuration
+        stop: Stopping event
+        serials: Device ID per serial number, looked up from the stations of the devices without one if not given
+    """
+
+    def __init__(
+        self,
+        collector: TempestCollector,
+        config: UdpConfig,
+        stop: Event,
+        serials: Optional[Dict[str, str]] = None,
+    ):
+        self.collector = collector
+        self.config = config
+        self.stop = stop
+        self.serials = serials if serials is not None else self._lookup_serials()
+        self.received = 0
+        self._last_observation = time.monotonic()
+        self._cloud: Optional[Thread] = None
+
+    def _lookup_serials(self) -> Dict[str, str]:
+        serials = {d.serial_number: d.device_id for d in self.collector.devices.values() if d.serial_number}
+        unknown = set(self.collector.devices) - set(serials.values())
+        if not unknown:
+            return serials
+        try:
+            for station in self.collector.get_stations():
+                for device in station.devices:
+                    if str(device.device_id) in unknown:
+                        serials[device.serial_number] = str(device.device_id)
+                        unknown.discard(str(device.device_id))
+        except Exception as e:
+            _logger.warning(f"Could not look up serial numbers of devices: {str(e)}")
+        for device_id in unknown:
+            _logger.warning(f"Serial number of device {device_id} unknown, set serial_number to pick its broadcasts")
+        return serials
+
+    def _socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # Allows the WeatherFlow app or other listeners on the same host
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.config.host, self.config.port))
+        # Wake up regularly to check the stop event and for a quiet hub
+        sock.settimeout(1)
+        return sock
+
+    def handle(self, datagram: bytes, sender: Tuple[str, int]) -> None:
+        """
+        Decode a broadcast, and hand it to the collector if it is from a configured device.
+        """
+        started = perf_counter()
+        try:
+            obs = loads(datagram)
+        except ValueError:
+            _logger.debug("Ignoring undecodable datagram from %s", sender[0])
+            return
+        self.received += 1
+        _logger.debug("UDP message from %s: %s", sender[0], datagram)
+        device_id = self.serials.get(obs.get("serial_number"))
+        if device_id is None:
+            # Status messages of the hub, and messages from devices that are not configured
+            return
+        obs["device_id"] = device_id
+        if obs.get("type") in PARSERS:
+            self._last_observation = time.monotonic()
+            if self._cloud is not None:
+                _logger.info("Receiving broadcasts from the hub again, closing the cloud websocket")
+                self.collector.close()
+                self._cloud = None
+        if self.collector.recorder is not None:
+            # Recorded with the device ID, so the recording replays like websocket frames
+            self.collector.recorder.record(dumps(obs).decode())
+        self.collector.collect(obs, started)
+
+    def _check_quiet(self) -> None:
+        if self.config.fallback_after <= 0 or self._cloud is not None:
+            return
+        quiet = time.monotonic() - self._last_observation
+        if quiet > self.config.fallback_after:
+            _logger.warning(f"No broadcasts from the hub for {quiet:.0f} seconds, falling back to the cloud websocket")
+            self._cloud = Thread(target=self.collector.run, name="CloudCollector", daemon=True)
+            self._cloud.start()
+
+    def run(self) -> None:
+        """
+        Listen for broadcasts until the stop event is set.
+        """
+        sock = self._socket()
+        _logger.info(f"Listening for broadcasts of {len(self.serials)} devices on UDP port {self.config.port}")
+        self._last_observation = time.monotonic()
+        try:
+            while not self.stop.is_set():
+                try:
+                    datagram, sender = sock.recvfrom(MAX_DATAGRAM)
+                except socket.timeout:
+                    datagram = None
+                if datagram:
+                    self.handle(datagram, sender)
+                self._check_quiet()
+        finally:
+            sock.close()
+            if self._cloud is not None:
+                self.collector.close()
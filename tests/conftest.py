@@ -0,0 +1,50 @@
+import os
+import sys
+import threading
+from typing import Any, Dict, List, Tuple
+
+import pytest
+
+# The extractor is run from the repository root, with some modules imported relative to the package directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "tempest_extractor")]
+
+from tempest_extractor.tempest_metrics import current_source  # noqa: E402
+
+
+class RecordingQueue:
+    """
+    Stand-in for the CDF upload queue, or a stage in front of it, recording what is added to it.
+    """
+
+    def __init__(self):
+        self.datapoints: Dict[str, List[Any]] = {}
+        # Source and timestamps of each call, in order
+        self.sources: List[Tuple[str, List[int]]] = []
+        self.upload_queue_size = 0
+        self.uploads = 0
+        self.added = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+        with self._lock:
+            self.datapoints.setdefault(external_id, []).extend(datapoints)
+            self.sources.append((current_source(), [datapoint[0] for datapoint in datapoints]))
+            self.upload_queue_size += len(datapoints)
+        self.added.set()
+
+    def upload(self) -> None:
+        with self._lock:
+            self.upload_queue_size = 0
+            self.uploads += 1
+
+
+@pytest.fixture
+def recording_queue() -> RecordingQueue:
+    return RecordingQueue()
+
+
+@pytest.fixture
+def make_queue() -> type:
+    # For tests needing more than one queue
+    return RecordingQueue
@@ -0,0 +1,93 @@
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+from tempest_extractor.config import AggregationConfig, TempestDeviceConfig
+from tempest_extractor.tempest_aggregation import AggregationStage
+
+SECOND = 1000
+WIND = "tempest:1:rapid_wind_avg"
+DIRECTION = "tempest:1:rapid_wind_direction"
+
+
+def stage(tmp_path, recording_queue, flush_after: int = 0, **aggregation: Any) -> AggregationStage:
+    # Only the parts of the configuration the stage uses
+    config = SimpleNamespace(
+        aggregation=AggregationConfig(
+            flush_after=flush_after, state_path=str(tmp_path / "aggregation.json"), **aggregation
+        ),
+        tempest=SimpleNamespace(get_devices=lambda: [TempestDeviceConfig("1", "Roof")]),
+        external_id=lambda device_id, element: f"tempest:{device_id}:{element}",
+    )
+    return AggregationStage(recording_queue, config)
+
+
+@pytest.mark.parametrize("aggregate, expected", [("average", 4.0), ("min", 1.0), ("max", 8.0), ("count", 4)])
+def test_window_is_stored_when_the_next_one_starts(tmp_path, recording_queue, aggregate, expected):
+    aggregation = stage(tmp_path, recording_queue, elements={"rapid_wind_avg": aggregate})
+    aggregation.add_to_upload_queue(WIND, [(3 * i * SECOND, v) for i, v in enumerate([1.0, 8.0, 4.0, 3.0])])
+    assert WIND not in recording_queue.datapoints
+    aggregation.add_to_upload_queue(WIND, [(61 * SECOND, 5.0)])
+    assert recording_queue.datapoints[WIND] == [(0, expected)]
+    assert aggregation.ratio() == 5
+
+
+def test_direction_is_averaged_as_a_vector(tmp_path, recording_queue):
+    aggregation = stage(tmp_path, recording_queue)
+    aggregation.add_to_upload_queue(
+        DIRECTION, [(0, 350), (3 * SECOND, 10), (60 * SECOND, 90), (63 * SECOND, 180), (120 * SECOND, 0)]
+    )
+    assert recording_queue.datapoints[DIRECTION] == [(0, 0.0), (60 * SECOND, 135.0)]
+
+
+def test_late_and_other_data_points(tmp_path, recording_queue):
+    aggregation = stage(tmp_path, recording_queue)
+    aggregation.add_to_upload_queue(WIND, [(60 * SECOND, 2.0), (SECOND, 1.0), (120 * SECOND, 3.0)])
+    assert recording_queue.datapoints[WIND] == [(60 * SECOND, 2.0)]
+    assert aggregation.late == 1
+    aggregation.add_to_upload_queue("tempest:1:air_temperature", [(0, 20.0), (SECOND, 20.5)])
+    assert recording_queue.datapoints["tempest:1:air_temperature"] == [(0, 20.0), (SECOND, 20.5)]
+
+
+def test_quiet_window_is_flushed(tmp_path, recording_queue):
+    aggregation = stage(tmp_path, recording_queue, flush_after=120)
+    try:
+        aggregation.add_to_upload_queue(WIND, [(0, 2.0), (3 * SECOND, 4.0)])
+        aggregation.flush(time.monotonic() - 60)
+        assert WIND not in recording_queue.datapoints
+        aggregation.flush(time.monotonic())
+        assert recording_queue.datapoints[WIND] == [(0, 3.0)]
+        # Stored once, and points arriving after the flush are late
+        aggregation.add_to_upload_queue(WIND, [(6 * SECOND, 9.0)])
+        aggregation.flush(time.monotonic())
+        aggregation.add_to_upload_queue(WIND, [(60 * SECOND, 1.0), (120 * SECOND, 1.0)])
+        assert recording_queue.datapoints[WIND] == [(0, 3.0), (60 * SECOND, 1.0)]
+        assert aggregation.late == 1
+    finally:
+        aggregation.close()
+
+
+def test_raw_tail_keeps_the_last_seconds(tmp_path, recording_queue):
+    aggregation = stage(tmp_path, recording_queue, raw_tail=10)
+    aggregation.add_to_upload_queue(WIND, [(3 * i * SECOND, float(i)) for i in range(10)])
+    assert aggregation.tail(WIND) == [(3 * i * SECOND, float(i)) for i in range(6, 10)]
+    assert aggregation.tail(DIRECTION) == []
+
+
+def test_open_windows_are_continued_after_a_restart(tmp_path, recording_queue):
+    aggregation = stage(tmp_path, recording_queue)
+    aggregation.add_to_upload_queue(WIND, [(0, 2.0)])
+    aggregation.close()
+    assert WIND not in recording_queue.datapoints
+    aggregation = stage(tmp_path, recording_queue)
+    aggregation.add_to_upload_queue(WIND, [(30 * SECOND, 4.0), (60 * SECOND, 1.0)])
+    assert recording_queue.datapoints[WIND] == [(0, 3.0)]
+
+
+def test_periodic_elements_are_rejected(tmp_path, recording_queue):
+    with pytest.raises(ValueError, match="wind_avg"):
+        stage(tmp_path, recording_queue, elements={"wind_avg": "average"})
+    with pytest.raises(ValueError, match="median"):
+        stage(tmp_path, recording_queue, elements={"rapid_wind_avg": "median"})
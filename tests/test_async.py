@@ -0,0 +1,76 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from threading import Event
+from types import SimpleNamespace
+
+import pytest
+from cognite.extractorutils.statestore import LocalStateStore
+
+from benchmarks.frames import obs_st_row
+from tempest_extractor.config import BackfillConfig, ExtractorConfig, TempestConfig, TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_client import TempestCollector
+
+pytest.importorskip("aiohttp")
+
+from tempest_extractor.tempest_async import AsyncRuntime  # noqa: E402
+
+
+def make_config() -> YamlConfig:
+    tempest = TempestConfig(
+        token="", elements=["air_temperature"], summaries=[], devices=[TempestDeviceConfig("1234", "Roof")]
+    )
+    return YamlConfig(
+        version=None,
+        type=None,
+        # Only the external ID prefix is used on the ingest path
+        cognite=SimpleNamespace(external_id_prefix="tempest:"),
+        logger=None,
+        tempest=tempest,
+        backfill=BackfillConfig(),
+        extractor=ExtractorConfig(runtime="asyncio", streaming_mode="push", flush_size=1, flush_linger=0.01),
+    )
+
+
+def test_event_loop_runs_while_the_upload_queue_blocks(tmp_path, make_queue):
+    class BlockedQueue(make_queue):
+        # Like the CDF queue while its uploader holds the lock through a slow upload
+        def __init__(self) -> None:
+            super().__init__()
+            self.unblock = threading.Event()
+
+        def add_to_upload_queue(self, external_id, datapoints) -> None:
+            self.unblock.wait(10)
+            super().add_to_upload_queue(external_id, datapoints)
+
+    config = make_config()
+    queue = BlockedQueue()
+    stop = Event()
+    collector = TempestCollector(config.tempest)
+    runtime = AsyncRuntime(queue, stop, collector, config, LocalStateStore(str(tmp_path / "states.json")))
+
+    async def scenario() -> None:
+        runtime._data = asyncio.Event()
+        stream = asyncio.create_task(runtime._stream())
+        message = {"type": "obs_st", "device_id": 1234, "obs": [obs_st_row(1661673288, random.Random(0))]}
+        collector._on_message(None, json.dumps(message))
+        runtime._data.set()
+        # The streamer is stuck on the queue, other coroutines keep running
+        started = time.monotonic()
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+        assert time.monotonic() - started < 2
+        assert not queue.datapoints
+        queue.unblock.set()
+        assert await asyncio.get_running_loop().run_in_executor(None, queue.added.wait, 5)
+        stop.set()
+        await stream
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        queue.unblock.set()
+        runtime._enqueuer.shutdown()
+    assert [t for t, _ in queue.datapoints["tempest:1234:air_temperature"]] == [1661673288000]
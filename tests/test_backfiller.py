@@ -0,0 +1,222 @@
+import time
+from threading import Event, Lock
+from types import SimpleNamespace
+from typing import Dict, List, Set, Tuple
+
+import arrow
+from cognite.extractorutils.statestore import LocalStateStore
+
+from tempest_extractor.config import BackfillConfig, TempestDeviceConfig
+from tempest_extractor.tempest_backfiller import Backfiller, WindowPlanner
+from tempest_extractor.tempest_dataclasses import TempestObservationBatch
+from tempest_extractor.tempest_http import TempestApiError
+
+DEVICE = TempestDeviceConfig("1234", "Roof")
+HOUR = 60 * 60
+
+
+def backfiller(tmp_path, states: LocalStateStore) -> Backfiller:
+    # Only the parts of the configuration the backfiller uses
+    config = SimpleNamespace(
+        backfill=BackfillConfig(),
+        extractor=SimpleNamespace(parallelism=1),
+        tempest=SimpleNamespace(get_devices=lambda: [DEVICE], elements=["air_temperature"]),
+        external_id=lambda device_id, element: f"tempest:{device_id}:{element}",
+    )
+    return Backfiller(None, Event(), None, config, states)
+
+
+def test_migrates_grid_window_states(tmp_path):
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    now = arrow.utcnow().int_timestamp
+    top = now - now % (24 * HOUR)
+    # Windows of a day fetched concurrently, the third newest one had not completed
+    for start in (top, top - 24 * HOUR, top - 3 * 24 * HOUR):
+        states.set_state(f"backfill:{DEVICE.device_id}:{start}", low=start, high=min(start + 24 * HOUR, now))
+    states.set_state(f"backfill:other:{top}", low=top, high=now)
+
+    planners = backfiller(tmp_path, states).plan()
+
+    assert states.get_state(f"backfill:{DEVICE.device_id}") == (top - 24 * HOUR, now)
+    assert not [key for key in states if key.startswith(f"backfill:{DEVICE.device_id}:")]
+    # States of devices not configured are left alone
+    assert states.get_state(f"backfill:other:{top}") == (top, now)
+    # The backfill resumes below the contiguous windows, fetching the one after the gap again
+    assert planners[0].end == top - 24 * HOUR
+
+
+def test_migration_keeps_newer_progress(tmp_path):
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    now = arrow.utcnow().int_timestamp
+    states.set_state(f"backfill:{DEVICE.device_id}", low=now - 2 * 24 * HOUR, high=now)
+    states.set_state(f"backfill:{DEVICE.device_id}:{now - HOUR}", low=now - HOUR, high=now)
+
+    backfiller(tmp_path, states).plan()
+
+    assert states.get_state(f"backfill:{DEVICE.device_id}") == (now - 2 * 24 * HOUR, now)
+    assert list(states) == [f"backfill:{DEVICE.device_id}"]
+
+
+class FakeCollector:
+    """
+    Answers historical requests with one row per minute, failing the first request for each device given.
+    """
+
+    def __init__(self, fail: Set[str] = frozenset()):
+        self.fail = set(fail)
+        self.requests: List[Tuple[str, int, int]] = []
+        self.failed: List[Tuple[str, int, int]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = Lock()
+
+    def get_historical(self, device_id: str, time_start: int, time_end: int) -> TempestObservationBatch:
+        with self._lock:
+            self.requests.append((device_id, time_start, time_end))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(0.01)
+            with self._lock:
+                fail = device_id in self.fail
+                self.fail.discard(device_id)
+            if fail:
+                self.failed.append((device_id, time_start, time_end))
+                raise TempestApiError("observations/", status=503)
+            epochs = list(range(time_start - time_start % 60 + 60, time_end + 1, 60))
+            batch = TempestObservationBatch()
+            batch.extend_columns(
+                epochs, {"air_temperature": [20.0] * len(epochs), "report_interval": [1] * len(epochs)}
+            )
+            return batch
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def datapoints_per_element(self, elements: List[str], observations: TempestObservationBatch) -> Dict[str, List]:
+        return {element: observations.datapoints(element) for element in elements} if len(observations) else {}
+
+
+def test_backfills_devices_concurrently_and_retries(tmp_path, recording_queue):
+    devices = [TempestDeviceConfig("1", "Roof"), TempestDeviceConfig("2", "Garden")]
+    config = SimpleNamespace(
+        backfill=BackfillConfig(backfill_days=1, iteration_time=0, target_rows=120),
+        extractor=SimpleNamespace(parallelism=4),
+        tempest=SimpleNamespace(get_devices=lambda: devices, elements=["air_temperature"]),
+        external_id=lambda device_id, element: f"tempest:{device_id}:{element}",
+    )
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    collector = FakeCollector(fail={"2"})
+    queue = recording_queue
+    backfiller = Backfiller(queue, Event(), collector, config, states)
+    backfiller.run()
+
+    # Both devices fetching several windows at once
+    assert collector.max_in_flight == 4
+    for device in devices:
+        low, high = states.get_state(f"backfill:{device.device_id}")
+        assert low == backfiller.stop_at.int_timestamp
+        timestamps = sorted(
+            timestamp // 1000 for timestamp, _ in queue.datapoints[f"tempest:{device.device_id}:air_temperature"]
+        )
+        # Every minute once, from the backfill limit up to where it started
+        assert timestamps == list(range(timestamps[0], high + 1, 60))
+        assert timestamps[0] - low <= 60
+    # The failed window was fetched again
+    assert [request[0] for request in collector.failed] == ["2"]
+    assert collector.requests.count(collector.failed[0]) == 2
+
+
+def test_single_device_is_fetched_with_several_windows(tmp_path, recording_queue):
+    config = SimpleNamespace(
+        backfill=BackfillConfig(backfill_days=1, iteration_time=0, target_rows=60),
+        extractor=SimpleNamespace(parallelism=3),
+        tempest=SimpleNamespace(get_devices=lambda: [DEVICE], elements=["air_temperature"]),
+        external_id=lambda device_id, element: f"tempest:{device_id}:{element}",
+    )
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    collector = FakeCollector(fail={DEVICE.device_id})
+    backfiller = Backfiller(recording_queue, Event(), collector, config, states)
+    backfiller.run()
+
+    assert collector.max_in_flight == 3
+    low, high = states.get_state(f"backfill:{DEVICE.device_id}")
+    assert low == backfiller.stop_at.int_timestamp
+    timestamps = sorted(
+        timestamp // 1000 for timestamp, _ in recording_queue.datapoints["tempest:1234:air_temperature"]
+    )
+    assert timestamps == list(range(timestamps[0], high + 1, 60))
+
+
+def rows(start: int, end: int, step: int = 60, report_interval: int = 1) -> TempestObservationBatch:
+    epochs = list(range(start, end, step))
+    batch = TempestObservationBatch()
+    batch.extend_columns(epochs, {"report_interval": [report_interval] * len(epochs)})
+    return batch
+
+
+def planner(end: int = 1_000_000, stop_at: int = 0) -> WindowPlanner:
+    return WindowPlanner(DEVICE, end, stop_at, size=HOUR, min_size=600, max_size=7 * 24 * HOUR, target_rows=1440)
+
+
+def test_windows_are_sized_from_response_density():
+    plan = planner()
+    window = plan.next_window()
+    assert (window.time_start, window.time_end) == (1_000_000 - HOUR, 1_000_000)
+    # A device reporting every 10 minutes, target_rows would fit in 10 days, more than the largest window
+    assert plan.complete(window, rows(window.time_start, window.time_end, 600, report_interval=10))
+    assert plan.end == window.time_start
+    assert plan.size == 7 * 24 * HOUR
+    plan = planner()
+    window = plan.next_window()
+    assert plan.complete(window, rows(window.time_start, window.time_end))
+    # A row a minute fits target_rows in a day
+    assert plan.size == 24 * HOUR
+
+
+def test_empty_windows_grow_up_to_max_size():
+    plan = planner(end=100 * 24 * HOUR)
+    for size in (4 * HOUR, 16 * HOUR, 64 * HOUR, 7 * 24 * HOUR):
+        assert plan.complete(plan.next_window(), rows(0, 0))
+        assert plan.size == size
+
+
+def test_coarse_responses_are_fetched_again_in_smaller_windows():
+    plan = planner()
+    plan.size = 20 * 24 * HOUR
+    window = plan.next_window()
+    # The API answers long ranges at a 5 minute resolution
+    assert not plan.complete(window, rows(window.time_start, window.time_end, 300))
+    assert plan.end == 1_000_000
+    assert plan.coarse_size == window.time_end - window.time_start
+    assert plan.size < plan.coarse_size
+    smaller = plan.next_window()
+    assert smaller.time_end == window.time_end
+    assert plan.complete(smaller, rows(smaller.time_start, smaller.time_end))
+    # Windows stay below the coarse size from then on
+    assert plan.size < plan.coarse_size
+
+
+def test_progress_is_contiguous_when_windows_complete_out_of_order():
+    plan = planner()
+    first, second, third = plan.next_window(), plan.next_window(), plan.next_window()
+    assert first.time_start == second.time_end and second.time_start == third.time_end
+    assert plan.complete(third, rows(third.time_start, third.time_end))
+    assert plan.complete(second, rows(second.time_start, second.time_end))
+    # The newest window has not completed
+    assert plan.end == 1_000_000
+    plan.retry(first)
+    window = plan.next_window()
+    assert window == first
+    assert plan.complete(window, rows(window.time_start, window.time_end))
+    assert plan.end == third.time_start
+
+
+def test_backfill_stops_at_the_limit():
+    plan = planner(end=10 * HOUR, stop_at=9 * HOUR)
+    assert plan.remaining() == 1
+    window = plan.next_window()
+    assert window.time_start == 9 * HOUR
+    plan.complete(window, rows(window.time_start, window.time_end))
+    assert plan.done
+    assert plan.remaining() == 0
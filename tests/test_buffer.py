@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+
+from tempest_extractor.tempest_buffer import RingBuffer
+
+
+def test_drain_returns_items_in_order():
+    buffer = RingBuffer(10)
+    for item in range(5):
+        buffer.put(item)
+    assert buffer.depth == 5
+    assert buffer.drain() == [0, 1, 2, 3, 4]
+    assert buffer.depth == 0
+    assert buffer.drain() == []
+
+
+def test_capacity_is_counted_in_item_size():
+    buffer = RingBuffer(10, size=len)
+    buffer.put("abcd")
+    buffer.put("efgh")
+    assert buffer.depth == 8
+    buffer.put("ijkl")
+    # The oldest item made room for the newest
+    assert buffer.drain() == ["efgh", "ijkl"]
+    assert buffer.dropped == 4
+
+
+def test_drop_oldest_counts_dropped_items():
+    buffer = RingBuffer(3)
+    for item in range(10):
+        buffer.put(item)
+    assert buffer.drain() == [7, 8, 9]
+    assert buffer.dropped == 7
+    assert buffer.depth == 0
+
+
+def test_block_waits_for_the_consumer():
+    buffer = RingBuffer(2, overflow="block", block_timeout=0.01)
+    buffer.put(0)
+    buffer.put(1)
+    producer = threading.Thread(target=buffer.put, args=(2,))
+    producer.start()
+    time.sleep(0.1)
+    # The producer waits while the buffer is full
+    assert producer.is_alive()
+    assert buffer.drain() == [0, 1]
+    producer.join(1)
+    assert not producer.is_alive()
+    assert buffer.drain() == [2]
+    assert buffer.dropped == 0
+
+
+def test_spill_keeps_everything_in_order(tmp_path):
+    buffer = RingBuffer(3, overflow="spill", spill_path=str(tmp_path))
+    for item in range(3):
+        buffer.put(item)
+    buffer.put(3)
+    assert buffer.spilled == 1
+    buffer.put(4)
+    assert (buffer.depth, buffer.spilled) == (3, 2)
+    assert buffer.drain() == [0, 1, 2, 3, 4]
+    assert (buffer.depth, buffer.spilled, buffer.dropped) == (0, 0, 0)
+    assert not list(tmp_path.iterdir())
+
+
+def test_spill_keeps_ordering_while_items_are_on_disk(tmp_path):
+    buffer = RingBuffer(2, overflow="spill", spill_path=str(tmp_path))
+    for item in range(3):
+        buffer.put(item)
+    # Items after a spilled one go to disk too, even when there is room in memory
+    assert buffer.drain() == [0, 1, 2]
+    buffer.put(3)
+    assert buffer.spilled == 0
+    assert buffer.drain() == [3]
+
+
+def test_spill_files_left_by_a_crash_are_removed(tmp_path):
+    (tmp_path / "00000000.spill").write_bytes(b"left over")
+    RingBuffer(2, overflow="spill", spill_path=str(tmp_path))
+    assert not list(tmp_path.iterdir())
+
+
+def test_wait_counts_spilled_items(tmp_path):
+    buffer = RingBuffer(1, overflow="spill", spill_path=str(tmp_path))
+    assert not buffer.wait(1, timeout=0.01)
+    buffer.put(0)
+    buffer.put(1)
+    assert buffer.wait(2, timeout=0.01)
+
+
+def test_wait_wakes_up_on_put():
+    buffer = RingBuffer(10)
+    threading.Timer(0.05, buffer.put, args=(0,)).start()
+    assert buffer.wait(1, timeout=5)
+
+
+@pytest.mark.parametrize("overflow, spill_path", [("drop-newest", None), ("spill", None)])
+def test_invalid_policies_are_rejected(overflow, spill_path):
+    with pytest.raises(ValueError):
+        RingBuffer(1, overflow=overflow, spill_path=spill_path)
@@ -0,0 +1,119 @@
+import random
+from typing import Any, Dict, List, Tuple
+
+import arrow
+import pytest
+
+from benchmarks.frames import obs_st_row
+from tempest_extractor.config import TempestConfig, TempestDeviceConfig
+from tempest_extractor.tempest_cache import HistoricalCache
+from tempest_extractor.tempest_client import TempestCollector
+
+HOUR = 60 * 60
+
+
+class FakeApi:
+    """
+    Answers historical requests with one obs_st row a minute, both ends included, and with one row every five minutes
+    for ranges longer than coarse_after seconds.
+    """
+
+    def __init__(self, coarse_after: int = 10 * 24 * HOUR):
+        self.coarse_after = coarse_after
+        self.requests: List[Tuple[int, int]] = []
+
+    def __call__(self, device_id: str, time_start: int, time_end: int) -> Dict[str, Any]:
+        self.requests.append((time_start, time_end))
+        step = 300 if time_end - time_start > self.coarse_after else 60
+        first = time_start + -time_start % step
+        rows = [obs_st_row(epoch, random.Random(epoch)) for epoch in range(first, time_end + 1, step)]
+        return {"type": "obs_st", "device_id": int(device_id), "obs": rows}
+
+
+@pytest.fixture
+def grid() -> int:
+    # Start of an hour well in the past, so the windows after it are closed
+    now = arrow.utcnow().int_timestamp
+    return now - now % HOUR - 10 * HOUR
+
+
+def collector(tmp_path, api: FakeApi) -> TempestCollector:
+    config = TempestConfig(token="", elements=[], summaries=[], devices=[TempestDeviceConfig("1234", "Roof")])
+    cache = HistoricalCache(str(tmp_path), max_size=1024 * 1024 * 1024, window=HOUR, closed_after=HOUR)
+    client = TempestCollector(config, cache=cache)
+    client._fetch_historical = api
+    return client
+
+
+def epochs(client: TempestCollector, time_start: int, time_end: int) -> List[int]:
+    return list(client.get_historical("1234", time_start=time_start, time_end=time_end).epochs)
+
+
+def test_misses_are_fetched_as_one_range_and_hit_after(tmp_path, grid):
+    api = FakeApi()
+    client = collector(tmp_path, api)
+    assert epochs(client, grid + 600, grid + 3 * HOUR) == list(range(grid + 600, grid + 3 * HOUR + 1, 60))
+    assert api.requests == [(grid, grid + 3 * HOUR)]
+    assert len(list(tmp_path.iterdir())) == 3
+
+    assert epochs(client, grid + 600, grid + 3 * HOUR) == list(range(grid + 600, grid + 3 * HOUR + 1, 60))
+    assert len(api.requests) == 1
+    assert client.cache.hits == 3
+
+
+def test_only_the_missing_windows_are_fetched(tmp_path, grid):
+    api = FakeApi()
+    client = collector(tmp_path, api)
+    epochs(client, grid + HOUR, grid + 2 * HOUR)
+    api.requests.clear()
+    assert epochs(client, grid, grid + 4 * HOUR) == list(range(grid, grid + 4 * HOUR + 1, 60))
+    assert api.requests == [(grid, grid + HOUR), (grid + 2 * HOUR, grid + 4 * HOUR)]
+
+
+def test_ranges_ending_on_the_grid_have_no_extra_window(tmp_path, grid):
+    api = FakeApi()
+    client = collector(tmp_path, api)
+    assert client._historical_pieces(grid, grid + 2 * HOUR) == [
+        (grid, grid + HOUR, True),
+        (grid + HOUR, grid + 2 * HOUR, True),
+    ]
+    # The row on the boundary between windows comes once, and the one where the range ends is included
+    assert epochs(client, grid, grid + 2 * HOUR) == list(range(grid, grid + 2 * HOUR + 1, 60))
+    assert epochs(client, grid + 2 * HOUR, grid + 3 * HOUR)[0] == grid + 2 * HOUR
+
+
+def test_open_window_is_cached_once_closed(tmp_path, grid, monkeypatch):
+    api = FakeApi()
+    client = collector(tmp_path, api)
+    now = grid + 5 * HOUR + 1200
+    monkeypatch.setattr("tempest_extractor.tempest_client.arrow.utcnow", lambda: arrow.get(now))
+    pieces = client._historical_pieces(grid + 3 * HOUR, now)
+    # Windows ending less than closed_after ago may still get late data from the hub
+    assert pieces == [(grid + 3 * HOUR, grid + 4 * HOUR, True), (grid + 4 * HOUR, now, False)]
+    assert epochs(client, grid + 3 * HOUR, now) == list(range(grid + 3 * HOUR, now + 1, 60))
+    assert len(list(tmp_path.iterdir())) == 1
+
+    monkeypatch.setattr("tempest_extractor.tempest_client.arrow.utcnow", lambda: arrow.get(now + 2 * HOUR))
+    api.requests.clear()
+    assert epochs(client, grid + 3 * HOUR, now) == list(range(grid + 3 * HOUR, now + 1, 60))
+    assert api.requests == [(grid + 4 * HOUR, grid + 6 * HOUR)]
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_coarse_ranges_are_fetched_again_per_window(tmp_path, grid):
+    api = FakeApi(coarse_after=2 * HOUR)
+    client = collector(tmp_path, api)
+    assert epochs(client, grid, grid + 3 * HOUR) == list(range(grid, grid + 3 * HOUR + 1, 60))
+    assert api.requests == [(grid, grid + 3 * HOUR)] + [(grid + i * HOUR, grid + (i + 1) * HOUR) for i in range(3)]
+    api.requests.clear()
+    assert epochs(client, grid, grid + 3 * HOUR) == list(range(grid, grid + 3 * HOUR + 1, 60))
+    assert api.requests == []
+
+
+def test_least_recently_used_windows_are_evicted(tmp_path):
+    cache = HistoricalCache(str(tmp_path), max_size=1)
+    cache.put("1", 0, 10, {"obs": [[0]]})
+    cache.put("1", 10, 20, {"obs": [[10]]})
+    assert cache.get("1", 0, 10) is None
+    assert cache.get("1", 10, 20) == {"obs": [[10]]}
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+import pytest
+
+from tempest_extractor.config import CompressionConfig, CompressionElementConfig, TempestDeviceConfig
+from tempest_extractor.tempest_compression import CompressionStage
+
+MINUTE = 60 * 1000
+
+
+def make_config(tmp_path, elements: Dict[str, CompressionElementConfig], max_interval: int = 3600) -> SimpleNamespace:
+    # Only the parts of the configuration the stage uses
+    return SimpleNamespace(
+        compression=CompressionConfig(
+            elements=elements, max_interval=max_interval, state_path=str(tmp_path / "compression.json")
+        ),
+        tempest=SimpleNamespace(
+            get_devices=lambda: [TempestDeviceConfig("1", "Roof")],
+            elements=["pressure", "air_temperature"],
+            summaries=["pressure_trend"],
+        ),
+        external_id=lambda device_id, element: f"tempest:{device_id}:{element}",
+    )
+
+
+def stage(tmp_path, recording_queue, max_interval: int = 3600, **rules: CompressionElementConfig) -> CompressionStage:
+    return CompressionStage(recording_queue, make_config(tmp_path, rules, max_interval))
+
+
+def interpolate(stored: List[Any], timestamp: int) -> float:
+    for (t0, v0), (t1, v1) in zip(stored, stored[1:]):
+        if t0 <= timestamp <= t1:
+            return v0 + (v1 - v0) * (timestamp - t0) / (t1 - t0)
+    raise AssertionError(f"{timestamp} is outside the stored points")
+
+
+def test_deadband_stores_changes_beyond_the_tolerance(tmp_path, recording_queue):
+    compression = stage(tmp_path, recording_queue, air_temperature=CompressionElementConfig("deadband", 0.5))
+    values = [20.0, 20.2, 20.4, 20.6, 20.7, 19.9]
+    compression.add_to_upload_queue("tempest:1:air_temperature", [(i * MINUTE, v) for i, v in enumerate(values)])
+    assert recording_queue.datapoints["tempest:1:air_temperature"] == [
+        (0, 20.0),
+        (3 * MINUTE, 20.6),
+        (5 * MINUTE, 19.9),
+    ]
+    assert compression.ratio() == 2
+
+
+def test_swinging_door_stores_where_the_door_closes(tmp_path, recording_queue):
+    compression = stage(tmp_path, recording_queue, pressure=CompressionElementConfig("swinging-door", 0.1))
+    # A ramp, then flat
+    values = [1000.0 + i for i in range(10)] + [1009.0] * 10
+    datapoints = [(i * MINUTE, v) for i, v in enumerate(values)]
+    compression.add_to_upload_queue("tempest:1:pressure", datapoints)
+    stored = recording_queue.datapoints["tempest:1:pressure"]
+    assert stored == [(0, 1000.0), (9 * MINUTE, 1009.0)]
+    # The last point is only stored when the door closes or max_interval passes
+    for timestamp, value in datapoints[:10]:
+        assert abs(interpolate(stored, timestamp) - value) <= 0.1
+
+
+def test_max_interval_keeps_the_point_where_the_door_closed(tmp_path, recording_queue):
+    compression = stage(tmp_path, recording_queue, pressure=CompressionElementConfig("swinging-door", 0.1))
+    datapoints = [(i * MINUTE, 0.0) for i in range(60)] + [(60 * MINUTE, 10.0)]
+    compression.add_to_upload_queue("tempest:1:pressure", datapoints)
+    stored = recording_queue.datapoints["tempest:1:pressure"]
+    assert stored == [(0, 0.0), (59 * MINUTE, 0.0), (60 * MINUTE, 10.0)]
+    for timestamp, value in datapoints:
+        assert abs(interpolate(stored, timestamp) - value) <= 0.1
+
+
+def test_max_interval_stores_unchanged_values(tmp_path, recording_queue):
+    compression = stage(
+        tmp_path, recording_queue, max_interval=60 * 60, air_temperature=CompressionElementConfig("deadband", 1)
+    )
+    compression.add_to_upload_queue("tempest:1:air_temperature", [(i * 30 * MINUTE, 20.0) for i in range(5)])
+    assert [t for t, _ in recording_queue.datapoints["tempest:1:air_temperature"]] == [0, 60 * MINUTE, 120 * MINUTE]
+
+
+def test_strings_are_stored_on_change(tmp_path, recording_queue):
+    compression = stage(tmp_path, recording_queue)
+    values = ["steady", "steady", "rising", "rising", "steady"]
+    compression.add_to_upload_queue("tempest:1:pressure_trend", [(i * MINUTE, v) for i, v in enumerate(values)])
+    assert recording_queue.datapoints["tempest:1:pressure_trend"] == [
+        (0, "steady"),
+        (2 * MINUTE, "rising"),
+        (4 * MINUTE, "steady"),
+    ]
+
+
+def test_numeric_rules_for_strings_are_rejected(tmp_path, recording_queue):
+    with pytest.raises(ValueError, match="pressure_trend"):
+        stage(tmp_path, recording_queue, pressure_trend=CompressionElementConfig("deadband", 1))
+
+
+def test_late_and_other_data_points_pass(tmp_path, recording_queue):
+    compression = stage(tmp_path, recording_queue, air_temperature=CompressionElementConfig("deadband", 5))
+    compression.add_to_upload_queue("tempest:1:air_temperature", [(MINUTE, 20.0), (2 * MINUTE, 20.0)])
+    # Backfilled data, older than the last point received
+    compression.add_to_upload_queue("tempest:1:air_temperature", [(0, 20.0)])
+    compression.add_to_upload_queue("tempest:1:lux", [(0, 1.0), (MINUTE, 1.0)])
+    assert recording_queue.datapoints["tempest:1:air_temperature"] == [(MINUTE, 20.0), (0, 20.0)]
+    assert recording_queue.datapoints["tempest:1:lux"] == [(0, 1.0), (MINUTE, 1.0)]
+
+
+def test_state_is_saved_and_loaded(tmp_path, recording_queue):
+    rule = CompressionElementConfig("deadband", 0.5)
+    compression = stage(tmp_path, recording_queue, air_temperature=rule)
+    compression.add_to_upload_queue("tempest:1:air_temperature", [(0, 20.0)])
+    compression.close()
+    compression = stage(tmp_path, recording_queue, air_temperature=rule)
+    compression.add_to_upload_queue("tempest:1:air_temperature", [(MINUTE, 20.2), (2 * MINUTE, 21.0)])
+    assert recording_queue.datapoints["tempest:1:air_temperature"] == [(0, 20.0), (2 * MINUTE, 21.0)]
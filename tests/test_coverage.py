@@ -0,0 +1,59 @@
+from tempest_extractor.tempest_coverage import CoverageIndex
+
+
+def index(tmp_path, max_spacing: int = 180) -> CoverageIndex:
+    return CoverageIndex(str(tmp_path / "coverage.json"), max_spacing)
+
+
+def test_close_ranges_are_merged(tmp_path):
+    coverage = index(tmp_path)
+    coverage.add("a", 1000, 2000)
+    coverage.add("a", 5000, 6000)
+    # Within max_spacing of both neighbours
+    coverage.add("a", 2100, 4900)
+    assert coverage.intervals("a") == [(1000, 6000)]
+    coverage.add("a", 500, 1500)
+    assert coverage.intervals("a") == [(500, 6000)]
+
+
+def test_timestamps_are_indexed_as_runs(tmp_path):
+    coverage = index(tmp_path)
+    coverage.add_timestamps("a", [600, 0, 60, 120, 1000, 1060])
+    assert coverage.intervals("a") == [(0, 120), (600, 600), (1000, 1060)]
+
+
+def test_gaps_are_holes_between_intervals_newest_first(tmp_path):
+    coverage = index(tmp_path)
+    coverage.seed("a", [(0, 1000), (2000, 3000), (3500, 4000), (10000, 11000)])
+    assert coverage.gaps("a", before=20000, min_gap=300) == [(4000, 10000), (3000, 3500), (1000, 2000)]
+    # Short holes, and holes ending after the given epoch, are left alone
+    assert coverage.gaps("a", before=5000, min_gap=600) == [(1000, 2000)]
+    # Nothing before the first or after the last interval is a hole
+    assert coverage.gaps("b", before=20000, min_gap=0) == []
+
+
+def test_uploaded_data_points_are_indexed_per_device(tmp_path):
+    coverage = index(tmp_path)
+    uploaded = [
+        {"externalId": "tempest:1:air_temperature", "datapoints": [(60000, 1.0), (120000, 2.0)]},
+        {"externalId": "tempest:1:pressure", "datapoints": [(180000, 1.0)]},
+        {"externalId": "other", "datapoints": [(60000, 1.0)]},
+    ]
+    coverage.add_uploaded(uploaded, {"tempest:1:air_temperature": "1", "tempest:1:pressure": "1"})
+    assert coverage.intervals("1") == [(60, 180)]
+    assert "other" not in coverage
+
+
+def test_index_is_saved_and_loaded(tmp_path):
+    coverage = index(tmp_path)
+    coverage.seed("a", [(0, 1000), (2000, 3000)])
+    coverage.seed("b", [])
+    coverage.save()
+    loaded = index(tmp_path)
+    assert loaded.intervals("a") == [(0, 1000), (2000, 3000)]
+    assert "b" in loaded
+
+
+def test_unreadable_index_is_ignored(tmp_path):
+    (tmp_path / "coverage.json").write_text("{")
+    assert index(tmp_path).intervals("a") == []
@@ -0,0 +1,52 @@
+import json
+import random
+
+import pytest
+
+from benchmarks.frames import historical_response, summary, websocket_frames
+from tempest_extractor import tempest_decoding
+from tempest_extractor.tempest_dataclasses import TempestObsSummary
+from tempest_extractor.tempest_decoding import dumps, loads, record_decoder
+
+FRAMES = [frame for _, frame in websocket_frames(devices=3, seconds=120)] + [
+    json.dumps(historical_response(1234, days=1)),
+    # Escapes, unicode, nesting and numbers json.loads reads as int or float
+    json.dumps({"type": "ack", "id": 'æøå ☃ "quoted"', "nested": [[1, -2.5e-3, None, True], {}], "big": 2**53}),
+]
+
+
+@pytest.fixture(params=["fallback", "orjson"])
+def decoder(request, monkeypatch) -> str:
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(tempest_decoding, "orjson", None)
+    return request.param
+
+
+def test_loads_matches_json(decoder):
+    for frame in FRAMES:
+        assert loads(frame) == json.loads(frame)
+        assert loads(frame.encode()) == json.loads(frame)
+
+
+def test_dumps_round_trips(decoder):
+    for frame in FRAMES:
+        assert json.loads(dumps(json.loads(frame))) == json.loads(frame)
+
+
+def test_loads_rejects_invalid_json(decoder):
+    with pytest.raises(ValueError):
+        loads(b"{not json")
+
+
+def test_record_decoder_matches_the_schema():
+    decode = record_decoder(TempestObsSummary)
+    schema = TempestObsSummary.schema()
+    for seed in range(20):
+        message = summary(random.Random(seed))
+        assert decode(message) == schema.load(message)
+    # Keys that are not fields are ignored, and missing fields are None, where the schema would reject the message
+    decoded = decode({"feels_like": 12.5, "not_a_field": 1})
+    assert decoded.feels_like == 12.5 and decoded.dew_point is None
+    assert not hasattr(decoded, "not_a_field")
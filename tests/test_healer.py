@@ -0,0 +1,132 @@
+import random
+import time
+from types import SimpleNamespace
+from typing import Any, List, Tuple
+
+import arrow
+
+from benchmarks.frames import obs_st_row
+from tempest_extractor.config import ExtractorConfig, TempestConfig, TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_healer import GapHealer
+
+
+def make_config(heal_after: int = 90) -> YamlConfig:
+    tempest = TempestConfig(
+        token="",
+        elements=["air_temperature"],
+        summaries=[],
+        devices=[TempestDeviceConfig("1234", "Roof")],
+        heal_after=heal_after,
+    )
+    return YamlConfig(
+        version=None,
+        type=None,
+        # Only the external ID prefix is used on the ingest path
+        cognite=SimpleNamespace(external_id_prefix="tempest:"),
+        logger=None,
+        tempest=tempest,
+        extractor=ExtractorConfig(parallelism=1),
+    )
+
+
+def observe(collector: TempestCollector, *epochs: int) -> None:
+    for epoch in epochs:
+        message = {"type": "obs_st", "device_id": 1234, "obs": [obs_st_row(epoch, random.Random(epoch))]}
+        collector.collect(message, time.perf_counter())
+
+
+def collector_with_healer(config: YamlConfig) -> Tuple[TempestCollector, List[Tuple[str, int, int]]]:
+    collector = TempestCollector(config.tempest)
+    healed: List[Tuple[str, int, int]] = []
+    collector.healer = lambda device_id, start, end: healed.append((device_id, start, end))
+    return collector, healed
+
+
+def test_short_blip_heals_the_missed_observation():
+    collector, healed = collector_with_healer(make_config())
+    now = arrow.utcnow().int_timestamp
+    # One minute report interval, and one observation missed, well within heal_after
+    observe(collector, now - 140, now - 80)
+    collector.connected()
+    assert len(healed) == 1
+    device_id, start, end = healed[0]
+    assert (device_id, start) == ("1234", now - 79)
+    assert end >= now
+
+
+def test_no_heal_within_the_report_interval():
+    collector, healed = collector_with_healer(make_config())
+    now = arrow.utcnow().int_timestamp
+    observe(collector, now - 70, now - 10)
+    collector.connected()
+    assert healed == []
+
+
+def test_heal_after_is_used_until_the_report_interval_is_known():
+    collector, healed = collector_with_healer(make_config())
+    now = arrow.utcnow().int_timestamp
+    observe(collector, now - 80)
+    collector.connected()
+    assert healed == []
+    # Devices never heard from have nothing to heal from
+    collector.last_epochs.clear()
+    collector.connected()
+    assert healed == []
+
+    collector, healed = collector_with_healer(make_config())
+    observe(collector, now - 120)
+    collector.connected()
+    assert [device_id for device_id, _, _ in healed] == ["1234"]
+
+
+def test_heal_after_zero_turns_healing_off():
+    collector, healed = collector_with_healer(make_config(heal_after=0))
+    now = arrow.utcnow().int_timestamp
+    observe(collector, now - 3600, now - 3540)
+    collector.connected()
+    assert healed == []
+
+
+def test_heal_is_clipped_to_live_data_and_attributed(recording_queue):
+    config = make_config()
+    collector = TempestCollector(config.tempest)
+    start = 1661673288
+    # Missed observations, and one already received live since the reconnect
+    missed = [start + 60 * i for i in range(4)]
+    observe(collector, start + 180)
+
+    def get_historical(device_id: str, **kwargs: Any):
+        assert (device_id, kwargs["time_start"]) == ("1234", start)
+        return collector._observations_from_response(
+            {"type": "obs_st", "obs": [obs_st_row(epoch, random.Random(epoch)) for epoch in missed]}
+        )
+
+    collector.get_historical = get_historical
+    healer = GapHealer(recording_queue, collector, config)
+    try:
+        healer._heal("1234", start, start + 300)
+    finally:
+        healer.close()
+    assert [t for t, _ in recording_queue.datapoints["tempest:1234:air_temperature"]] == [
+        epoch * 1000 for epoch in missed[:3]
+    ]
+    assert [source for source, _ in recording_queue.sources] == ["healer"]
+    assert healer.healed == 1
+
+
+def test_failed_heal_is_left_to_the_gap_filler(recording_queue):
+    config = make_config()
+    collector = TempestCollector(config.tempest)
+
+    def get_historical(device_id: str, **kwargs: Any):
+        raise ConnectionError("offline")
+
+    collector.get_historical = get_historical
+    healer = GapHealer(recording_queue, collector, config)
+    try:
+        healer._heal("1234", 0, 60)
+    finally:
+        healer.close()
+    assert recording_queue.datapoints == {}
+    assert healer.healed == 0
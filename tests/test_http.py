@@ -0,0 +1,103 @@
+import json
+import logging
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Iterator, List, Tuple
+
+import pytest
+
+from tempest_extractor.tempest_http import TempestApiError, TempestHttpClient
+
+TOKEN = "SECRETTOKEN"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Statuses to answer with, in order, the last one repeated
+    statuses: List[int] = [200]
+    requests: List[str] = []
+
+    def do_GET(self) -> None:
+        type(self).requests.append(self.path)
+        status = self.statuses[min(len(self.requests), len(self.statuses)) - 1]
+        body = json.dumps({"status": "ok"}).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def stub() -> Iterator[Tuple[str, type]]:
+    handler = type("Handler", (StubHandler,), {"statuses": [200], "requests": []})
+    server = HTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", handler
+    server.shutdown()
+    server.server_close()
+
+
+def extractor_logs(caplog) -> str:
+    # urllib3 logs full URLs at debug level, only the extractor's own log lines are checked
+    return "\n".join(r.getMessage() for r in caplog.records if r.name.startswith("tempest_extractor"))
+
+
+def client(url: str, max_retries: int = 2) -> TempestHttpClient:
+    return TempestHttpClient(url, TOKEN, timeout=2, max_retries=max_retries, backoff_factor=0.01)
+
+
+def test_get_sends_token_and_decodes(stub):
+    url, handler = stub
+    assert client(url).get("observations/", {"device_id": 1}) == {"status": "ok"}
+    assert f"token={TOKEN}" in handler.requests[0]
+
+
+def test_retries_then_succeeds(stub):
+    url, handler = stub
+    handler.statuses = [503, 429, 200]
+    assert client(url).get("stations") == {"status": "ok"}
+    assert len(handler.requests) == 3
+
+
+def test_client_error_is_not_retried_and_hides_token(stub, caplog):
+    url, handler = stub
+    handler.statuses = [401]
+    with caplog.at_level(logging.DEBUG), pytest.raises(TempestApiError) as error:
+        client(url).get("observations/", {"device_id": 1})
+    assert error.value.status == 401
+    assert len(handler.requests) == 1
+    assert TOKEN not in str(error.value)
+    assert error.value.__context__ is None
+    assert TOKEN not in extractor_logs(caplog)
+
+
+def test_exhausted_retries_hide_token(stub, caplog):
+    url, handler = stub
+    handler.statuses = [503]
+    with caplog.at_level(logging.DEBUG), pytest.raises(TempestApiError) as error:
+        client(url, max_retries=1).get("observations/", {"device_id": 1})
+    assert error.value.status == 503
+    assert len(handler.requests) == 2
+    assert TOKEN not in str(error.value)
+    assert TOKEN not in extractor_logs(caplog)
+
+
+def test_connection_error_hides_token(caplog):
+    # A port nothing listens on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    with caplog.at_level(logging.DEBUG), pytest.raises(TempestApiError) as error:
+        client(f"http://127.0.0.1:{port}", max_retries=1).get("observations/", {"device_id": 1})
+    assert error.value.reason == "ConnectionError"
+    # The requests exception holding the URL is not chained into tracebacks
+    assert error.value.__suppress_context__
+    assert TOKEN not in str(error.value)
+    assert TOKEN not in extractor_logs(caplog)
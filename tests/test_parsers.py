@@ -0,0 +1,74 @@
+import random
+
+import pytest
+
+from benchmarks.frames import obs_air_row, obs_sky_row, obs_st_row
+from tempest_extractor.tempest_dataclasses import TempestObservationBatch
+from tempest_extractor.tempest_parsers import PARSERS, ObservationParser, get_parser, register_parser
+
+
+def parse(message: dict) -> TempestObservationBatch:
+    batch = TempestObservationBatch()
+    get_parser(message["type"]).parse(message, batch)
+    return batch
+
+
+def test_registry_covers_the_message_types():
+    assert set(PARSERS) == {"obs_st", "obs_sky", "obs_air", "rapid_wind", "evt_strike"}
+    assert get_parser("device_status") is None
+
+
+def test_obs_st_columns():
+    rows = [obs_st_row(1661673288 + 60 * i, random.Random(i)) for i in range(3)]
+    batch = parse({"type": "obs_st", "obs": rows})
+    assert list(batch.epochs) == [row[0] for row in rows]
+    assert batch.datapoints("air_temperature") == [(row[0] * 1000, row[7]) for row in rows]
+    assert batch.datapoints("battery_volts") == [(row[0] * 1000, row[16]) for row in rows]
+    # Null in every row, and not reported by obs_st
+    assert batch.datapoints("nc_rain_accumulation") == []
+    assert batch.datapoints("rapid_wind_avg") == []
+
+
+@pytest.mark.parametrize(
+    "o_type, row, element, index",
+    [("obs_sky", obs_sky_row, "wind_direction", 7), ("obs_air", obs_air_row, "pressure", 1)],
+)
+def test_other_device_layouts(o_type, row, element, index):
+    rows = [row(1661673288, random.Random(0))]
+    assert parse({"type": o_type, "obs": rows}).datapoints(element) == [(1661673288000, rows[0][index])]
+
+
+def test_single_row_messages():
+    batch = parse({"type": "rapid_wind", "ob": [1661673288, 3.5, 270]})
+    assert batch.datapoints("rapid_wind_avg") == [(1661673288000, 3.5)]
+    assert batch.datapoints("rapid_wind_direction") == [(1661673288000, 270)]
+    batch = parse({"type": "evt_strike", "evt": [1661673288, 12, 3848]})
+    assert batch.datapoints("strike_distance") == [(1661673288000, 12)]
+
+
+def test_short_rows_are_padded():
+    # Older firmware sends fewer columns
+    batch = parse({"type": "obs_air", "obs": [[1661673288, 1012.5, 21.0, 60]]})
+    assert len(batch) == 1
+    assert batch.datapoints("relative_humidity") == [(1661673288000, 60)]
+    assert batch.datapoints("report_interval") == []
+
+
+def test_messages_without_rows_parse_nothing():
+    batch = TempestObservationBatch()
+    assert get_parser("obs_st").parse({"type": "obs_st", "obs": []}, batch) == 0
+    assert get_parser("obs_st").parse({"type": "obs_st"}, batch) == 0
+    assert len(batch) == 0
+
+
+def test_register_parser_replaces_existing(monkeypatch):
+    monkeypatch.setattr("tempest_extractor.tempest_parsers.PARSERS", dict(PARSERS))
+    register_parser(ObservationParser("obs_air", {"pressure": 2}))
+    assert parse({"type": "obs_air", "obs": [[1661673288, 1012.5, 21.0]]}).datapoints("pressure") == [
+        (1661673288000, 21.0)
+    ]
+
+
+def test_unknown_elements_are_rejected():
+    with pytest.raises(ValueError, match="wind_speed"):
+        ObservationParser("obs_new", {"wind_speed": 1})
@@ -0,0 +1,80 @@
+from typing import Any, List
+
+from cognite.extractorutils.statestore import LocalStateStore
+from prometheus_client import REGISTRY
+
+from tempest_extractor.tempest_metrics import datapoint_source
+from tempest_extractor.tempest_pipeline import DedupFilter, SourceCounter
+
+
+def dedup(tmp_path, queue, recent_size: int = 2048):
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    return DedupFilter(queue, states, recent_size), states, queue
+
+
+def test_drops_data_points_inside_the_state_range(tmp_path, recording_queue):
+    stage, states, queue = dedup(tmp_path, recording_queue)
+    states.set_state("a", low=2000, high=4000)
+    stage.add_to_upload_queue("a", [(1000, 1.0), (2000, 2.0), (3000, 3.0), (4000, 4.0), (5000, 5.0)])
+    assert queue.datapoints["a"] == [(1000, 1.0), (5000, 5.0)]
+    assert (stage.passed, stage.dropped) == (2, 3)
+
+
+def test_time_series_without_state_pass(tmp_path, recording_queue):
+    stage, states, queue = dedup(tmp_path, recording_queue)
+    states.set_state("a", low=0, high=10000)
+    stage.add_to_upload_queue("b", [(1000, 1.0)])
+    assert queue.datapoints == {"b": [(1000, 1.0)]}
+
+
+def test_drops_recent_data_points_before_the_state_moves(tmp_path, recording_queue):
+    stage, _, queue = dedup(tmp_path, recording_queue)
+    # The streamer and a filler hand on overlapping data before anything is uploaded
+    stage.add_to_upload_queue("a", [(1000, 1.0), (2000, 2.0)])
+    stage.add_to_upload_queue("a", [(2000, 2.0), (3000, 3.0)])
+    assert queue.datapoints["a"] == [(1000, 1.0), (2000, 2.0), (3000, 3.0)]
+    # Recent timestamps are per time series
+    stage.add_to_upload_queue("b", [(2000, 2.0)])
+    assert queue.datapoints["b"] == [(2000, 2.0)]
+
+
+def test_recent_timestamps_are_bounded(tmp_path, recording_queue):
+    stage, _, queue = dedup(tmp_path, recording_queue, recent_size=2)
+    stage.add_to_upload_queue("a", [(1000, 1.0), (2000, 2.0), (3000, 3.0)])
+    # Only the 2 most recent are remembered
+    stage.add_to_upload_queue("a", [(1000, 1.0), (3000, 3.0)])
+    assert queue.datapoints["a"] == [(1000, 1.0), (2000, 2.0), (3000, 3.0), (1000, 1.0)]
+
+
+def test_nothing_is_handed_on_when_all_are_dropped(tmp_path):
+    class FailingQueue:
+        def add_to_upload_queue(self, external_id: str, datapoints: List[Any]) -> None:
+            raise AssertionError("called with no data points")
+
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    states.set_state("a", low=0, high=10000)
+    DedupFilter(FailingQueue(), states).add_to_upload_queue("a", [(1000, 1.0)])
+
+
+def uploaded(source: str) -> float:
+    return REGISTRY.get_sample_value("tempest_extractor_datapoints_uploaded_total", {"source": source}) or 0
+
+
+def test_uploads_are_counted_per_source_in_order(recording_queue):
+    queue = recording_queue
+    counter = SourceCounter(queue)
+    before = {source: uploaded(source) for source in ("test-live", "test-fill", "unknown")}
+    with datapoint_source("test-live"):
+        counter.add_to_upload_queue("a", [(1000, 1.0), (2000, 2.0)])
+        counter.add_to_upload_queue("b", [(1000, 1.0)])
+    with datapoint_source("test-fill"):
+        counter.add_to_upload_queue("a", [(500, 1.0)] * 4)
+    assert queue.datapoints["a"][:2] == [(1000, 1.0), (2000, 2.0)]
+    assert counter.upload_queue_size == 7
+
+    counter.uploaded(5)
+    counter.uploaded(3)
+    assert uploaded("test-live") - before["test-live"] == 3
+    assert uploaded("test-fill") - before["test-fill"] == 4
+    # More than was added, from outside the stages
+    assert uploaded("unknown") - before["unknown"] == 1
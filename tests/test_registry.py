@@ -0,0 +1,70 @@
+import time
+
+from cognite.client.data_classes import TimeSeries
+
+from tempest_extractor.tempest_registry import ProvisioningRegistry, fingerprint
+
+EXTERNAL_ID = "tempest:1234"
+
+
+def station_asset(name: str = "Roof", latitude: float = 59.9, longitude: float = 10.7) -> dict:
+    # Like the dump of the asset created for a device, with the name and location of its station
+    return {
+        "external_id": EXTERNAL_ID,
+        "name": name,
+        "metadata": {"latitude": str(latitude), "longitude": str(longitude), "device_id": "1234"},
+    }
+
+
+def test_unchanged_asset_is_a_hit_after_a_restart(tmp_path):
+    registry = ProvisioningRegistry(str(tmp_path / "provisioned.json"))
+    key = fingerprint(station_asset())
+    assert registry.asset_id(EXTERNAL_ID, key) is None
+    registry.add_asset(EXTERNAL_ID, key, 42)
+    registry.save()
+
+    registry = ProvisioningRegistry(str(tmp_path / "provisioned.json"))
+    assert registry.asset_id(EXTERNAL_ID, fingerprint(station_asset())) == 42
+
+
+def test_renamed_or_moved_station_is_a_miss(tmp_path):
+    registry = ProvisioningRegistry(str(tmp_path / "provisioned.json"))
+    registry.add_asset(EXTERNAL_ID, fingerprint(station_asset()), 42)
+    assert registry.asset_id(EXTERNAL_ID, fingerprint(station_asset(name="Garden"))) is None
+    assert registry.asset_id(EXTERNAL_ID, fingerprint(station_asset(latitude=60.1))) is None
+    assert registry.asset_id("tempest:5678", fingerprint(station_asset())) is None
+
+
+def test_entries_expire_after_max_age(tmp_path, monkeypatch):
+    registry = ProvisioningRegistry(str(tmp_path / "provisioned.json"), max_age=60)
+    key = fingerprint(station_asset())
+    time_series = [TimeSeries(external_id=f"{EXTERNAL_ID}:air_temperature", name="Air temperature")]
+    registry.add_asset(EXTERNAL_ID, key, 42)
+    registry.add_time_series(time_series)
+    now = time.time()
+    monkeypatch.setattr("tempest_extractor.tempest_registry.time.time", lambda: now + 30)
+    assert registry.asset_id(EXTERNAL_ID, key) == 42
+    assert registry.missing_time_series(time_series) == []
+
+    monkeypatch.setattr("tempest_extractor.tempest_registry.time.time", lambda: now + 90)
+    assert registry.asset_id(EXTERNAL_ID, key) is None
+    assert registry.missing_time_series(time_series) == time_series
+
+
+def test_changed_time_series_and_cleared_registry_are_misses(tmp_path):
+    registry = ProvisioningRegistry(str(tmp_path / "provisioned.json"))
+    time_series = TimeSeries(external_id=f"{EXTERNAL_ID}:air_temperature", name="Air temperature", unit="C")
+    registry.add_time_series([time_series])
+    renamed = TimeSeries(external_id=f"{EXTERNAL_ID}:air_temperature", name="Temperature", unit="C")
+    assert registry.missing_time_series([time_series, renamed]) == [renamed]
+
+    registry.add_asset(EXTERNAL_ID, fingerprint(station_asset()), 42)
+    registry.clear()
+    assert registry.asset_id(EXTERNAL_ID, fingerprint(station_asset())) is None
+    assert registry.missing_time_series([time_series]) == [time_series]
+
+
+def test_unreadable_registry_is_ignored(tmp_path):
+    (tmp_path / "provisioned.json").write_text("{not json")
+    registry = ProvisioningRegistry(str(tmp_path / "provisioned.json"))
+    assert registry.asset_id(EXTERNAL_ID, fingerprint(station_asset())) is None
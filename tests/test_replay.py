@@ -0,0 +1,79 @@
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from benchmarks.frames import obs_st_row
+from tempest_extractor.config import ExtractorConfig, TempestConfig, TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_replay import FrameRecorder, FrameReplayer, read_frames
+from tempest_extractor.tempest_streamer import Streamer
+
+EPOCHS = [1661673288 + 60 * i for i in range(5)]
+
+
+def make_config() -> YamlConfig:
+    tempest = TempestConfig(
+        token="", elements=["air_temperature"], summaries=[], devices=[TempestDeviceConfig("1234", "Roof")]
+    )
+    return YamlConfig(
+        version=None,
+        type=None,
+        # Only the external ID prefix is used on the ingest path
+        cognite=SimpleNamespace(external_id_prefix="tempest:"),
+        logger=None,
+        tempest=tempest,
+        extractor=ExtractorConfig(streaming_mode="push", flush_size=1, flush_linger=0.01),
+    )
+
+
+def frame(epoch: int) -> str:
+    # Pretty printed, like some proxies forward frames
+    message = {"type": "obs_st", "device_id": 1234, "obs": [obs_st_row(epoch, random.Random(epoch))]}
+    return json.dumps(message, indent=2)
+
+
+def record(path: str, max_size: int = 1024 * 1024) -> None:
+    recorder = FrameRecorder(path, max_size=max_size, max_files=10)
+    try:
+        for epoch in EPOCHS:
+            recorder.record(frame(epoch))
+    finally:
+        recorder.close()
+
+
+def test_recorded_frames_replay_through_the_pipeline(tmp_path, recording_queue):
+    # Small files, so the recording is rotated and replayed across files
+    record(str(tmp_path), max_size=1)
+    assert [json.loads(recorded)["obs"][0][0] for _, recorded in read_frames(str(tmp_path))] == EPOCHS
+
+    config = make_config()
+    collector = TempestCollector(config.tempest)
+    stop = threading.Event()
+    streamer = threading.Thread(target=Streamer(recording_queue, stop, collector, config).run)
+    streamer.start()
+    try:
+        replayer = FrameReplayer(collector, str(tmp_path), stop, speed=0)
+        replayer.run()
+        assert replayer.replayed == len(EPOCHS)
+        deadline = time.monotonic() + 5
+        while len(recording_queue.datapoints.get("tempest:1234:air_temperature", [])) < len(EPOCHS):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        streamer.join()
+    assert [t for t, _ in recording_queue.datapoints["tempest:1234:air_temperature"]] == [
+        epoch * 1000 for epoch in EPOCHS
+    ]
+
+
+def test_truncated_recording_is_read_up_to_the_last_complete_frame(tmp_path):
+    record(str(tmp_path))
+    (recording,) = tmp_path.iterdir()
+    # Cut short in the gzip trailer, as by a crash before the file was closed
+    recording.write_bytes(recording.read_bytes()[:-8])
+    frames = list(read_frames(str(recording)))
+    assert frames
+    assert [json.loads(recorded)["obs"][0][0] for _, recorded in frames] == EPOCHS[: len(frames)]
@@ -0,0 +1,131 @@
+import random
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import pytest
+
+from tempest_extractor.config import RollingConfig, TempestDeviceConfig
+from tempest_extractor.tempest_rolling import SLACK, STATISTICS, RollingFeed, RollingStatistics
+
+MINUTE = 60 * 1000
+HOUR = 60 * MINUTE
+
+
+def rolling(tmp_path, *statistics: str) -> RollingStatistics:
+    # Only the parts of the configuration the statistics use
+    config = SimpleNamespace(
+        rolling=RollingConfig(statistics=list(statistics), state_path=str(tmp_path / "rolling.json")),
+        tempest=SimpleNamespace(get_devices=lambda: [TempestDeviceConfig("1", "Roof")]),
+        external_id=lambda device_id, element: f"tempest:{device_id}:{element}",
+    )
+    return RollingStatistics(config)
+
+
+def expected(name: str, datapoints: List[Tuple[int, float]], timestamp: int) -> Optional[float]:
+    """
+    The statistic at a timestamp, computed from scratch.
+    """
+    statistic = STATISTICS[name]
+    start = timestamp - statistic.window * 1000
+    if datapoints[0][0] > start + SLACK:
+        return None
+    values = [v for t, v in datapoints if start < t <= timestamp]
+    if statistic.kind == "sum":
+        return round(sum(values), 6)
+    if statistic.kind == "min":
+        return min(values)
+    if statistic.kind == "max":
+        return max(values)
+    before = [(t, v) for t, v in datapoints if t <= start]
+    reference_time, reference = before[-1] if before else next((t, v) for t, v in datapoints if t > start)
+    if abs(reference_time - start) > SLACK:
+        return None
+    return round(dict(datapoints)[timestamp] - reference, 6)
+
+
+def series(step: int, hours: int, seed: int = 0) -> List[Tuple[int, float]]:
+    generator = random.Random(seed)
+    return [(t, round(generator.uniform(0, 10), 2)) for t in range(0, hours * HOUR + 1, step)]
+
+
+@pytest.mark.parametrize(
+    "name, element",
+    [
+        ("rain_accumulation_1h", "rain_accumulation"),
+        ("wind_gust_max_1h", "wind_gust"),
+        ("air_temperature_min_24h", "air_temperature"),
+        ("pressure_change_3h", "pressure"),
+    ],
+)
+def test_statistics_match_computing_from_scratch(tmp_path, name, element):
+    statistics = rolling(tmp_path, name)
+    datapoints = series(5 * MINUTE, 27)
+    derived = []
+    # In batches, as the streamer hands them over
+    for i in range(0, len(datapoints), 7):
+        derived.extend(statistics.update("1", {element: datapoints[i : i + 7]}).get(name, []))
+    want = [(t, expected(name, datapoints, t)) for t, _ in datapoints]
+    assert derived == [(t, value) for t, value in want if value is not None]
+    assert derived
+
+
+def test_change_needs_a_point_from_a_window_ago(tmp_path):
+    statistics = rolling(tmp_path, "pressure_change_3h")
+    statistics.update("1", {"pressure": [(0, 1000.0)]})
+    assert statistics.update("1", {"pressure": [(3 * HOUR, 1003.5)]}) == {"pressure_change_3h": [(3 * HOUR, 3.5)]}
+    # Quiet from one to four hours, there is nothing to compare with three hours later
+    assert statistics.update("1", {"pressure": [(4 * HOUR + 30 * MINUTE, 1004.0)]}) == {}
+
+
+def test_late_points_are_merged_and_statistics_computed_again(tmp_path):
+    statistics = rolling(tmp_path, "rain_accumulation_1h", "wind_gust_max_1h")
+    datapoints = series(MINUTE, 3, seed=1)
+    # Live data with a 20 minute outage, healed afterwards
+    missed = [(t, v) for t, v in datapoints if 2 * HOUR < t <= 2 * HOUR + 20 * MINUTE]
+    live = [point for point in datapoints if point not in missed]
+    data = {"rain_accumulation": live, "wind_gust": live}
+    statistics.update("1", data)
+
+    data = {"rain_accumulation": missed, "wind_gust": missed}
+    derived = statistics.update("1", data)
+    for name in ("rain_accumulation_1h", "wind_gust_max_1h"):
+        # From the first missed point, up to the newest point
+        assert derived[name] == [(t, expected(name, datapoints, t)) for t, _ in datapoints if t >= missed[0][0]]
+    assert statistics.late == 0
+
+
+def test_points_older_than_a_window_and_duplicates_are_ignored(tmp_path):
+    statistics = rolling(tmp_path, "rain_accumulation_1h")
+    statistics.update("1", {"rain_accumulation": [(t, 1.0) for t in range(0, 3 * HOUR + 1, MINUTE)]})
+    assert statistics.update("1", {"rain_accumulation": [(HOUR, 5.0), (3 * HOUR, 5.0)]}) == {}
+    assert statistics.late == 2
+
+
+def test_windows_are_continued_after_a_restart(tmp_path):
+    datapoints = series(5 * MINUTE, 3, seed=2)
+    statistics = rolling(tmp_path, "wind_gust_max_1h")
+    statistics.update("1", {"wind_gust": datapoints[:20]})
+    statistics.close()
+    statistics = rolling(tmp_path, "wind_gust_max_1h")
+    derived = statistics.update("1", {"wind_gust": datapoints[20:]})["wind_gust_max_1h"]
+    assert derived == [(t, expected("wind_gust_max_1h", datapoints, t)) for t, _ in datapoints[20:]]
+
+
+def test_feed_puts_statistics_computed_again_in_the_derived_queue(tmp_path, make_queue):
+    statistics = rolling(tmp_path, "rain_accumulation_1h")
+    missed = 90 * MINUTE
+    rain = [(t, 1.0) for t in range(0, 2 * HOUR + 1, 10 * MINUTE) if t != missed]
+    statistics.update("1", {"rain_accumulation": rain})
+    queue, derived = make_queue(), make_queue()
+    feed = RollingFeed(queue, statistics, derived)
+    feed.add_to_upload_queue("tempest:1:rain_accumulation", [(missed, 2.0)])
+    feed.add_to_upload_queue("tempest:1:air_temperature", [(missed, 20.0)])
+
+    assert queue.datapoints == {
+        "tempest:1:rain_accumulation": [(missed, 2.0)],
+        "tempest:1:air_temperature": [(missed, 20.0)],
+    }
+    # Six points an hour, one of them the missed one
+    assert derived.datapoints == {
+        "tempest:1:rain_accumulation_1h": [(t, 7.0) for t in range(missed, 2 * HOUR + 1, 10 * MINUTE)]
+    }
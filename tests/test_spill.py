@@ -0,0 +1,135 @@
+import threading
+import time
+from typing import Any, Callable, List
+
+import pytest
+
+from tempest_extractor.tempest_metrics import datapoint_source
+from tempest_extractor.tempest_spill import SpillStage
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def stop():
+    stop = threading.Event()
+    yield stop
+    stop.set()
+
+
+def spill_stage(tmp_path, stop: threading.Event, queue: Any, max_datapoints: int = 4) -> SpillStage:
+    return SpillStage(queue, str(tmp_path), max_datapoints, segment_size=1024, drain_rate=100000, stop=stop)
+
+
+@pytest.fixture
+def first_run(tmp_path, make_queue):
+    # Stopped, and without room, so everything is spilled and nothing drained
+    stopped = threading.Event()
+    stopped.set()
+    return spill_stage(tmp_path, stopped, make_queue(), max_datapoints=0)
+
+
+def points(*timestamps: int) -> List[Any]:
+    return [(timestamp, float(timestamp)) for timestamp in timestamps]
+
+
+def test_data_points_pass_while_the_queue_has_room(tmp_path, stop, recording_queue):
+    queue = recording_queue
+    stage = spill_stage(tmp_path, stop, queue)
+    stage.add_to_upload_queue("a", points(1, 2, 3))
+    assert queue.datapoints == {"a": points(1, 2, 3)}
+    assert stage.spilled == 0
+    assert not list(tmp_path.iterdir())
+
+
+def test_spills_when_full_and_drains_in_order(tmp_path, stop, recording_queue):
+    queue = recording_queue
+    stage = spill_stage(tmp_path, stop, queue)
+    stage.add_to_upload_queue("a", points(1, 2, 3))
+    stage.add_to_upload_queue("a", points(6, 7))
+    # Once anything is on disk, newer data goes there too, so nothing overtakes it
+    stage.add_to_upload_queue("a", points(4, 5))
+    assert stage.spilled == 4
+    assert queue.datapoints["a"] == points(1, 2, 3)
+    segments = list(tmp_path.iterdir())
+    assert len(segments) == 1
+
+    queue.upload()
+    stage.confirm_upload()
+    assert wait_for(lambda: len(queue.datapoints["a"]) == 7)
+    # Fed back sorted by time
+    assert queue.datapoints["a"] == points(1, 2, 3, 4, 5, 6, 7)
+    # Kept until an upload including it has completed
+    assert segments[0].exists()
+    stage.confirm_upload()
+    assert not segments[0].exists()
+
+
+def test_drains_segments_left_by_an_earlier_run(tmp_path, stop, first_run, recording_queue):
+    first = first_run
+    first.add_to_upload_queue("a", points(1, 2))
+    first.close()
+    assert len(list(tmp_path.iterdir())) == 1
+
+    queue = recording_queue
+    spill_stage(tmp_path, stop, queue)
+    assert wait_for(lambda: queue.datapoints.get("a") == points(1, 2))
+
+
+def test_truncated_segments_are_drained_up_to_the_damage(tmp_path, stop, first_run, recording_queue):
+    first = first_run
+    first.add_to_upload_queue("a", points(1, 2))
+    first.add_to_upload_queue("a", points(3, 4))
+    first.close()
+    segment = next(tmp_path.iterdir())
+    segment.write_bytes(segment.read_bytes()[:-5])
+
+    queue = recording_queue
+    spill_stage(tmp_path, stop, queue)
+    assert wait_for(lambda: queue.datapoints.get("a") == points(1, 2))
+
+
+def test_spilled_data_points_keep_their_source(tmp_path, stop, first_run, recording_queue):
+    first = first_run
+    with datapoint_source("healer"):
+        first.add_to_upload_queue("a", points(1, 2))
+    first.add_to_upload_queue("a", points(3))
+    first.close()
+
+    spill_stage(tmp_path, stop, recording_queue)
+    assert wait_for(lambda: len(recording_queue.sources) == 2)
+    assert sorted(recording_queue.sources) == [("healer", [1, 2]), ("unknown", [3])]
+
+
+def test_spills_while_an_upload_holds_the_queue(tmp_path, stop, recording_queue, monkeypatch):
+    monkeypatch.setattr("tempest_extractor.tempest_spill.BUSY_WAIT", 0.01)
+    queue_lock = threading.RLock()
+    uploading, uploaded = threading.Event(), threading.Event()
+
+    def upload():
+        with queue_lock:
+            uploading.set()
+            uploaded.wait(5)
+
+    threading.Thread(target=upload).start()
+    assert uploading.wait(5)
+    stage = SpillStage(
+        recording_queue, str(tmp_path), 100, segment_size=1024, drain_rate=100000, stop=stop, queue_lock=queue_lock
+    )
+    try:
+        started = time.monotonic()
+        stage.add_to_upload_queue("a", points(1, 2))
+        assert time.monotonic() - started < 1
+        assert stage.spilled == 2
+        assert not recording_queue.datapoints
+    finally:
+        uploaded.set()
+    # Drained once the upload is done
+    assert wait_for(lambda: recording_queue.datapoints.get("a") == points(1, 2))
@@ -0,0 +1,103 @@
+import json
+
+from tempest_extractor.tempest_statestore import LogStateStore
+
+
+def store(tmp_path, **kwargs) -> LogStateStore:
+    states = LogStateStore(str(tmp_path / "states.json"), **kwargs)
+    states.initialize()
+    return states
+
+
+def log_lines(tmp_path) -> list:
+    return (tmp_path / "states.json.log").read_text().splitlines()
+
+
+def test_changes_are_appended_and_replayed(tmp_path):
+    states = store(tmp_path)
+    states.set_state("a", low=1, high=2)
+    states.set_state("b", low=3, high=4)
+    states.synchronize()
+    states.expand_state("a", high=5)
+    states.delete_state("b")
+    states.synchronize()
+    assert [json.loads(line)["sequence"] for line in log_lines(tmp_path)] == [1, 2]
+    # Nothing pending, nothing appended
+    states.synchronize()
+    assert len(log_lines(tmp_path)) == 2
+
+    loaded = store(tmp_path)
+    assert loaded.get_state("a") == (1, 5)
+    assert loaded.get_state("b") == (None, None)
+    assert len(loaded) == 1
+
+
+def test_unchanged_states_are_not_appended(tmp_path):
+    states = store(tmp_path)
+    states.set_state("a", low=1, high=2)
+    states.synchronize()
+    states.set_state("a", low=1, high=2)
+    states.expand_state("a", low=2, high=1)
+    states.synchronize()
+    assert len(log_lines(tmp_path)) == 1
+
+
+def test_max_pending_appends_right_away(tmp_path):
+    states = store(tmp_path, max_pending=2)
+    states.set_state("a", low=1, high=2)
+    assert not (tmp_path / "states.json.log").read_text()
+    states.set_state("b", low=1, high=2)
+    assert len(log_lines(tmp_path)) == 1
+
+
+def test_log_is_compacted_into_the_snapshot(tmp_path):
+    states = store(tmp_path, compact_bytes=200)
+    for i in range(20):
+        states.set_state(f"key-{i}", low=i, high=i)
+        states.synchronize()
+    snapshot = json.loads((tmp_path / "states.json").read_text())
+    assert snapshot["sequence"] > 1
+    assert len(log_lines(tmp_path)) < 20
+
+    loaded = store(tmp_path)
+    assert len(loaded) == 20
+    assert loaded.get_state("key-19") == (19, 19)
+
+
+def test_log_lines_in_the_snapshot_are_skipped(tmp_path):
+    # A compaction interrupted after writing the snapshot, before emptying the log
+    (tmp_path / "states.json").write_text(json.dumps({"sequence": 1, "states": {"a": {"low": 5, "high": 6}}}))
+    (tmp_path / "states.json.log").write_text(
+        json.dumps({"sequence": 1, "changes": {"a": {"low": 1, "high": 2}}})
+        + "\n"
+        + json.dumps({"sequence": 2, "changes": {"b": {"low": 3, "high": 4}}})
+        + "\n"
+    )
+    loaded = store(tmp_path)
+    assert loaded.get_state("a") == (5, 6)
+    assert loaded.get_state("b") == (3, 4)
+
+
+def test_incomplete_line_is_cut_off(tmp_path):
+    states = store(tmp_path)
+    states.set_state("a", low=1, high=2)
+    states.synchronize()
+    with open(tmp_path / "states.json.log", "a") as f:
+        f.write('{"sequence": 2, "changes": {"a": {"lo')
+
+    loaded = store(tmp_path)
+    assert loaded.get_state("a") == (1, 2)
+    assert len(log_lines(tmp_path)) == 1
+    # Appends continue after the complete lines
+    loaded.set_state("a", low=1, high=3)
+    loaded.synchronize()
+    assert store(tmp_path).get_state("a") == (1, 3)
+
+
+def test_clear_removes_everything(tmp_path):
+    states = store(tmp_path, compact_bytes=0)
+    states.set_state("a", low=1, high=2)
+    states.synchronize()
+    states.clear()
+    assert len(states) == 0
+    assert len(store(tmp_path)) == 0
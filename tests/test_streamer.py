@@ -0,0 +1,77 @@
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any
+
+from benchmarks.frames import obs_st_row
+from tempest_extractor.config import ExtractorConfig, TempestConfig, TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_client import TempestCollector
+from tempest_extractor.tempest_streamer import Streamer
+
+
+def make_config(**extractor: Any) -> YamlConfig:
+    tempest = TempestConfig(
+        token="", elements=["air_temperature"], summaries=[], devices=[TempestDeviceConfig("1234", "Roof")]
+    )
+    return YamlConfig(
+        version=None,
+        type=None,
+        # Only the external ID prefix is used on the ingest path
+        cognite=SimpleNamespace(external_id_prefix="tempest:"),
+        logger=None,
+        tempest=tempest,
+        extractor=ExtractorConfig(**extractor),
+    )
+
+
+def frame(epoch: int) -> str:
+    return json.dumps({"type": "obs_st", "device_id": 1234, "obs": [obs_st_row(epoch, random.Random(epoch))]})
+
+
+def start(config: YamlConfig, queue):
+    collector = TempestCollector(config.tempest)
+    stop = threading.Event()
+    thread = threading.Thread(target=Streamer(queue, stop, collector, config).run)
+    thread.start()
+    return collector, stop, thread
+
+
+def test_push_mode_hands_on_data_as_it_arrives(recording_queue):
+    config = make_config(streaming_mode="push", collector_interval=60, flush_size=1, flush_linger=0.01)
+    queue = recording_queue
+    collector, stop, thread = start(config, queue)
+    try:
+        received = time.monotonic()
+        collector._on_message(None, frame(1661673288))
+        # Well before the polling interval
+        assert queue.added.wait(5)
+        assert time.monotonic() - received < 5
+        assert [epoch for epoch, _ in queue.datapoints["tempest:1234:air_temperature"]] == [1661673288000]
+        assert queue.uploads == 0
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_push_mode_lingers_for_a_batch_and_uploads_on_flush(recording_queue):
+    config = make_config(streaming_mode="push", flush_size=3, flush_linger=5, upload_on_flush=True)
+    queue = recording_queue
+    collector, stop, thread = start(config, queue)
+    try:
+        for i in range(3):
+            collector._on_message(None, frame(1661673288 + 60 * i))
+            if i < 2:
+                time.sleep(0.05)
+                # Waiting for flush_size rows, or flush_linger seconds
+                assert not queue.added.is_set()
+        assert queue.added.wait(5)
+        assert len(queue.datapoints["tempest:1234:air_temperature"]) == 3
+        deadline = time.monotonic() + 5
+        while not queue.uploads and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert queue.uploads == 1
+    finally:
+        stop.set()
+        thread.join()
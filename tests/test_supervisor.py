@@ -0,0 +1,201 @@
+import copy
+import json
+import os
+import sys
+import threading
+import time
+from functools import partial
+from types import SimpleNamespace
+from typing import List
+
+from cognite.extractorutils import Extractor
+from cognite.extractorutils.configtools.elements import LocalStateStoreConfig, StateStoreConfig
+from cognite.extractorutils.statestore import LocalStateStore
+
+from tempest_extractor.config import ExtractorConfig, TempestConfig, TempestDeviceConfig, YamlConfig
+from tempest_extractor.tempest_supervisor import Supervisor, _suffixed, rebalance_files, shard_of
+
+DEVICES = [str(device_id) for device_id in range(100, 120)]
+
+
+def config(tmp_path) -> SimpleNamespace:
+    # Only the parts of the configuration rebalance_files uses
+    return SimpleNamespace(
+        tempest=SimpleNamespace(get_devices=lambda: [SimpleNamespace(device_id=device_id) for device_id in DEVICES]),
+        cognite=SimpleNamespace(external_id_prefix="tempest:"),
+        aggregation=None,
+        compression=None,
+        gapfill=SimpleNamespace(path=str(tmp_path / "coverage.json")),
+        rolling=SimpleNamespace(state_path=str(tmp_path / "rolling.json")),
+    )
+
+
+def read(path) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def write(path, content: dict) -> None:
+    with open(path, "w") as f:
+        json.dump(content, f)
+
+
+def test_rebalance_files_partitions_and_merges_back(tmp_path):
+    cfg = config(tmp_path)
+    rolling = {f"tempest:{device_id}:rain_accumulation_1h": [1, 2, []] for device_id in DEVICES}
+    coverage = {device_id: [[0, 60]] for device_id in DEVICES}
+    # Entries of devices no longer configured stay in the main file
+    coverage["999"] = [[0, 60]]
+    write(cfg.rolling.state_path, rolling)
+    write(cfg.gapfill.path, coverage)
+
+    rebalance_files(cfg, 0, 3)
+    for shard in range(3):
+        keys = read(_suffixed(cfg.rolling.state_path, shard))
+        assert keys and all(shard_of(key.split(":")[1], 3) == shard for key in keys)
+        assert all(shard_of(key, 3) == shard for key in read(_suffixed(cfg.gapfill.path, shard)))
+    assert read(cfg.gapfill.path) == {"999": [[0, 60]]}
+    assert not (tmp_path / "rolling.json").exists()
+
+    rebalance_files(cfg, 3, 2)
+    assert not (tmp_path / "rolling-2.json").exists()
+    assert {**read(_suffixed(cfg.rolling.state_path, 0)), **read(_suffixed(cfg.rolling.state_path, 1))} == rolling
+
+    rebalance_files(cfg, 2, 0)
+    assert read(cfg.rolling.state_path) == rolling
+    assert read(cfg.gapfill.path) == coverage
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["coverage.json", "rolling.json"]
+
+
+def test_rebalance_files_completes_interrupted_rebalance(tmp_path):
+    cfg = config(tmp_path)
+    key = f"tempest:{DEVICES[0]}:rain_accumulation_1h"
+    target = _suffixed(cfg.rolling.state_path, shard_of(DEVICES[0], 2))
+    # Copied to its partition, but not yet removed from the main file
+    write(cfg.rolling.state_path, {key: "old"})
+    write(target, {key: "moved"})
+
+    rebalance_files(cfg, 0, 2)
+    assert read(target) == {key: "moved"}
+    assert not (tmp_path / "rolling.json").exists()
+
+
+def test_rebalance_files_keeps_unreadable_files(tmp_path):
+    cfg = config(tmp_path)
+    (tmp_path / "rolling-0.json").write_text("{not json")
+    write(cfg.rolling.state_path, {f"tempest:{device_id}:rain_accumulation_1h": 1 for device_id in DEVICES})
+
+    rebalance_files(cfg, 0, 2)
+    assert (tmp_path / "rolling-0.json").read_text() == "{not json"
+    # Entries of shard 0 stay where they were
+    assert all(shard_of(key.split(":")[1], 2) == 0 for key in read(cfg.rolling.state_path))
+    assert all(shard_of(key.split(":")[1], 2) == 1 for key in read(_suffixed(cfg.rolling.state_path, 1)))
+
+
+def record_start(path: str, crash: bool, config: YamlConfig, shard: int, workers: int) -> None:
+    """
+    Worker writing the devices of its shard to a file per shard, one line per start. The worker of shard 0 crashes the
+    first time if crash is set.
+    """
+    with open(os.path.join(path, f"starts-{shard}"), "a") as f:
+        f.write(json.dumps([device.device_id for device in config.tempest.get_devices()]) + "\n")
+    crashed = os.path.join(path, "crashed")
+    if crash and shard == 0 and not os.path.exists(crashed):
+        open(crashed, "w").close()
+        sys.exit(3)
+    time.sleep(60)
+
+
+def starts(path, shard: int) -> List[List[str]]:
+    try:
+        return [json.loads(line) for line in (path / f"starts-{shard}").read_text().splitlines()]
+    except FileNotFoundError:
+        return []
+
+
+def wait_for(condition, timeout: float = 60) -> bool:
+    # Workers are spawned, which takes a while
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def supervised_config(tmp_path, devices: List[str]) -> YamlConfig:
+    return YamlConfig(
+        version=None,
+        type=None,
+        cognite=SimpleNamespace(external_id_prefix="tempest:"),
+        logger=None,
+        tempest=TempestConfig(
+            token="",
+            elements=["air_temperature"],
+            summaries=[],
+            devices=[TempestDeviceConfig(device_id, "Roof") for device_id in devices],
+        ),
+        extractor=ExtractorConfig(
+            workers=2, state_store=StateStoreConfig(local=LocalStateStoreConfig(str(tmp_path / "states.json")))
+        ),
+    )
+
+
+def start_supervisor(tmp_path, config: YamlConfig, states: LocalStateStore, crash: bool, **kwargs) -> tuple:
+    stop = threading.Event()
+    supervisor = Supervisor(
+        config, None, states, stop, partial(record_start, str(tmp_path), crash), restart_delay=0.1, **kwargs
+    )
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    return supervisor, stop, thread
+
+
+def test_workers_are_started_per_shard_and_restarted_after_a_crash(tmp_path):
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    supervisor, stop, thread = start_supervisor(tmp_path, supervised_config(tmp_path, DEVICES), states, crash=True)
+    try:
+        assert wait_for(lambda: len(starts(tmp_path, 0)) == 2 and len(starts(tmp_path, 1)) == 1)
+        assert supervisor.restarts == 1
+        for shard in range(2):
+            assert all(shard_of(device_id, 2) == shard for device_id in starts(tmp_path, shard)[0])
+        assert sorted(starts(tmp_path, 0)[0] + starts(tmp_path, 1)[0]) == DEVICES
+        # The restarted worker collects the same devices
+        assert starts(tmp_path, 0)[1] == starts(tmp_path, 0)[0]
+    finally:
+        stop.set()
+        thread.join()
+    assert not any(process.is_alive() for process in supervisor._processes)
+
+
+def test_devices_are_resharded_when_they_change_on_reload(tmp_path, monkeypatch):
+    config = supervised_config(tmp_path, DEVICES)
+    monkeypatch.setattr(Extractor, "_config_singleton", config)
+    states = LocalStateStore(str(tmp_path / "states.json"))
+    removed = f"tempest:{DEVICES[0]}:air_temperature"
+    states.set_state(removed, 0, 60)
+    resharded: List[List[str]] = []
+    supervisor, stop, thread = start_supervisor(
+        tmp_path,
+        config,
+        states,
+        crash=False,
+        reshard=lambda reloaded: resharded.append([device.device_id for device in reloaded.tempest.get_devices()]),
+    )
+    try:
+        assert wait_for(lambda: starts(tmp_path, 0) and starts(tmp_path, 1))
+        assert removed not in states
+        devices = DEVICES[1:] + ["200"]
+        reloaded = copy.deepcopy(config)
+        reloaded.tempest.devices = [TempestDeviceConfig(device_id, "Roof") for device_id in devices]
+        monkeypatch.setattr(Extractor, "_config_singleton", reloaded)
+
+        assert wait_for(lambda: len(starts(tmp_path, 0)) == 2 and len(starts(tmp_path, 1)) == 2)
+        assert resharded == [devices]
+        assert sorted(starts(tmp_path, 0)[1] + starts(tmp_path, 1)[1]) == sorted(devices)
+        assert supervisor.restarts == 0
+    finally:
+        stop.set()
+        thread.join()
+    # States of devices no longer configured are moved back to the main state store
+    assert states.get_state(removed) == (0, 60)
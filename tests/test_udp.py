@@ -0,0 +1,81 @@
+import json
+import random
+import socket
+import threading
+import time
+from typing import Any, Dict, List
+
+import pytest
+
+from benchmarks.frames import obs_st_row
+from tempest_extractor.config import TempestConfig, TempestDeviceConfig, UdpConfig
+from tempest_extractor.tempest_client import CollectedFrame, TempestCollector
+from tempest_extractor.tempest_udp import UdpListener
+
+SERIAL = "ST-00012345"
+HUB_STATUS = {"serial_number": "HB-00000001", "type": "hub_status", "uptime": 3600}
+
+
+@pytest.fixture
+def port() -> int:
+    # A free port on localhost, so the test does not depend on a hub broadcasting on the network
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def receive(port: int, *messages: Dict[str, Any]) -> List[CollectedFrame]:
+    """
+    Send messages as datagrams to a listener on localhost, and wait for the frames it collects.
+    """
+    config = TempestConfig(token="", elements=[], summaries=[], devices=[TempestDeviceConfig("1234", "Roof")])
+    collector = TempestCollector(config)
+    stop = threading.Event()
+    listener = UdpListener(collector, UdpConfig(port=port, host="127.0.0.1", fallback_after=0), stop, {SERIAL: "1234"})
+    thread = threading.Thread(target=listener.run)
+    thread.start()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            deadline = time.monotonic() + 5
+            # Status messages of the hub until the listener has bound its socket, they are counted but not collected
+            while listener.received == 0 and time.monotonic() < deadline:
+                sender.sendto(json.dumps(HUB_STATUS).encode(), ("127.0.0.1", port))
+                time.sleep(0.05)
+            probes = listener.received
+            for message in messages:
+                sender.sendto(json.dumps(message).encode(), ("127.0.0.1", port))
+            while listener.received < probes + len(messages) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        assert probes and listener.received >= probes + len(messages)
+        return collector.buffer.drain()
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_observations_and_rapid_wind_are_parsed(port):
+    row = obs_st_row(1661673288, random.Random(0))
+    frames = receive(
+        port,
+        {"serial_number": SERIAL, "type": "obs_st", "hub_sn": "HB-00000001", "obs": [row], "firmware_revision": 156},
+        {"serial_number": SERIAL, "type": "rapid_wind", "hub_sn": "HB-00000001", "ob": [1661673291, 3.2, 187]},
+    )
+    assert [(frame.device_id, list(frame.observations.epochs)) for frame in frames] == [
+        ("1234", [1661673288]),
+        ("1234", [1661673291]),
+    ]
+    observations, rapid_wind = frames[0].observations, frames[1].observations
+    assert observations.values["air_temperature"][0] == row[7]
+    assert observations.values["wind_avg"][0] == row[2]
+    assert rapid_wind.values["rapid_wind_avg"][0] == 3.2
+    assert rapid_wind.values["rapid_wind_direction"][0] == 187
+
+
+def test_other_devices_and_status_messages_are_ignored(port):
+    frames = receive(
+        port,
+        {"serial_number": "ST-99999999", "type": "rapid_wind", "hub_sn": "HB-00000001", "ob": [1661673291, 1.0, 90]},
+        HUB_STATUS,
+        {"serial_number": SERIAL, "type": "device_status", "hub_sn": "HB-00000001", "voltage": 2.6},
+    )
+    assert frames == []